@@ -6,7 +6,7 @@ miniconda_version="4.6.14"
 miniconda_url="https://repo.anaconda.com/miniconda/Miniconda3-${miniconda_version}-Linux-x86_64.sh"
 miniconda_md5="718259965f234088d785cad1fbd7de03"
 
-python_version="3.6"
+python_version="3.8"
 
 # Define Python requirements
 python_requirements=$(cat <<EOF
@@ -16,13 +16,14 @@ click-plugins
 cligj
 cycler
 Fiona
-geopandas
+geopandas>=0.12
 joblib
 kiwisolver
 matplotlib
 munch
 numpy
-pandas
+pandas>=1.5
+pyarrow>=13
 pyparsing
 pyproj
 python-dateutil
@@ -31,9 +32,10 @@ Rtree
 scikit-learn
 scipy
 seaborn
-Shapely
+Shapely>=2.0
 six
 tqdm
+openpyxl
 xlrd
 EOF
 )
@@ -0,0 +1,77 @@
+# Benchmark of the home location imputation: Point objects built one by one (as previously done in to_gpd)
+# versus vectorized geometry construction (shapely.points and STRtree.query, as in ZoneIndex.locate) versus
+# the coordinate-array path of ZoneIndex (locate_xy, one vectorized contains_xy per zone over a slice of points).
+#
+# python -m benchmark.point_lookup -n 10000000 [--municipality-shp g1g18.shp | --segment-length 100]
+
+import time
+from optparse import OptionParser
+
+import geopandas as gpd
+import numpy as np
+import shapely
+import shapely.geometry as geo
+
+from utils.spatial import ZoneIndex, load_municipalities
+
+option_parser = OptionParser()
+option_parser.add_option("-n", "--points", type="int", default=10000000, dest="points", help="number of synthetic points")
+option_parser.add_option("--municipality-shp", dest="mun_shp", help="Shapefile of Swiss municipalities (default: synthetic grid)")
+option_parser.add_option("--segment-length", type="float", dest="segment_length", help="densify the synthetic grid to vertices this far apart (m)")
+option_parser.add_option("--skip-loop", default=False, action="store_true", dest="skip_loop", help="skip the per-point loop")
+options, args = option_parser.parse_args()
+
+# rough extent of Switzerland in EPSG:2056
+x_min, y_min, x_max, y_max = 2485000, 1075000, 2834000, 1296000
+
+if options.mun_shp is None:
+    # ~2200 square municipalities of about 6x6 km
+    xs = np.arange(x_min, x_max, 6000)
+    ys = np.arange(y_min, y_max, 6000)
+    cells = np.array([(x, y) for x in xs for y in ys])
+    df_municipalities = gpd.GeoDataFrame({"municipality_id": np.arange(len(cells))},
+                                         geometry=shapely.box(cells[:, 0], cells[:, 1], cells[:, 0] + 6000, cells[:, 1] + 6000),
+                                         crs="EPSG:2056")
+
+    if options.segment_length is not None:
+        # real municipality borders have hundreds of vertices, which makes each point-in-polygon test more expensive
+        df_municipalities.geometry = shapely.segmentize(df_municipalities.geometry.values, options.segment_length)
+else:
+    df_municipalities = load_municipalities(options.mun_shp)
+
+rng = np.random.default_rng(0)
+x = rng.uniform(x_min, x_max, options.points)
+y = rng.uniform(y_min, y_max, options.points)
+
+print("Benchmarking %d points against %d municipalities (%.0f vertices on average)..." % (
+    options.points, len(df_municipalities), np.mean(shapely.get_num_coordinates(df_municipalities.geometry.values))))
+
+start = time.perf_counter()
+municipality_index = ZoneIndex.from_frame(df_municipalities, "municipality_id")
+print("index construction: %.2fs" % (time.perf_counter() - start))
+
+results = {}
+
+if not options.skip_loop:
+    start = time.perf_counter()
+    points = [geo.Point(*coord) for coord in zip(x, y)]
+    points = gpd.GeoSeries(points, crs="EPSG:2056").values
+    conversion = time.perf_counter() - start
+    results["point loop"] = municipality_index.lookup(points)
+    print("point loop: conversion %.2fs, total %.2fs" % (conversion, time.perf_counter() - start))
+    del points
+
+start = time.perf_counter()
+points = shapely.points(x, y)
+conversion = time.perf_counter() - start
+results["tree query"] = municipality_index.lookup(points)
+print("tree query: conversion %.2fs, total %.2fs" % (conversion, time.perf_counter() - start))
+del points
+
+start = time.perf_counter()
+results["coordinate arrays"] = municipality_index.lookup_xy(x, y)
+print("coordinate arrays: total %.2fs" % (time.perf_counter() - start))
+
+reference = results["coordinate arrays"]
+for name, result in results.items():
+    print("%s identical: %s" % (name, np.array_equal(result, reference)))
@@ -0,0 +1,59 @@
+# Benchmark of the startup time of the run scripts: time to import each script in a fresh interpreter,
+# as they are now (plotting and geo stacks imported where used) and with the plotting, geo and progress bar
+# stacks imported first (as previously done at the top of the scripts and utils modules).
+#
+# python -m benchmark.startup [-r 5]
+
+import glob
+import os
+import subprocess as sp
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+# modules previously imported at module top by the scripts or by the utils modules they use
+HEAVY_MODULES = ["matplotlib.pyplot", "seaborn", "geopandas", "shapely", "sklearn.neighbors", "tqdm"]
+
+# imports a script from its path (names start with a number) and prints the import time and the heavy modules loaded
+IMPORT_SCRIPT = """
+import importlib.util, sys, time
+start = time.perf_counter()
+for name in sys.argv[2:]:
+    __import__(name)
+if sys.argv[1]:
+    spec = importlib.util.spec_from_file_location("script", sys.argv[1])
+    spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(time.perf_counter() - start)
+print(",".join(name for name in %r if name in sys.modules))
+""" % (HEAVY_MODULES,)
+
+option_parser = OptionParser()
+option_parser.add_option("-r", "--repeat", type="int", default=5, dest="repeat", help="number of fresh interpreters per measurement")
+options, args = option_parser.parse_args()
+
+src_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+env = dict(os.environ)
+env["PYTHONPATH"] = os.pathsep.join([src_dir] + ([os.environ["PYTHONPATH"]] if "PYTHONPATH" in os.environ else []))
+
+
+def import_time(script_path, preloaded):
+    # median over fresh interpreters, so that no module is cached between measurements
+    times = []
+    for i in range(options.repeat):
+        output = sp.run([sys.executable, "-c", IMPORT_SCRIPT, script_path] + preloaded,
+                        env=env, stdout=sp.PIPE, check=True, universal_newlines=True).stdout.split("\n")
+        times.append(float(output[0]))
+    return np.median(times), output[1]
+
+
+# baseline: the interpreter with numpy and pandas only, which all scripts need
+print("Benchmarking script imports over %d interpreters..." % options.repeat)
+baseline, _ = import_time("", ["numpy", "pandas"])
+print("numpy + pandas: %.2fs" % baseline)
+
+print("%-55s %10s %10s  %s" % ("script", "lazy", "eager", "heavy modules loaded (lazy)"))
+for script_path in sorted(glob.glob(os.path.join(src_dir, "run", "[0-9]*.py"))):
+    lazy, loaded = import_time(script_path, [])
+    eager, _ = import_time(script_path, HEAVY_MODULES)
+    print("%-55s %9.2fs %9.2fs  %s" % (os.path.basename(script_path), lazy, eager, loaded or "-"))
@@ -0,0 +1,279 @@
+# Benchmarks of the main stages of the analysis scripts on synthetic data (see benchmark.synthetic):
+# loading of the inputs, home location imputation, clustering, matching and export of the Swissmod trips.
+#
+# Each benchmark prepares its inputs (not timed, shared between benchmarks) and returns the function to time,
+# which is run --repeat times. Timings are written to a JSON file; given the JSON file of an earlier run,
+# benchmarks slower than the baseline by more than the tolerance are reported as regressions (exit status 1).
+#
+# python -m benchmark.suite --scale 1% --data-dir data/benchmark/1pct --output results.json [--baseline old.json]
+#
+# The synthetic data is generated first if the data directory does not contain it yet.
+#
+# The results of the matching, the export and the municipality lookup are checked against reference implementations
+# on a small synthetic sample by python-analysis/tests/test_synthetic.py.
+
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from benchmark.synthetic import generate, parse_scale
+
+YEAR = "2018"
+
+# name and function of the benchmarks, in run order
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+
+def script_module(name):
+    # script names start with a number: load them from their path rather than by module name
+    script_path = glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                         "run", name + ".py"))[0]
+    spec = importlib.util.spec_from_file_location("run_" + name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Inputs:
+    # paths of the synthetic data and intermediate results, computed once by the first benchmark needing them
+
+    def __init__(self, data_dir, work_dir):
+        self.data_dir = data_dir
+        self.work_dir = work_dir
+        self.results = {}
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def get(self, name, compute):
+        if name not in self.results:
+            self.results[name] = compute()
+        return self.results[name]
+
+    def trips_path(self):
+        # copy of trips.csv, so that the trip store is written to the work directory
+        def copy():
+            path = os.path.join(self.work_dir, "trips.csv")
+            shutil.copy(self.path("trips.csv"), path)
+            return path
+        return self.get("trips_path", copy)
+
+    def trip_store(self):
+        from utils.trip_store import open_trips
+        return self.get("trip_store", lambda: open_trips(self.trips_path()))
+
+    def home_locations(self):
+        from utils.home_locations import home_locations_table, impute_home_locations
+        self.trip_store()
+        return self.get("home_locations", lambda: home_locations_table(
+            impute_home_locations(self.trips_path(), self.path("shp/g1g18.shp"),
+                                  self.path("spatial_structure_2018.xlsx"))))
+
+    def plan_features(self):
+        script = script_module("01_annual_car_dist_home_locations_income")
+        return self.get("plan_features", lambda: script.load_features(self.path("plan_features.csv"),
+                                                                      self.path("microcensus"), None))
+
+    def beddem_agents(self):
+        from utils.beddem import load_agents, load_vehicles
+        return self.get("beddem_agents", lambda: load_agents(
+            self.path("03-trips.{year}.csv".format(year=YEAR)),
+            load_vehicles(self.path("01-disaggregatedvehiclestock.{year}.csv".format(year=YEAR)))))
+
+    def matsim_agents(self):
+        script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+        self.trip_store()
+        return self.get("matsim_agents", lambda: script.aggregate_matsim_agents(
+            script.load_matsim_car_trips(self.trips_path()), self.home_locations()))
+
+
+@benchmark("trip store conversion")
+def trip_store_conversion(inputs):
+    from utils.trip_store import convert_trips
+    store_path = os.path.join(inputs.work_dir, "trips_benchmark.parquet")
+    return lambda: convert_trips(inputs.trips_path(), store_path)
+
+
+@benchmark("car trips loading")
+def car_trips_loading(inputs):
+    from utils.trip_store import load_trips
+    inputs.trip_store()
+    return lambda: load_trips(inputs.trips_path(), filters=[("mode", "==", "car"), ("freight", "==", False)])
+
+
+@benchmark("plan features loading")
+def plan_features_loading(inputs):
+    from utils.schema import PLAN_FEATURES, read_csv
+    return lambda: read_csv(inputs.path("plan_features.csv"), PLAN_FEATURES, sep="\t")
+
+
+@benchmark("BEDDEM agents loading")
+def beddem_agents_loading(inputs):
+    from utils.beddem import load_agents, load_vehicles
+    df_vehicles = load_vehicles(inputs.path("01-disaggregatedvehiclestock.{year}.csv".format(year=YEAR)))
+    return lambda: load_agents(inputs.path("03-trips.{year}.csv".format(year=YEAR)), df_vehicles)
+
+
+@benchmark("municipalities loading")
+def municipalities_loading(inputs):
+    from utils.spatial import load_municipalities
+    return lambda: load_municipalities(inputs.path("shp/g1g18.shp"))
+
+
+@benchmark("home location imputation")
+def home_location_imputation(inputs):
+    from utils.home_locations import impute_home_locations
+    from utils.spatial import load_municipalities, load_spatial_structure
+
+    # municipalities and spatial structure are cached, as in the pipeline
+    cache_dir = os.path.join(inputs.work_dir, "cache")
+    load_municipalities(inputs.path("shp/g1g18.shp"), cache_dir)
+    load_spatial_structure(inputs.path("spatial_structure_2018.xlsx"), cache_dir)
+    inputs.trip_store()
+    return lambda: impute_home_locations(inputs.trips_path(), inputs.path("shp/g1g18.shp"),
+                                         inputs.path("spatial_structure_2018.xlsx"), cache_dir)
+
+
+@benchmark("drive time clustering")
+def drive_time_clustering(inputs):
+    script = script_module("01_annual_car_dist_home_locations_income")
+    features = script.add_home_agglo_type(inputs.plan_features(), inputs.home_locations())
+    return lambda: script.cluster_drive_time(features)
+
+
+@benchmark("park time clustering")
+def park_time_clustering(inputs):
+    script = script_module("01_activity_patterns_with_park_time")
+    features = script.load_features(inputs.path("plan_features.csv"))
+    return lambda: script.cluster_park_time(features)
+
+
+@benchmark("MATSim to BEDDEM matching")
+def matching(inputs):
+    script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+    df_agents_beddem = inputs.beddem_agents()
+    df_agents_matsim = inputs.matsim_agents()
+    return lambda: script.match_agents(df_agents_matsim.copy(), df_agents_beddem)
+
+
+@benchmark("MATSim to BEDDEM random matching")
+def random_matching(inputs):
+    script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+    df_agents_beddem = inputs.beddem_agents()
+    df_agents_matsim = inputs.matsim_agents()
+    return lambda: script.match_agents(df_agents_matsim.copy(), df_agents_beddem, matching="random")
+
+
+@benchmark("MATSim to BEDDEM features matching")
+def features_matching(inputs):
+    script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+    df_agents_beddem = inputs.beddem_agents()
+    df_agents_matsim = inputs.matsim_agents()
+    return lambda: script.match_agents(df_agents_matsim.copy(), df_agents_beddem, matching="features",
+                                       features=["distance", "number_trips"])
+
+
+@benchmark("MATSim to BEDDEM capacity matching")
+def capacity_matching(inputs):
+    script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+    df_agents_beddem = inputs.beddem_agents()
+    df_agents_matsim = inputs.matsim_agents()
+    return lambda: script.match_agents(df_agents_matsim.copy(), df_agents_beddem, matching="capacity")
+
+
+@benchmark("Swissmod trips export")
+def swissmod_export(inputs):
+    from utils.export import export_sorted
+    script = script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+    df_agents_matsim = script.match_agents(inputs.matsim_agents().copy(), inputs.beddem_agents())
+    df_trips = script.swissmod_trips(script.load_matsim_car_trips(inputs.trips_path()), df_agents_matsim)
+    path = os.path.join(inputs.work_dir, "swissmod_trips.csv")
+    return lambda: export_sorted(df_trips, script.SWISSMOD_ORDER, path)
+
+
+def run(inputs, names, repeat):
+    results = {}
+    for name, function in BENCHMARKS:
+        if names and not any(part.lower() in name.lower() for part in names):
+            continue
+
+        print("--- {name} ---".format(name=name))
+        timed = function(inputs)
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            timed()
+            times.append(time.perf_counter() - start)
+        results[name] = {"median_s": float(np.median(times)), "min_s": float(np.min(times)), "repeat": repeat}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # names of the benchmarks slower than in the baseline by more than the tolerance
+    regressions = []
+    print("%-38s %10s %10s %8s" % ("benchmark", "baseline", "current", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-38s %10s %9.3fs" % (name, "-", result["median_s"]))
+            continue
+
+        change = result["median_s"] / baseline[name]["median_s"] - 1.0
+        regression = change > tolerance
+        print("%-38s %9.3fs %9.3fs %+7.0f%%%s" % (name, baseline[name]["median_s"], result["median_s"], 100 * change,
+                                                 "  REGRESSION" if regression else ""))
+        if regression:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    option_parser = OptionParser()
+    option_parser.add_option("--scale", default="1%", dest="scale", help="share of Switzerland of the synthetic data (1%, 10%, 100% or a fraction), default = 1%")
+    option_parser.add_option("--data-dir", dest="data_dir", help="directory of the synthetic data, generated if missing")
+    option_parser.add_option("-k", "--benchmarks", dest="benchmarks", help="comma-separated parts of the names of the benchmarks to run, default = all")
+    option_parser.add_option("-r", "--repeat", type="int", default=3, dest="repeat", help="number of timed runs per benchmark")
+    option_parser.add_option("--output", dest="output", help="output path for the results (json)")
+    option_parser.add_option("--baseline", dest="baseline", help="results of an earlier run to compare with (json)")
+    option_parser.add_option("--tolerance", type="float", default=0.2, dest="tolerance", help="relative slowdown reported as regression, default = 0.2")
+    options, args = option_parser.parse_args()
+
+    scale = parse_scale(options.scale)
+    if not os.path.exists(os.path.join(options.data_dir, "03-trips.{year}.csv".format(year=YEAR))):
+        generate(options.data_dir, scale, YEAR)
+
+    with tempfile.TemporaryDirectory(prefix="sccer_benchmark_") as work_dir:
+        benchmark_names = None if options.benchmarks is None else options.benchmarks.split(",")
+        results = run(Inputs(options.data_dir, work_dir), benchmark_names, options.repeat)
+
+    print("--- RESULTS (scale %g) ---" % scale)
+    regressions = []
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], options.tolerance)
+    else:
+        for name, result in results.items():
+            print("%-38s %9.3fs (min %.3fs)" % (name, result["median_s"], result["min_s"]))
+
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump({"scale": scale, "results": results}, f, indent=1)
+
+    if len(regressions) > 0:
+        print("Regressions:", ", ".join(regressions))
+        sys.exit(1)
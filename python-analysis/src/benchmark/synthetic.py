@@ -0,0 +1,328 @@
+# Synthetic inputs of the analysis scripts, at the size of a share of Switzerland, so that the performance of the
+# pipeline can be measured without the scenario and BEDDEM data:
+#
+#     plan_features.csv, household_features.csv   as written by WriteSccerPlanFeatures / WriteSccerHouseholdFeatures
+#     trips.csv                                   as written by RunTripAnalysis
+#     01-disaggregatedvehiclestock.{year}.csv     BEDDEM vehicle stock
+#     03-trips.{year}.csv                         BEDDEM trips
+#     shp/g1g18.shp, spatial_structure_2018.xlsx  toy municipalities: a grid of ~2200 squares over Switzerland
+#     microcensus/                                microcensus vehicles and households
+#
+# Values are random (fixed seed) but follow the formats, value ranges and rough distributions of the real data.
+# The number of MATSim and BEDDEM agents is proportional to the scale, municipalities and microcensus are not.
+# Large files are written in chunks of agents, so that memory stays bounded at any scale.
+#
+# python -m benchmark.synthetic --scale 1% --output-dir data/benchmark/1pct
+
+import os
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+
+# sizes of Switzerland (100% scale)
+SWISS_PERSONS = 8500000
+SWISS_CARS = 4600000
+SCALES = {"1%": 0.01, "10%": 0.1, "100%": 1.0}
+
+# rough extent of Switzerland in EPSG:2056, covered by square municipalities
+EXTENT = (2485000, 1075000, 2834000, 1296000)
+MUNICIPALITY_SIZE = 6000
+
+MICROCENSUS_HOUSEHOLDS = 57090
+FREIGHT_SHARE = 0.005
+CHUNK_AGENTS = 200000
+
+TIME_STEP = 3600
+ACTIVITIES = ["work", "education", "shop", "leisure", "other"]
+MODES = ["car", "car_passenger", "pt", "walk", "bike"]
+MODE_SHARES = [0.5, 0.1, 0.2, 0.15, 0.05]
+VEHICLE_TYPES = ["small", "medium", "large"]
+POWERTRAINS = ["ICE", "HEV", "PHEV", "BEV"]
+POWERTRAIN_SHARES = [0.85, 0.08, 0.03, 0.04]
+BEDDEM_MODES = ["Car", "PT", "Walk", "Bike"]
+BEDDEM_MODE_SHARES = [0.65, 0.2, 0.1, 0.05]
+
+
+def parse_scale(scale):
+    # "1%", "10%", "100%" or a fraction
+    if scale in SCALES:
+        return SCALES[scale]
+    if scale.endswith("%"):
+        return float(scale[:-1]) / 100.0
+    return float(scale)
+
+
+def _chunks(count, chunk_size=CHUNK_AGENTS):
+    for start in range(0, count, chunk_size):
+        yield start, min(start + chunk_size, count)
+
+
+def _append_csv(df, path, first, **kwargs):
+    df.to_csv(path, mode="w" if first else "a", header=first, index=False, **kwargs)
+
+
+def _within_person(counts):
+    # position of each row within its person, for rows repeated counts times per person
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(np.sum(counts)) - starts
+
+
+def municipality_grid():
+    # ids and lower left corners of the square municipalities
+    xs = np.arange(EXTENT[0], EXTENT[2], MUNICIPALITY_SIZE)
+    ys = np.arange(EXTENT[1], EXTENT[3], MUNICIPALITY_SIZE)
+    x, y = np.meshgrid(xs, ys, indexing="ij")
+    return np.arange(1, x.size + 1), x.flatten(), y.flatten()
+
+
+def write_municipalities(output_dir, rng):
+    import geopandas as gpd
+    import shapely
+
+    ids, x, y = municipality_grid()
+
+    os.makedirs(os.path.join(output_dir, "shp"), exist_ok=True)
+    df_municipalities = gpd.GeoDataFrame({"GMDNR": ids, "GMDNAME": ["municipality %d" % i for i in ids]},
+                                         geometry=shapely.box(x, y, x + MUNICIPALITY_SIZE, y + MUNICIPALITY_SIZE),
+                                         crs="EPSG:2056")
+    df_municipalities.to_file(os.path.join(output_dir, "shp", "g1g18.shp"), encoding="latin1")
+
+    # spatial structure: 6 title rows, then one row per municipality with the canton in column 2,
+    # the agglomeration type in column 17 and the municipality type in column 21 (see utils.spatial)
+    df_structure = pd.DataFrame({column: "" for column in range(22)}, index=range(len(ids)))
+    df_structure[0] = ids
+    df_structure[1] = ["municipality %d" % i for i in ids]
+    df_structure[2] = rng.integers(1, 27, len(ids))
+    df_structure[17] = rng.integers(1, 8, len(ids))
+    df_structure[21] = rng.integers(1, 10, len(ids))
+    df_titles = pd.DataFrame([["Raumgliederungen der Schweiz (synthetic)"]] + [[""]] * 5)
+
+    with pd.ExcelWriter(os.path.join(output_dir, "spatial_structure_2018.xlsx")) as writer:
+        df_titles.to_excel(writer, index=False, header=False, startrow=0)
+        df_structure.to_excel(writer, index=False, header=False, startrow=6)
+
+
+def write_microcensus(output_dir, rng):
+    os.makedirs(os.path.join(output_dir, "microcensus"), exist_ok=True)
+    households = np.arange(1, MICROCENSUS_HOUSEHOLDS + 1)
+
+    # about one car per household, with negative codes for missing answers
+    vehicles = rng.choice(households, int(MICROCENSUS_HOUSEHOLDS * 1.1))
+    df_vehicles = pd.DataFrame({"HHNR": vehicles,
+                                "f30900_31700": np.where(rng.random(len(vehicles)) < 0.05, -98,
+                                                         np.round(rng.gamma(2.0, 7000.0, len(vehicles)), -2))})
+    for driver in range(1, 6):
+        df_vehicles["f30700_hpnr%d" % driver] = np.where(rng.random(len(vehicles)) < 0.5 / driver,
+                                                         rng.integers(1, 5, len(vehicles)), -99)
+    df_vehicles.to_csv(os.path.join(output_dir, "microcensus", "fahrzeuge.csv"), index=False, encoding="latin1")
+
+    df_households = pd.DataFrame({"HHNR": households,
+                                  "F20601": np.where(rng.random(len(households)) < 0.05, -98,
+                                                     rng.integers(1, 10, len(households)))})
+    df_households.to_csv(os.path.join(output_dir, "microcensus", "haushalte.csv"), index=False, encoding="latin1")
+
+
+def write_plan_features(output_dir, persons, rng):
+    # only the agents who drive have car features, -1 otherwise (as longest_stop_s of agents without car trips)
+    path = os.path.join(output_dir, "plan_features.csv")
+    hours = np.arange(0, 24 * 3600, TIME_STEP) / 3600
+
+    # share of drivers on the road per hour, with morning and evening peaks
+    on_road = 0.02 + 0.2 * np.exp(-(hours - 7.5) ** 2 / 2) + 0.25 * np.exp(-(hours - 17.5) ** 2 / 3)
+
+    for start, end in _chunks(persons):
+        count = end - start
+        drives = rng.random(count) < 0.6
+
+        driven_s = (rng.random((count, len(hours))) < on_road) * rng.uniform(60, 1800, (count, len(hours)))
+        driven_s[~drives] = 0.0
+        distance_m = driven_s * rng.uniform(5, 20, (count, len(hours)))
+
+        columns = {"agentId": np.arange(start + 1, end + 1),
+                   "age": rng.integers(0, 95, count),
+                   "sex": rng.choice(["m", "f"], count),
+                   "mzHeadId": rng.integers(1, MICROCENSUS_HOUSEHOLDS + 1, count),
+                   "mzPersonId": rng.integers(1, MICROCENSUS_HOUSEHOLDS + 1, count),
+                   "statpopHouseholdId": rng.integers(1, 4000000, count),
+                   "statpopPersonId": np.arange(start + 1, end + 1),
+                   "longest_stop_s": np.where(drives, rng.uniform(0, 14 * 3600, count), -1.0),
+                   "longest_stop_9_16_s": np.where(drives, rng.uniform(0, 7 * 3600, count), -1.0),
+                   "longest_trip_m": np.where(drives, distance_m.max(axis=1), -1.0),
+                   "total_stop_s": np.where(drives, rng.uniform(0, 16 * 3600, count), -1.0),
+                   "total_trip_m": np.where(drives, distance_m.sum(axis=1), -1.0)}
+        for hour in range(len(hours)):
+            interval = "[{start};{end}]".format(start=float(hour * TIME_STEP), end=float((hour + 1) * TIME_STEP))
+            columns["driven_s_" + interval] = driven_s[:, hour]
+            columns["distance_m_" + interval] = distance_m[:, hour]
+        # parked time per bin, read by the activity pattern scripts
+        for hour in range(len(hours)):
+            interval = "[{start};{end}]".format(start=float(hour * TIME_STEP), end=float((hour + 1) * TIME_STEP))
+            columns["parked_s_" + interval] = np.where(drives, TIME_STEP - driven_s[:, hour], 0.0)
+
+        _append_csv(pd.DataFrame(columns), path, start == 0, sep="\t")
+
+    return path
+
+
+def write_household_features(output_dir, persons, rng):
+    path = os.path.join(output_dir, "household_features.csv")
+    for start, end in _chunks(persons):
+        count = end - start
+        _append_csv(pd.DataFrame({"agentId": np.arange(start + 1, end + 1),
+                                  "householdId": rng.integers(1, 4000000, count),
+                                  "householdSize": rng.integers(1, 7, count),
+                                  "householdIncome": np.round(rng.gamma(2.0, 4000.0, count))}),
+                    path, start == 0, sep="\t")
+    return path
+
+
+def _trip_chain(persons, home_x, home_y, rng):
+    # home - activities - home chains of 2 to 6 trips per person
+    counts = rng.integers(2, 7, len(persons))
+    trips = np.sum(counts)
+    position = _within_person(counts)
+    last = position == np.repeat(counts, counts) - 1
+
+    # activity locations around home, the last trip of the chain returns home
+    spread = np.repeat(rng.lognormal(8.5, 0.8, len(persons)), counts)
+    destination_x = np.repeat(home_x, counts) + rng.normal(0, 1, trips) * spread
+    destination_y = np.repeat(home_y, counts) + rng.normal(0, 1, trips) * spread
+    destination_x[last] = np.repeat(home_x, counts)[last]
+    destination_y[last] = np.repeat(home_y, counts)[last]
+    origin_x = np.roll(destination_x, 1)
+    origin_y = np.roll(destination_y, 1)
+    origin_x[position == 0] = home_x
+    origin_y[position == 0] = home_y
+
+    following = rng.choice(ACTIVITIES, trips).astype(object)
+    following[last] = "home"
+    preceding = np.roll(following, 1)
+    preceding[position == 0] = "home"
+
+    crowfly = np.hypot(destination_x - origin_x, destination_y - origin_y)
+    network = crowfly * rng.uniform(1.1, 1.6, trips)
+    travel_time = network / rng.uniform(3, 20, trips) + 60
+
+    # trips of a person follow each other, with activities of 10 minutes to 8 hours in between
+    gaps = travel_time + rng.uniform(600, 8 * 3600, trips)
+    gaps[position == 0] = 0.0
+    elapsed = np.cumsum(gaps)
+    elapsed -= np.repeat(elapsed[position == 0], counts)
+    start_time = np.repeat(rng.uniform(5 * 3600, 10 * 3600, len(persons)), counts) + elapsed
+
+    return pd.DataFrame({"person_id": np.repeat(persons, counts),
+                         "person_trip_id": position + 1,
+                         "origin_x": origin_x,
+                         "origin_y": origin_y,
+                         "destination_x": destination_x,
+                         "destination_y": destination_y,
+                         "start_time": start_time,
+                         "travel_time": travel_time,
+                         "network_distance": network,
+                         "mode": rng.choice(MODES, trips, p=MODE_SHARES),
+                         "preceedingPurpose": preceding,
+                         "followingPurpose": following,
+                         "returning": last,
+                         "crowfly_distance": crowfly})
+
+
+def write_trips(output_dir, persons, rng):
+    path = os.path.join(output_dir, "trips.csv")
+    x_min, y_min, x_max, y_max = EXTENT
+    freight_agents = int(persons * FREIGHT_SHARE)
+
+    for start, end in _chunks(persons):
+        count = end - start
+        home_x = rng.uniform(x_min, x_max, count)
+        home_y = rng.uniform(y_min, y_max, count)
+        _append_csv(_trip_chain(np.arange(start + 1, end + 1).astype(str), home_x, home_y, rng),
+                    path, start == 0, sep=";")
+
+    # freight agents, without home activities
+    for start, end in _chunks(freight_agents):
+        count = end - start
+        df_freight = _trip_chain(np.array(["freight_%d" % i for i in range(start, end)]),
+                                 rng.uniform(x_min, x_max, count), rng.uniform(y_min, y_max, count), rng)
+        df_freight["mode"] = "car"
+        df_freight["preceedingPurpose"] = "freight"
+        df_freight["followingPurpose"] = "freight"
+        _append_csv(df_freight, path, False, sep=";")
+
+    return path
+
+
+def write_beddem(output_dir, agents, year, rng):
+    vehicles_path = os.path.join(output_dir, "01-disaggregatedvehiclestock.{year}.csv".format(year=year))
+    trips_path = os.path.join(output_dir, "03-trips.{year}.csv".format(year=year))
+
+    # one row per vehicle of the stock
+    for start, end in _chunks(agents):
+        count = end - start
+        powertrain = rng.choice(POWERTRAINS, count, p=POWERTRAIN_SHARES)
+        consumption = np.where(powertrain == "BEV", rng.uniform(12, 25, count), rng.uniform(40, 80, count))
+        _append_csv(pd.DataFrame({"ID": np.arange(start, end),
+                                  "Type_Of_Vehicle": rng.choice(VEHICLE_TYPES, count),
+                                  "Powertrain": powertrain,
+                                  "Cons": consumption,
+                                  "CO2": np.where(powertrain == "BEV", 0.0, consumption * 2.4)}),
+                    vehicles_path, start == 0)
+
+    # a week of trips per agent, 0 to 6 trips per day
+    for start, end in _chunks(agents):
+        count = end - start
+        df_agents = pd.DataFrame({"AgentID": np.arange(start, end),
+                                  "gemeindetype": rng.integers(1, 10, count),
+                                  "Kanton": rng.integers(1, 27, count),
+                                  "Vehicle_Category": rng.choice(VEHICLE_TYPES, count),
+                                  "Vehicle_Type": rng.choice(POWERTRAINS, count, p=POWERTRAIN_SHARES),
+                                  "Weight_To_Universe": rng.uniform(10, 300, count)})
+
+        counts = rng.integers(0, 7, count * 7)
+        rows = np.repeat(np.arange(count * 7), counts)
+        df_trips = df_agents.iloc[rows // 7].reset_index(drop=True)
+        df_trips["Day_Of_The_Week"] = rows % 7
+        df_trips["Time_Start"] = np.round(rng.uniform(0, 24, len(rows)), 2)
+        df_trips["Mode"] = rng.choice(BEDDEM_MODES, len(rows), p=BEDDEM_MODE_SHARES)
+        df_trips["Distance"] = np.round(rng.lognormal(2.0, 1.0, len(rows)), 2)
+        df_trips["Purpose"] = rng.choice(ACTIVITIES, len(rows))
+
+        # trips are not sorted by agent in the BEDDEM output
+        _append_csv(df_trips.sample(frac=1, random_state=rng.integers(2 ** 31)), trips_path, start == 0)
+
+    return vehicles_path, trips_path
+
+
+def generate(output_dir, scale, year=2018, seed=0):
+    # writes all inputs to output_dir, returns the number of MATSim persons and BEDDEM agents
+    rng = np.random.default_rng(seed)
+    persons = max(1, int(round(SWISS_PERSONS * scale)))
+    agents = max(1, int(round(SWISS_CARS * scale)))
+    os.makedirs(output_dir, exist_ok=True)
+
+    print("Generating municipalities and microcensus...")
+    write_municipalities(output_dir, rng)
+    write_microcensus(output_dir, rng)
+
+    print("Generating plan and household features of %d persons..." % persons)
+    write_plan_features(output_dir, persons, rng)
+    write_household_features(output_dir, persons, rng)
+
+    print("Generating trips of %d persons..." % persons)
+    write_trips(output_dir, persons, rng)
+
+    print("Generating BEDDEM vehicles and trips of %d agents..." % agents)
+    write_beddem(output_dir, agents, year, rng)
+
+    return persons, agents
+
+
+if __name__ == "__main__":
+    option_parser = OptionParser()
+    option_parser.add_option("--scale", default="1%", dest="scale", help="share of Switzerland (1%, 10%, 100% or a fraction), default = 1%")
+    option_parser.add_option("--output-dir", dest="output_dir", help="output directory")
+    option_parser.add_option("--year", default="2018", dest="year", help="year in the BEDDEM file names, default = 2018")
+    option_parser.add_option("--seed", type="int", default=0, dest="seed", help="random seed")
+    options, args = option_parser.parse_args()
+
+    generate(options.output_dir, parse_scale(options.scale), options.year, options.seed)
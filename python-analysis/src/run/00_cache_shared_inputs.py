@@ -0,0 +1,45 @@
+import json
+from optparse import OptionParser
+
+from filemanagement.directories import INTERIM_DIR
+from utils.microcensus import load_household_income, load_vehicle_km
+from utils.spatial import load_municipalities, load_spatial_structure
+
+# Reads the inputs that do not depend on the simulation year once, into the cache directory,
+# so that the scripts run for each year (possibly concurrently) only load the cached tables.
+
+
+def parse_options(argv=None):
+    option_parser = OptionParser()
+    option_parser.add_option("--mz-dir", dest="microcensus", help="microcensus data")
+    option_parser.add_option("--municipality-shp", dest="mun_shp", help="Shapefile of Swiss municipalities")
+    option_parser.add_option("--spatial-structure", dest="spatial_structure", help="Swiss spatial structure data")
+    option_parser.add_option("--cache-dir", default=INTERIM_DIR, dest="cache_dir", help="directory for cached microcensus, municipality and spatial structure data")
+    option_parser.add_option("--output", dest="output", help="output path for the summary of cached tables (json)")
+    options, args = option_parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    tables = {}
+
+    print("Caching microcensus data...")
+    tables["mz_vehicle_km"] = len(load_vehicle_km(options.microcensus, options.cache_dir))
+    tables["mz_household_income"] = len(load_household_income(options.microcensus, options.cache_dir))
+
+    print("Caching municipality shapefile...")
+    tables["municipalities"] = len(load_municipalities(options.mun_shp, options.cache_dir))
+
+    print("Caching canton and municipality type data...")
+    tables["spatial_structure"] = len(load_spatial_structure(options.spatial_structure, options.cache_dir))
+
+    # number of rows per cached table
+    with open(options.output, "w") as f:
+        json.dump(tables, f, indent=1)
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,42 @@
 import re
-from bisect import bisect, bisect_left
 from optparse import OptionParser
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
 
-option_parser = OptionParser()
-option_parser.add_option("--plans", type="string", dest="plans", help="features extracted by WriteSccerPlanFeatures")
-option_parser.add_option("--households", dest="households", help="features extracted by WriteSccerHouseholdFeatures")
-option_parser.add_option("--figure", dest="figure", help="output path for figure file")
-option_parser.add_option("--output", dest="output", help="output path for output csv")
-options, args = option_parser.parse_args()
+from utils.binning import interval_labels
+from utils.figures import render
+from utils.instrumentation import stage
+from utils.schema import HOUSEHOLD_FEATURES, PLAN_FEATURES, read_csv
+from utils.segmentation import Dimension, Segmentation, aggregate
 
-# ## Loading features and merging
-#
-# Load basic features and additional household features and merge them.
-print("Loading features and merging...")
 
-plans = pd.read_csv(filepath_or_buffer=options.plans, sep="\t")
-plans = plans.query('longest_stop_s >= 0')
-households = pd.read_csv(filepath_or_buffer=options.households, sep="\t")
-households = households.query('householdSize >= 0')
-features = pd.merge(plans,households, on="agentId")
-print(features.head(3))
+def parse_options(argv=None):
+    option_parser = OptionParser()
+    option_parser.add_option("--plans", type="string", dest="plans", help="features extracted by WriteSccerPlanFeatures")
+    option_parser.add_option("--households", dest="households", help="features extracted by WriteSccerHouseholdFeatures")
+    option_parser.add_option("--figure", dest="figure", help="output path for figure file")
+    option_parser.add_option("--no-figures", default=False, action="store_true", dest="no_figures", help="only write the output csv, without figure")
+    option_parser.add_option("--output", dest="output", help="output path for output csv")
+    options, args = option_parser.parse_args(argv)
+    return options
+
+
+@stage("load plan and household features")
+def load_features(plans_path, households_path):
+    # ## Loading features and merging
+    #
+    # Load basic features and additional household features and merge them.
+    print("Loading features and merging...")
+
+    plans = read_csv(plans_path, PLAN_FEATURES, sep="\t")
+    plans = plans.query('longest_stop_s >= 0')
+    households = read_csv(households_path, HOUSEHOLD_FEATURES, sep="\t")
+    households = households.query('householdSize >= 0')
+    features = pd.merge(plans,households, on="agentId")
+    print(features.head(3))
+    return features
+
 
 # ## Meaningful clustering
 #
@@ -35,101 +47,58 @@ print(features.head(3))
 #
 # Range depends on lots of factors, so we just use a few thresholds starting at 50km up to 100km
 
-print("Defining range clusters...")
 range_thresholds = np.array([50 * 1000 * 2 ** i for i in range(2)])
-print(range_thresholds / 1000)
 
 # PSI is additionally interested in clustering according to household size.
 # We therefore define three household types: single, couple and family.
 
-print("Defining household clusters...")
 household_thresholds = np.array([i + 1 for i in range(2)])
-print(household_thresholds)
 
 # Now, just generate one label per combination and compute labels
 
-print("Adding labels...")
-
-
-def find_range_threshold(t, thresholds, unit):
-    if t == len(thresholds):
-        return ''.join(("> ", str(thresholds[t - 1]), unit))
-    if t == 0:
-        return ''.join(("[0 , ", str(thresholds[t]), unit, "]"))
-    return ''.join(("[", str(thresholds[t - 1]), " , ", str(thresholds[t]), unit, "]"))
-
+range_dimension = Dimension("range", "longest_trip_m", interval_labels(range_thresholds / 1000, "km"),
+                            thresholds=range_thresholds)
+household_size_dimension = Dimension("household_size", "householdSize",
+                                     [str(t) for t in household_thresholds] + ["".join((str(household_thresholds[-1] + 1), " or more "))],
+                                     thresholds=household_thresholds, side="left", prefix="hhsize_")
 
-def find_hh_threshold(t, thresholds, unit):
-    if t == len(thresholds):
-        return ''.join((str(thresholds[t - 1] + 1), ' or more ', unit))
-    return ''.join((str(thresholds[t]), unit))
+# parked time per time bin, averaged per combination of range and household size
+parktime_segmentation = Segmentation([range_dimension, household_size_dimension], "parked_s", "parked_time_s")
 
 
-def comp_label(range_classes, household_size_class):
-    m = map(lambda r, s: "".join(
-        ("range_", find_range_threshold(r, range_thresholds / 1000, "km"),
-         "-hhsize_", find_hh_threshold(s, household_thresholds, ""))),
-            range_classes, household_size_class)
-    return np.array(list(m))
+@stage("aggregate travel distance")
+def cluster_park_time(features):
+    print("Defining range clusters...")
+    print(range_thresholds / 1000)
 
+    print("Defining household clusters...")
+    print(household_thresholds)
 
-pred_meaning = (features.assign(range_class=list(map(lambda x: bisect(range_thresholds, x), features.longest_trip_m)),
-                                household_size_class=list(map(lambda x: bisect_left(household_thresholds, x), features.householdSize)))
-                .assign(range_label=lambda x: list(map(lambda t: find_range_threshold(t, range_thresholds / 1000, "km"), x.range_class)),
-                        household_size_label=lambda x: list(map(lambda t: find_hh_threshold(t, household_thresholds, ""), x.household_size_class)))
-                .assign(label=lambda x: comp_label(x.range_class, x.household_size_class)))
-print(pred_meaning[["agentId",
-                    "longest_trip_m", "range_class", "range_label",
-                    "householdSize", "household_size_class", "household_size_label",
-                    "label"]].head())
+    print("Adding labels...")
+    pred_meaning = parktime_segmentation.assign(features)
+    print(pred_meaning[["agentId",
+                        "longest_trip_m", "range_class", "range_label",
+                        "householdSize", "household_size_class", "household_size_label",
+                        "label"]].head())
 
-crosstab_clusters = pd.crosstab(pred_meaning.range_label, pred_meaning.household_size_label)
-print(crosstab_clusters)
+    crosstab_clusters = pd.crosstab(pred_meaning.range_label, pred_meaning.household_size_label)
+    print(crosstab_clusters)
 
-# PSI wants to see when the cars are parked during the day.
-# We should:
-# - visualize the number of cars parked per TOD in a faceted way
-# - export a table containing the number of parked car per time bin per class
-#
-
-print("Computing when cars park...")
-parked_columns = [v for v in pred_meaning.columns.values if v.startswith("parked_s")]
-
-
-def decode_time(type):
-    def f(name):
-        interval = re.search("\[(.*)\]", name).group(1).split(';')
+    # PSI wants to see when the cars are parked during the day.
+    # We should:
+    # - visualize the number of cars parked per TOD in a faceted way
+    # - export a table containing the number of parked car per time bin per class
+    #
 
-        low= float(interval[0])
-        high=float(interval[1])
+    print("Computing when cars park...")
 
-        if (type == 'middle'): return ( low + high ) / 2.0
-        if (type == 'low'): return low
-        if (type == 'high'): return high
+    parktime_per_group, = aggregate(pred_meaning, [parktime_segmentation], [parktime_segmentation.assigned_codes(pred_meaning)])
+    parktime_per_group['parked_time_min'] = parktime_per_group['parked_time_s'] / 60.0
+    print(parktime_per_group.head(10))
+    return parktime_per_group
 
-        raise NameError(type)
-
-    return f
-
-
-parktime_per_group = pred_meaning.groupby(("range_label", "household_size_label"))[parked_columns].aggregate(np.average)
-parktime_per_group['n'] = pred_meaning.groupby(("range_label", "household_size_label"))['range_label'].aggregate(np.size)
-parktime_per_group = parktime_per_group.reset_index()
-parktime_per_group = pd.melt(parktime_per_group,
-                             id_vars=['range_label', 'household_size_label', 'n'], value_vars=parked_columns,
-                             var_name="interval_s", value_name="parked_time_s"
-                             )
-parktime_per_group['interval_start_s'] = parktime_per_group["interval_s"].apply(decode_time('low'))
-parktime_per_group['interval_end_s'] = parktime_per_group["interval_s"].apply(decode_time('high'))
-parktime_per_group['time_of_day_s'] = parktime_per_group["interval_s"].apply(decode_time('middle'))
-parktime_per_group['time_of_day_h'] = parktime_per_group['time_of_day_s'] / 3600.0
-parktime_per_group['parked_time_min'] = parktime_per_group['parked_time_s'] / 60.0
-parktime_per_group = parktime_per_group.drop(columns=['interval_s'])
-print(parktime_per_group.head(10))
 
 # To get nice plots: order categories in a meaningful way
-print("Setting up plots...")
-
 
 def numeric_range(r):
     if r.startswith(">"): return float("inf")
@@ -142,24 +111,12 @@ def numeric_hh(hh):
     return float(hh)
 
 
-# looks strange, but set cannot get a pandas series in constructor, while list can...
-print("Ordering parked times...")
-range_ordered = list(set(list(parktime_per_group.range_label)))
-range_ordered.sort(key=numeric_range)
-print(range_ordered)
-
-print("Ordering household sizes...")
-household_size_ordered = list(set(list(parktime_per_group.household_size_label)))
-household_size_ordered.sort(key= numeric_hh)
-print(household_size_ordered)
-
-
 # Cannot get bloody Seaborn to understand that my "hue" variable should be continuous...
 # Dirty hack to get this right
-print("Generating figures...")
-
 
 def create_palette(ns):
+    import seaborn as sns
+
     my_palette = {}
     m = np.log(max(ns) + 2)
     all_blues = sns.color_palette("Blues", int(m) + 1)
@@ -171,24 +128,62 @@ def create_palette(ns):
 
 
 def annotate(n, **kwargs):
+    import matplotlib.pyplot as plt
+
     print(str(n.iloc[0]))
     return plt.annotate("n=" + str(n.iloc[0]), xy=(0, 1))
 
 
-print(parktime_per_group["n"].unique())
+def plot_park_time(parktime_per_group):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    print("Setting up plots...")
+
+    # looks strange, but set cannot get a pandas series in constructor, while list can...
+    print("Ordering parked times...")
+    range_ordered = list(set(list(parktime_per_group.range_label)))
+    range_ordered.sort(key=numeric_range)
+    print(range_ordered)
+
+    print("Ordering household sizes...")
+    household_size_ordered = list(set(list(parktime_per_group.household_size_label)))
+    household_size_ordered.sort(key= numeric_hh)
+    print(household_size_ordered)
+
+    print("Generating figures...")
+    print(parktime_per_group["n"].unique())
+
+    # plot
+    grid = sns.FacetGrid(parktime_per_group,
+                         row="household_size_label", col="range_label", hue="n",
+                         row_order=household_size_ordered, col_order=range_ordered,
+                         palette=create_palette(parktime_per_group.n),
+                         margin_titles=True)
+    grid.map(annotate, "n")
+    grid.map(plt.plot, "time_of_day_h", "parked_time_min")
+    return grid
+
+
+def main(argv=None):
+    options = parse_options(argv)
+
+    features = load_features(options.plans, options.households)
+    parktime_per_group = cluster_park_time(features)
+    del features
+
+    print("Saving output...")
+    print(options.output)
+    with stage("write output") as record:
+        parktime_per_group.to_csv(options.output)
+        record.rows = len(parktime_per_group)
+
+    # figure rendered once the csv is written, from the columns it shows
+    if not options.no_figures:
+        figure_table = parktime_per_group[["range_label", "household_size_label", "n", "time_of_day_h", "parked_time_min"]]
+        render([(plot_park_time, (figure_table,), options.figure)])
+    print("Done")
 
-# plot
-grid = sns.FacetGrid(parktime_per_group,
-                     row="household_size_label", col="range_label", hue="n",
-                     row_order=household_size_ordered, col_order=range_ordered,
-                     palette=create_palette(parktime_per_group.n),
-                     margin_titles=True)
-grid.map(annotate, "n")
-grid.map(plt.plot, "time_of_day_h", "parked_time_min")
 
-print("Saving output...")
-print(options.figure)
-grid.savefig(options.figure)
-print(options.output)
-parktime_per_group.to_csv(options.output)
-print("Done")
+if __name__ == "__main__":
+    main()
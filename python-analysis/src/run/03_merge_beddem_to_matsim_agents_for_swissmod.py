@@ -1,519 +1,505 @@
+import glob
+import os
 from optparse import OptionParser
 
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import shapely.geometry as geo
-from sklearn.neighbors import KDTree
-from tqdm import tqdm
-
-option_parser = OptionParser()
-option_parser.add_option("--beddem-vehicles", dest="beddem_vehicles", help="BEDDEM disaggregated vehicle stock")
-option_parser.add_option("--beddem-trips", dest="beddem_trips", help="BEDDEM trips")
-option_parser.add_option("--matsim-trips", dest="matsim_trips", help="MATSim trips")
-option_parser.add_option("--municipality-shp", dest="mun_shp", help="Shapefile of Swiss municipalities")
-option_parser.add_option("--spatial-structure", dest="spatial_structure", help="Swiss spatial structure data")
-option_parser.add_option("--consider-cantons", default=False, action="store_true", dest="consider_cantons", help="flag whether to consider cantons when matching")
-option_parser.add_option("--fig-dir", dest="fig_dir", help="output directory for figures")
-option_parser.add_option("--fig-ext", dest="fig_ext", help="figure file extension")
-option_parser.add_option("--output", dest="output", help="output path for output csv")
-options, args = option_parser.parse_args()
-
-
-# # BEDDEM filtering
-print("--- BEDDEM ---")
-
-# load in vehicle stock
-print("Loading disaggregated vehicle stock...")
-print(options.beddem_vehicles)
-df_vehicles = pd.read_csv(filepath_or_buffer=options.beddem_vehicles)
-df_vehicles = df_vehicles.rename({"ID": "agent_id",
-                                  "Type_Of_Vehicle": "vehicle_type",
-                                  "Powertrain": "powertrain",
-                                  "Cons": "consumption"}, axis=1)
-df_vehicles = df_vehicles[["vehicle_type", "powertrain", "consumption", "CO2"]]
-df_vehicles = df_vehicles.groupby(["vehicle_type", "powertrain"]).mean().reset_index()
-print(df_vehicles.head(3))
-
-# load in trips
-print("Loading trips...")
-print(options.beddem_trips)
-df_trips = pd.read_csv(filepath_or_buffer=options.beddem_trips)
-print("number of unique agents:", len(df_trips["AgentID"].unique()))
-print("vehicle categories:", df_trips["Vehicle_Category"].unique())
-print(df_trips.sort_values("AgentID").head(3))
-
-# select only car trips
-print("Filtering car trips...")
-df_trips = df_trips[df_trips["Mode"] == "Car"].reset_index(drop=True)
-df_trips = df_trips.rename({"AgentID": "agent_id",
-                            "gemeindetype": "municipality_type",
-                            "Kanton": "canton",
-                            "Vehicle_Category": "vehicle_type",
-                            "Vehicle_Type": "powertrain",
-                            "Day_Of_The_Week": "day_of_week",
-                            "Time_Start": "time_start",
-                            "Weather": "weather",
-                            "Mode": "mode",
-                            "Distance": "distance",
-                            "Purpose": "purpose",
-                            "Weight_To_Universe": "weight"}, axis=1)
-print("number of unique car-driving agents:", len(df_trips["agent_id"].unique()))
-print("vehicle categories:", df_trips["vehicle_type"].unique())
-print(df_trips.sort_values("agent_id").head())
-
-# merge vehicle info
-print("Merging vehicle info onto trips...")
-df_trips_beddem = pd.merge(df_trips,
-                           df_vehicles,
-                           on=["vehicle_type", "powertrain"])
-df_trips_beddem = df_trips_beddem[["agent_id",
-                                   "municipality_type",
-                                   "canton",
-                                   "day_of_week",
-                                   "mode",
-                                   "distance",
-                                   "vehicle_type",
-                                   "powertrain",
-                                   "consumption",
-                                   "weight"]]
-df_trips_beddem = df_trips_beddem.sort_values(["agent_id", "day_of_week"])
-print("number of unique agents:", len(df_trips_beddem["agent_id"].unique()))
-print(df_trips_beddem.head(3))
-
-# aggregate distance travelled by car
-print("Aggregating distance travelled by car...")
-df_trips_beddem = df_trips_beddem[df_trips_beddem["day_of_week"] < 5]
-df_agents_beddem = (df_trips_beddem
-                    .groupby(["agent_id", "municipality_type",
-                              "canton", "day_of_week",
-                              "vehicle_type", "powertrain",
-                              "consumption", "weight"])["distance"]
-                    .agg(["sum", "count"])
-                    .rename(columns={"sum": "distance", "count": "number_trips"})
-                    .reset_index()
-                    .groupby(["agent_id", "municipality_type",
-                              "canton", "vehicle_type",
-                              "powertrain", "consumption"])
-                    .mean()
-                    .reset_index()
-                    )
-print("number of unique agents:", len(df_agents_beddem["agent_id"].unique()))
-print(df_agents_beddem.head(3))
-
-
-# # MATSim filtering
-print("--- MATSim ---")
-
-# load in trips (MATSim)
-print("Loading trips...")
-df_trips_matsim = pd.read_csv(filepath_or_buffer=options.matsim_trips, sep=";")
-
-# dropping trips with freight agents
-df_trips_matsim = df_trips_matsim[~df_trips_matsim["person_id"].str.contains("freight")]
-
-# convert ids to int
-df_trips_matsim["person_id"] = df_trips_matsim["person_id"].astype(np.int64)
-
-# convert distances to km
-df_trips_matsim['network_distance'] = df_trips_matsim['network_distance'] / 1000
-df_trips_matsim['crowfly_distance'] = df_trips_matsim['crowfly_distance'] / 1000
-print(df_trips_matsim.head(10))
-
-# filter only car trips
-print("Filtering car trips...")
-df_trips_car = df_trips_matsim[df_trips_matsim["mode"] == "car"]
-
-# remove trips under 1 m
-print("Removing trips under 1 m...")
-df_trips_car = df_trips_car[df_trips_car["network_distance"] > 0.001]
-print(df_trips_car.head(3))
-
-# aggregate distance travelled by car
-print("Aggregating distance travelled by car...")
-df_trips_matsim_agg = (df_trips_car[["person_id","network_distance"]]
-                       .sort_values("person_id")
-                       .groupby("person_id")["network_distance"]
-                       .agg(["sum", "count"])
-                       .rename(columns={"sum": "network_distance", "count": "number_trips"})
-                       .reset_index()
-                       )
-print(df_trips_matsim_agg.head(3))
-
-
-## Spatial data
-print("--- SPATIAL DATA ---")
-
-# load municipality shapefile
-print("Loading municipality shapefile...")
-print(options.mun_shp)
-df_municipalities = gpd.read_file(options.mun_shp, encoding = "latin1").to_crs({'init': 'EPSG:2056'})
-df_municipalities = df_municipalities[["GMDNR", "geometry"]].rename({"GMDNR":"municipality_id"}, axis=1)
-print(df_municipalities.head(3))
-
-# load spatial structure data
-print("Loading canton and municipality type data...")
-print(options.spatial_structure)
-df_municipality_types = pd.read_excel(options.spatial_structure,
-                                      names=["municipality_id", "canton_id", "municipality_type"],
-                                      usecols=[0, 2, 21],
-                                      skiprows=6,
-                                      nrows=2229,
-                                      )
-print(df_municipality_types.head(3))
-
-
-def to_gpd(df, x="x", y="y", crs={"init": "epsg:2056"}):
-    df["geometry"] = [
-        geo.Point(*coord) for coord in tqdm(
-            zip(df[x], df[y]), total=len(df),
-            desc="Converting coordinates"
-        )]
-    df = gpd.GeoDataFrame(df)
-    df.crs = crs
-
-    if not crs == {"init": "epsg:2056"}:
-        df = df.to_crs({"init": "epsg:2056"})
-
-    return df
-
-
-def impute(df_points, df_zones, point_id_field, zone_id_field, fix_by_distance=True, chunk_size=10000):
-    assert(type(df_points) == gpd.GeoDataFrame)
-    assert(type(df_zones) == gpd.GeoDataFrame)
-
-    assert(point_id_field in df_points.columns)
-    assert(zone_id_field in df_zones.columns)
-    assert(not zone_id_field in df_points.columns)
-
-    df_original = df_points
-    df_points = df_points[[point_id_field, "geometry"]]
-    df_zones = df_zones[[zone_id_field, "geometry"]]
-
-    print("Imputing %d zones into %d points by spatial join..." % (len(df_zones), len(df_points)))
-
-    result = []
-    chunk_count = max(1, int(len(df_points) / chunk_size))
-    for chunk in tqdm(np.array_split(df_points, chunk_count), total=chunk_count):
-        result.append(gpd.sjoin(df_zones, chunk, op="contains", how="right"))
-    df_points = pd.concat(result).reset_index()
-
-    if "left_index" in df_points: del df_points["left_index"]
-    if "right_index" in df_points: del df_points["right_index"]
-
-    invalid_mask = pd.isnull(df_points[zone_id_field])
-
-    if fix_by_distance and np.any(invalid_mask):
-        print("  Fixing %d points by centroid distance join..." % np.count_nonzero(invalid_mask))
-        coordinates = np.vstack([df_zones["geometry"].centroid.x, df_zones["geometry"].centroid.y]).T
-        kd_tree = KDTree(coordinates)
-
-        df_missing = df_points[invalid_mask]
-        coordinates = np.vstack([df_missing["geometry"].centroid.x, df_missing["geometry"].centroid.y]).T
-        indices = kd_tree.query(coordinates, return_distance=False).flatten()
-
-        df_points.loc[invalid_mask, zone_id_field] = df_zones.iloc[indices][zone_id_field].values
-
-    return pd.merge(df_original, df_points[[point_id_field, zone_id_field]], on=point_id_field, how="left")
-
-
-# impute canton and municipality of agent's home location
-print("Selecting MATSim agent's home locations...")
-df_home_matsim = df_trips_matsim[["person_id", "preceedingPurpose", "origin_x", "origin_y"]]
-df_home_matsim = df_home_matsim[df_home_matsim["preceedingPurpose"] == "home"]
-df_home_matsim = (df_home_matsim.drop_duplicates()
-    .rename({"origin_x": "x", "origin_y": "y"}, axis=1)[["person_id", "x", "y"]])
-df_home_matsim = to_gpd(df_home_matsim, "x", "y")
-df_home_matsim = df_home_matsim.drop(["x", "y"], axis=1)
-print(df_home_matsim.head(3))
-
-print("Imputing canton and municipality of home locations...")
-df_home = impute(df_home_matsim, df_municipalities, "person_id", "municipality_id")
-df_home = pd.merge(df_home, df_municipality_types, on="municipality_id")
-df_home = df_home[["person_id", "canton_id", "municipality_type"]]
-print(df_home.head(3))
-
-# merge spatial info
-print("Merging home location info onto MATSim trips...")
-df_trips_matsim_agg = pd.merge(df_trips_matsim_agg, df_home, on="person_id")
-df_trips_matsim_agg = df_trips_matsim_agg.sort_values(["canton_id", "municipality_type"])
-print(df_trips_matsim_agg.head())
-
-
-# # Matching
-print("--- MATCHING ---")
-
-print(df_trips_matsim_agg.head(3))
-print(df_agents_beddem.head(3))
-
-# set some default values
-df_trips_matsim_agg["agent_id"] = 0
-df_trips_matsim_agg["canton_id_beddem"] = 0
-df_trips_matsim_agg["municipality_type_beddem"] = 0
-df_trips_matsim_agg["vehicle_type"] = ''
-df_trips_matsim_agg["powertrain"] = ''
-df_trips_matsim_agg["consumption"] = 0
-df_trips_matsim_agg["distance_beddem"] = 0
-df_trips_matsim_agg["number_trips_beddem"] = 0
-
-# match MATSim agents to BedDem agents
-municipality_types = df_trips_matsim_agg["municipality_type"].unique()
-
-with tqdm(desc="Matching MATSim agents to BedDem agents", total=len(municipality_types)) as municipality_progress:
-    for municipality_type in municipality_types:
-
-        # create MATSim municipality filter
-        f_matsim_municipality = (df_trips_matsim_agg["municipality_type"] == municipality_type)
-
-        # create BEDDEM filters
-        f_beddem_m_c = np.ones(len(df_agents_beddem), dtype=np.bool)
-        f_beddem_municipality = (df_agents_beddem["municipality_type"] == municipality_type)
-
-        # create KDtree from BEDDEM agents using municipalities only
-        coordinates_municipality = np.vstack([df_agents_beddem.loc[f_beddem_municipality, "distance"].values]).T
-        kd_tree_municipality = KDTree(coordinates_municipality)
-
-        canton_ids = df_trips_matsim_agg.loc[f_matsim_municipality, "canton_id"].unique()
-        for canton_id in canton_ids:
-
-            # get relevant MATSim agents
-            f_matsim_canton = (df_trips_matsim_agg["canton_id"] == canton_id)
-            f_matsim_m_c = (f_matsim_canton & f_matsim_municipality)
-
-            # get relevant BEDDEM agents
-            f_beddem_canton = (df_agents_beddem["canton"] == canton_id)
-            f_beddem_m_c = (f_beddem_canton & f_beddem_municipality)
-
-            # if no match, only consider municipality type
-            if (np.sum(f_beddem_m_c) == 0):
-                f_beddem_m_c = f_beddem_municipality
-
-            # create KDtree from BEDDEM agents using both municipalities and cantons
-            coordinates_municipality_canton = np.vstack([df_agents_beddem.loc[f_beddem_m_c, "distance"].values]).T
-            kd_tree_municipality_canton = KDTree(coordinates_municipality_canton)
-
-            # try to match MATSim agents using both municipalities and cantons
-            matsim_pts = np.vstack([df_trips_matsim_agg.loc[f_matsim_m_c, "network_distance"].values]).T
-            (distances, indices) = kd_tree_municipality_canton.query(matsim_pts, return_distance=True)
-            indices = indices.flatten()
-            distances = distances.flatten()
-
-            # get matches within 1 km
-            f_direct = distances <= 5
-            f_matsim_m_c_direct = np.zeros(np.shape(f_matsim_m_c), dtype=bool)
-            f_matsim_m_c_direct[f_matsim_m_c] = f_direct
-            df_matches_direct = df_agents_beddem.loc[f_beddem_m_c, :].iloc[list(indices[f_direct])]
-
-            # get matched data
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "agent_id"] = df_matches_direct.loc[:, "agent_id"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "canton_id_beddem"] = df_matches_direct.loc[:, "canton"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "municipality_type_beddem"] = df_matches_direct.loc[:, "municipality_type"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "vehicle_type"] = df_matches_direct.loc[:, "vehicle_type"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "powertrain"] = df_matches_direct.loc[:, "powertrain"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "consumption"] = df_matches_direct.loc[:, "consumption"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "distance_beddem"] = df_matches_direct.loc[:, "distance"].values
-            df_trips_matsim_agg.loc[f_matsim_m_c_direct, "number_trips_beddem"] = df_matches_direct.loc[:, "number_trips"].values
-
-            # try to match only with municipalities otherwise, if there is anything left to match
-            if np.sum(~f_direct) > 0:
-                matsim_pts_indirect = matsim_pts[~f_direct]
-                (distances_indirect, indices_indirect) = kd_tree_municipality.query(matsim_pts_indirect, return_distance=True)
-                distances_indirect = distances_indirect.flatten()
-                indices_indirect = indices_indirect.flatten()
-
-                f_matsim_m_c_indirect = np.zeros(np.shape(f_matsim_m_c), dtype=bool)
-                f_matsim_m_c_indirect[f_matsim_m_c] = ~f_direct
-
-                df_matches_indirect = df_agents_beddem.loc[f_beddem_municipality, :].iloc[list(indices_indirect)]
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "agent_id"] = df_matches_indirect.loc[:, "agent_id"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "canton_id_beddem"] = df_matches_indirect.loc[:, "canton"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "municipality_type_beddem"] = df_matches_indirect.loc[:, "municipality_type"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "vehicle_type"] = df_matches_indirect.loc[:, "vehicle_type"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "powertrain"] = df_matches_indirect.loc[:, "powertrain"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "consumption"] = df_matches_indirect.loc[:, "consumption"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "distance_beddem"] = df_matches_indirect.loc[:, "distance"].values
-                df_trips_matsim_agg.loc[f_matsim_m_c_indirect, "number_trips_beddem"] = df_matches_indirect.loc[:, "number_trips"].values
-
-        municipality_progress.update()
-
-print(df_trips_matsim_agg.head(3))
-
-
-# # Comparing results
-print("--- MATCHING RESULTS ---")
-# distance matching -- scatter plot
-print("distance matching: scatter plot")
-plt.figure(dpi=120)
-plt.plot(df_trips_matsim_agg["network_distance"].values, df_trips_matsim_agg["distance_beddem"].values, ".")
-plt.xlabel("MATSim daily distance by car (km)")
-plt.ylabel("BEDDEM daily distance by car (km)")
-print("Plotting results...")
-plt.savefig('{dir}/distance_scatter.{ext}'.format(dir=options.fig_dir, ext=options.fig_ext))
-
-# distance matching -- relative error
-print("distance matching: relative error")
-plt.figure(dpi=120)
-dist_rel_err = np.abs(df_trips_matsim_agg["network_distance"].values - df_trips_matsim_agg["distance_beddem"].values) / df_trips_matsim_agg["network_distance"].values
-dist_rel_err = dist_rel_err[dist_rel_err < 1 ]
-plt.hist(dist_rel_err, 100)
-plt.xlim((0,1))
-plt.xlabel("Relative error on daily distance by car")
-print("Plotting results...")
-plt.savefig('{dir}/distance_comparison.{ext}'.format(dir=options.fig_dir, ext=options.fig_ext))
-print("Error <= 25%:", np.sum(dist_rel_err <= 0.25) / len(df_trips_matsim_agg))
-print("Error > 25%:", np.sum(dist_rel_err > 0.25) / len(df_trips_matsim_agg))
-
-# number of trips matching -- absolute error
-print("number of trips matching: absolute error")
-plt.figure(dpi=120)
-trips_abs_err = np.abs(df_trips_matsim_agg["number_trips"].values - df_trips_matsim_agg["number_trips_beddem"].values)
-plt.hist(trips_abs_err, 100)
-plt.xlim((0,10))
-plt.xlabel("Absolute error on number of car trips")
-print("Plotting results...")
-plt.savefig('{dir}/number_trips_comparison.{ext}'.format(dir=options.fig_dir, ext=options.fig_ext))
-print("Absolute error <= 2 trips:", np.sum(trips_abs_err <= 2) / len(df_trips_matsim_agg))
-print("Absolute error > 2 trips:", np.sum(trips_abs_err > 2) / len(df_trips_matsim_agg))
-
-# compare canton matching
-print("Comparing canton matching...")
-print("Correctly matched cantons:",np.sum(df_trips_matsim_agg["canton_id"].values == df_trips_matsim_agg["canton_id_beddem"].values) / len(df_trips_matsim_agg))
-print("Incorrectly matched cantons:",np.sum(df_trips_matsim_agg["canton_id"].values != df_trips_matsim_agg["canton_id_beddem"].values) / len(df_trips_matsim_agg))
-
-# compare municipality type matching
-print("Comparing municipality type matching...")
-print("Correctly matched municipality types:", np.sum(df_trips_matsim_agg["municipality_type"].values == df_trips_matsim_agg["municipality_type_beddem"].values) / len(df_trips_matsim_agg))
-print("Incorrectly matched municipality types:",np.sum(df_trips_matsim_agg["municipality_type"].values != df_trips_matsim_agg["municipality_type_beddem"].values) / len(df_trips_matsim_agg))
-
-# # Vehicle stocks
-print("--- VEHICLE STOCKS ---")
-
-# matsim vehicle stock
-print("Getting MATSim vehicle stock...")
-df_vehicle_stock_matsim = (df_trips_matsim_agg[["vehicle_type", "powertrain"]]
-                           .groupby(["vehicle_type", "powertrain"])
-                           .size()
-                           .reset_index()
-                           .rename(columns={0: "count"})
-                           )
-print(df_vehicle_stock_matsim.head(3))
 
-# beddem stock for agents using car
-print("Getting BEDDEM vehicle stock...")
-df_vehicle_stock_beddem = (df_agents_beddem[["vehicle_type", "powertrain", "weight"]]
-                           .groupby(["vehicle_type", "powertrain"])
-                           .sum()
+import utils
+from filemanagement.directories import INTERIM_DIR
+from utils.beddem import CHUNK_SIZE, load_agents, load_vehicles
+from utils.cache import digest_memo_path, fingerprint
+from utils.export import CHUNK_SIZE as EXPORT_CHUNK_SIZE, export_sorted
+from utils.figures import histogram, render
+from utils.home_locations import home_locations_table, impute_home_locations, load_home_locations
+from utils.instrumentation import stage
+from utils.match_index import load_match_index, match_index_path_for, write_match_index
+from utils.matching import match_capacity, match_features, match_nearest, match_random
+from utils.trip_store import load_trips
+
+# strata of MATSim and BEDDEM agents tried when matching, from the finest to the coarsest
+MATCHING_STRATA = [(["municipality_type", "canton_id"], ["municipality_type", "canton"]),
+                   (["municipality_type"], ["municipality_type"])]
+
+# matching modes: nearest daily distance, drawn by BEDDEM weight among daily distances within the tolerance,
+# nearest on several scaled features, or assigned by daily distance under capacities given by the BEDDEM weights
+MATCHING_MODES = ["nearest", "random", "features", "capacity"]
+RANDOM_TOLERANCE = 0.01
+
+# features of the features matching mode, as MATSim and BEDDEM columns (start times in hours)
+MATCHING_FEATURES = {"distance": ("network_distance", "distance"),
+                     "number_trips": ("number_trips", "number_trips"),
+                     "start_time_mean": ("start_time_mean", "start_time_mean"),
+                     "start_time_std": ("start_time_std", "start_time_std")}
+
+# columns of the Swissmod trips, exported sorted by SWISSMOD_ORDER
+SWISSMOD_COLUMNS = ["vehicleId", "vehicleType", "powertrain", "consumption", "startTime", "endTime",
+                    "startX", "startY", "endX", "endY", "startActivityType", "endActivityType", "travelDistance_km"]
+SWISSMOD_ORDER = ["startTime", "endTime"]
+
+# BEDDEM attributes copied onto matched MATSim agents
+MATCHED_COLUMNS = {"agent_id": "agent_id",
+                   "canton": "canton_id_beddem",
+                   "municipality_type": "municipality_type_beddem",
+                   "vehicle_type": "vehicle_type",
+                   "powertrain": "powertrain",
+                   "consumption": "consumption",
+                   "distance": "distance_beddem",
+                   "number_trips": "number_trips_beddem"}
+
+
+def parse_options(argv=None):
+    option_parser = OptionParser()
+    option_parser.add_option("--beddem-vehicles", dest="beddem_vehicles", help="BEDDEM disaggregated vehicle stock")
+    option_parser.add_option("--beddem-trips", dest="beddem_trips", help="BEDDEM trips")
+    option_parser.add_option("--beddem-chunk-size", type="int", default=CHUNK_SIZE, dest="beddem_chunk_size", help="number of BEDDEM trips read at once")
+    option_parser.add_option("--matsim-trips", dest="matsim_trips", help="MATSim trips")
+    option_parser.add_option("--municipality-shp", dest="mun_shp", help="Shapefile of Swiss municipalities")
+    option_parser.add_option("--spatial-structure", dest="spatial_structure", help="Swiss spatial structure data")
+    option_parser.add_option("--home-locations", dest="home_locations", help="home locations written by utils.home_locations (imputed from the MATSim trips if not given)")
+    option_parser.add_option("--cache-dir", default=INTERIM_DIR, dest="cache_dir", help="directory for cached municipality and spatial structure data")
+    option_parser.add_option("--consider-cantons", default=False, action="store_true", dest="consider_cantons", help="flag whether to consider cantons when matching")
+    option_parser.add_option("--matching", type="choice", choices=MATCHING_MODES, default="nearest", dest="matching", help="matching of MATSim to BEDDEM agents: nearest (daily distance), random (drawn by BEDDEM weight within 1% of the daily distance), features (nearest on --matching-features) or capacity (BEDDEM agents used in proportion to their weight), default = nearest")
+    option_parser.add_option("--matching-features", default="distance,number_trips", dest="matching_features", help="comma-separated features of the features matching, among distance (required), number_trips, start_time_mean and start_time_std, default = distance,number_trips")
+    option_parser.add_option("--seed", type="int", default=0, dest="seed", help="seed of the random matching, default = 0")
+    option_parser.add_option("--match-index", dest="match_index", help="path of the persisted matching, reused while the matching inputs are unchanged (default: next to the output, *.matches.parquet)")
+    option_parser.add_option("--rematch", default=False, action="store_true", dest="rematch", help="match again even if the persisted matching is up to date")
+    option_parser.add_option("--workers", type="int", default=1, dest="workers", help="number of processes used for matching, exporting the Swissmod trips and rendering figures")
+    option_parser.add_option("--fig-dir", dest="fig_dir", help="output directory for figures")
+    option_parser.add_option("--no-figures", default=False, action="store_true", dest="no_figures", help="only write the output csv, without figures")
+    option_parser.add_option("--fig-ext", dest="fig_ext", help="figure file extension")
+    option_parser.add_option("--export-chunk-size", type="int", default=EXPORT_CHUNK_SIZE, dest="export_chunk_size", help="number of Swissmod trips sorted and written at once")
+    option_parser.add_option("--output", dest="output", help="output path for output csv (.csv.gz, .csv.zst: compressed csv, .parquet: Parquet)")
+    options, args = option_parser.parse_args(argv)
+
+    features = options.matching_features.split(",")
+    if "distance" not in features or not set(features) <= set(MATCHING_FEATURES):
+        option_parser.error("invalid matching features: {features}".format(features=options.matching_features))
+    return options
+
+
+def matching_features(names):
+    # MATSim and BEDDEM columns of the features, daily distance first
+    return [columns for name, columns in MATCHING_FEATURES.items() if name in names]
+
+
+@stage("load BEDDEM vehicle stock")
+def load_beddem_vehicles(vehicles_path):
+    # # BEDDEM filtering
+    print("--- BEDDEM ---")
+
+    # load in vehicle stock
+    print("Loading disaggregated vehicle stock...")
+    print(vehicles_path)
+    df_vehicles = load_vehicles(vehicles_path)
+    print(df_vehicles.head(3))
+    return df_vehicles
+
+
+@stage("load BEDDEM agents")
+def load_beddem_agents(df_vehicles, trips_path, chunk_size=CHUNK_SIZE, start_times=False):
+    # load in car trips and aggregate distance travelled by car on weekdays, chunk by chunk
+    print("Loading trips and aggregating distance travelled by car...")
+    print(trips_path)
+    df_agents_beddem = load_agents(trips_path, df_vehicles, chunk_size=chunk_size, start_times=start_times)
+    print("number of unique car-driving agents:", len(df_agents_beddem["agent_id"].unique()))
+    print("vehicle categories:", df_agents_beddem["vehicle_type"].unique())
+    print(df_agents_beddem.head(3))
+    return df_agents_beddem
+
+
+@stage("load MATSim car trips")
+def load_matsim_car_trips(trips_path):
+    # # MATSim filtering
+    print("--- MATSim ---")
+
+    # load in car trips (MATSim), without freight agents
+    print("Loading car trips...")
+    df_trips_car = load_trips(trips_path, filters=[("mode", "==", "car"), ("freight", "==", False)])
+    df_trips_car = df_trips_car.drop(["freight", "freight_id"], axis=1)
+
+    # convert distances to km
+    df_trips_car['network_distance'] = df_trips_car['network_distance'] / 1000
+    df_trips_car['crowfly_distance'] = df_trips_car['crowfly_distance'] / 1000
+    print(df_trips_car.head(10))
+
+    # remove trips under 1 m
+    print("Removing trips under 1 m...")
+    df_trips_car = df_trips_car[df_trips_car["network_distance"] > 0.001]
+    print(df_trips_car.head(3))
+    return df_trips_car
+
+
+@stage("aggregate MATSim agents")
+def aggregate_matsim_agents(df_trips_car, df_home, start_times=False):
+    # aggregate distance travelled by car
+    print("Aggregating distance travelled by car...")
+    df_trips_matsim_agg = (df_trips_car[["person_id","network_distance"]]
+                           .sort_values("person_id")
+                           .groupby("person_id")["network_distance"]
+                           .agg(["sum", "count"])
+                           .rename(columns={"sum": "network_distance", "count": "number_trips"})
                            .reset_index()
-                           .rename(columns={"weight": "count"})
                            )
-print(df_vehicle_stock_beddem.head(3))
-
-# compare vehicle stocks
-print("Comparing vehicle stocks...")
-df_vehicle_stock_compare = pd.merge(df_vehicle_stock_matsim, df_vehicle_stock_beddem,
-                                    on=["vehicle_type", "powertrain"],
-                                    how="outer",
-                                    suffixes=["_matsim", "_beddem"]).fillna(0.0)
-df_vehicle_stock_compare["count_matsim"] = df_vehicle_stock_compare["count_matsim"] / np.sum(df_vehicle_stock_compare["count_matsim"])
-df_vehicle_stock_compare["count_beddem"] = df_vehicle_stock_compare["count_beddem"] / np.sum(df_vehicle_stock_compare["count_beddem"])
-
-a = df_vehicle_stock_compare.rename({"count_matsim": "share"}, axis=1).drop("count_beddem", axis=1)
-b = df_vehicle_stock_compare.rename({"count_beddem": "share"}, axis=1).drop("count_matsim", axis=1)
-
-a["case"] = "matsim"
-b["case"] = "beddem"
-
-df_vehicle_stock_compare = pd.concat([a, b])
-
-sns.set(style="whitegrid")
-ax1 = sns.catplot(x="powertrain", y="share",
-                  hue="case",
-                  col="vehicle_type",
-                  kind="bar",
-                  data=df_vehicle_stock_compare)
-
-print("Plotting results...")
-ax1.savefig('{dir}/vehicle_stock_comparison.{ext}'.format(dir=options.fig_dir, ext=options.fig_ext))
-
-
-# # Generating output for Swissmod
-print("--- SWISSMOD ---")
-print("Generating output for Swissmod...")
-
-# merge vehicle info into matsim car trips
-print("Merging agent vehicle info into MATSim car trips...")
-df_matsim_agent_veh = df_trips_matsim_agg[["person_id", "vehicle_type", "powertrain", "consumption"]]
-df_trips_w_veh = pd.merge(df_trips_car, df_matsim_agent_veh, on="person_id")
-
-# get end times
-print("Getting trip end times...")
-df_trips_w_veh.loc[:,"endTime"] = df_trips_w_veh.loc[:,"start_time"] + df_trips_w_veh.loc[:,"travel_time"]
-
-# rename columns
-print("Renaming and cleaning column names...")
-renames = {"person_id":"vehicleId",
-           "vehicle_type":"vehicleType",
-           "start_time":"startTime",
-           "origin_x":"startX",
-           "origin_y":"startY",
-           "destination_x":"endX",
-           "destination_y":"endY",
-           "preceedingPurpose":"startActivityType",
-           "followingPurpose":"endActivityType",
-           "network_distance":"travelDistance_km"}
-df_trips_w_veh = df_trips_w_veh.rename(index=str, columns=renames)
-
-# only keep desired columns
-df_trips_w_veh = df_trips_w_veh[["vehicleId",
-                                 "vehicleType",
-                                 "powertrain",
-                                 "consumption",
-                                 "startTime",
-                                 "endTime",
-                                 "startX",
-                                 "startY",
-                                 "endX",
-                                 "endY",
-                                 "startActivityType",
-                                 "endActivityType",
-                                 "travelDistance_km"]]
-
-# set to desired format
-print("Setting desired data types...")
-df_trips_w_veh.loc[:, "vehicleId"] = df_trips_w_veh.loc[:, "vehicleId"].astype(int)
-df_trips_w_veh.loc[:, "vehicleType"] = df_trips_w_veh.loc[:, "vehicleType"].astype(str)
-df_trips_w_veh.loc[:, "powertrain"] = df_trips_w_veh.loc[:, "powertrain"].astype(str)
-df_trips_w_veh.loc[:, "consumption"] = df_trips_w_veh.loc[:, "consumption"].astype(float)
-df_trips_w_veh.loc[:, "startTime"] = df_trips_w_veh.loc[:, "startTime"].astype(float)
-df_trips_w_veh.loc[:, "endTime"] = df_trips_w_veh.loc[:, "endTime"].astype(float)
-df_trips_w_veh.loc[:, "startX"] = df_trips_w_veh.loc[:, "startX"].astype(float)
-df_trips_w_veh.loc[:, "startY"] = df_trips_w_veh.loc[:, "startY"].astype(float)
-df_trips_w_veh.loc[:, "endX"] = df_trips_w_veh.loc[:, "endX"].astype(float)
-df_trips_w_veh.loc[:, "endY"] = df_trips_w_veh.loc[:, "endY"].astype(float)
-df_trips_w_veh.loc[:, "startActivityType"] = df_trips_w_veh.loc[:, "startActivityType"].astype(str)
-df_trips_w_veh.loc[:, "endActivityType"] = df_trips_w_veh.loc[:, "endActivityType"].astype(str)
-df_trips_w_veh.loc[:, "travelDistance_km"] = df_trips_w_veh.loc[:, "travelDistance_km"].astype(float)
-
-# sort by timestamp
-print("Sorting data by timestamp...")
-df_trips_w_veh = df_trips_w_veh.sort_values(by=["startTime","endTime"], ascending=True)
-print(df_trips_w_veh.head(10))
-
-# plot distance distribution
-print("Plotting distance distribution...")
-data = df_trips_w_veh["travelDistance_km"].values
-plt.figure(dpi=120)
-plt.hist(data, bins=500)
-x_max = np.ceil(np.percentile(data, 95) / 10) * 10
-plt.xlim((0, x_max))
-plt.xlabel("Distance (km)")
-plt.ylabel("# of car trips")
-plt.savefig('{dir}/distance_distribution.{ext}'.format(dir=options.fig_dir, ext=options.fig_ext))
-
-# save to file
-print("Saving output...")
-df_trips_w_veh.to_csv(options.output, sep=",", index=False)
-
-print("Done")
\ No newline at end of file
+    print(df_trips_matsim_agg.head(3))
+
+    if start_times:
+        # mean and standard deviation of the start times of the car trips, in hours as in BEDDEM
+        start_time_h = (df_trips_car["start_time"] / 3600.0).groupby(df_trips_car["person_id"])
+        df_moments = pd.DataFrame({"start_time_mean": start_time_h.mean(),
+                                   "start_time_std": start_time_h.std(ddof=0)}).reset_index()
+        df_trips_matsim_agg = pd.merge(df_trips_matsim_agg, df_moments, on="person_id")
+
+    # merge spatial info (df_home: see utils.home_locations)
+    print("Merging home location info onto MATSim trips...")
+    df_home = df_home[["person_id", "canton_id", "municipality_type"]]
+    df_trips_matsim_agg = pd.merge(df_trips_matsim_agg, df_home, on="person_id")
+    df_trips_matsim_agg = df_trips_matsim_agg.sort_values(["canton_id", "municipality_type"])
+    print(df_trips_matsim_agg.head())
+    return df_trips_matsim_agg
+
+
+@stage("match agents")
+def match_agents(df_trips_matsim_agg, df_agents_beddem, workers=1, matching="nearest", seed=0, features=("distance",)):
+    # features: names of the features of the features matching (see MATCHING_FEATURES)
+    # # Matching
+    print("--- MATCHING ---")
+
+    print(df_trips_matsim_agg.head(3))
+    print(df_agents_beddem.head(3))
+
+    # set some default values
+    df_trips_matsim_agg["agent_id"] = 0
+    df_trips_matsim_agg["canton_id_beddem"] = 0
+    df_trips_matsim_agg["municipality_type_beddem"] = 0
+    df_trips_matsim_agg["vehicle_type"] = ''
+    df_trips_matsim_agg["powertrain"] = ''
+    df_trips_matsim_agg["consumption"] = 0.0
+    df_trips_matsim_agg["distance_beddem"] = 0.0
+    df_trips_matsim_agg["number_trips_beddem"] = 0.0
+
+    print("Matching MATSim agents to BedDem agents ({matching})...".format(matching=matching))
+    if matching == "random":
+        # BEDDEM agent drawn by weight among daily distances within 1%, within municipality type and canton
+        # if there are BEDDEM agents there, within municipality type otherwise (nearest if none within 1%)
+        matches = match_random(df_trips_matsim_agg, df_agents_beddem, "network_distance", "distance", "weight",
+                               MATCHING_STRATA, tolerance=RANDOM_TOLERANCE, seed=seed)
+    elif matching == "features":
+        # nearest on the features scaled by their standard deviation among BEDDEM agents, within municipality type
+        # and canton among the BEDDEM agents with a daily distance within 5 km if any, within municipality type otherwise
+        matches = match_features(df_trips_matsim_agg, df_agents_beddem, matching_features(features),
+                                 MATCHING_STRATA, max_distance=5.0)
+    elif matching == "capacity":
+        # BEDDEM agents used in proportion to their weight scaled to the number of MATSim agents, within municipality
+        # type and canton if there are BEDDEM agents there, within municipality type otherwise,
+        # assigned in order of daily distance
+        matches = match_capacity(df_trips_matsim_agg, df_agents_beddem, "network_distance", "distance", "weight",
+                                 MATCHING_STRATA)
+    else:
+        # nearest daily distance within municipality type and canton if within 5 km,
+        # nearest within municipality type otherwise
+        matches = match_nearest(df_trips_matsim_agg, df_agents_beddem, "network_distance", "distance",
+                                MATCHING_STRATA, max_distance=5.0, workers=workers)
+
+    # get matched data
+    f_matched = matches >= 0
+    df_matches = df_agents_beddem.iloc[matches[f_matched]]
+    for beddem_column, matsim_column in MATCHED_COLUMNS.items():
+        df_trips_matsim_agg.loc[f_matched, matsim_column] = df_matches[beddem_column].values
+    print("Matched within canton:", np.mean(df_trips_matsim_agg["canton_id"].values
+                                            == df_trips_matsim_agg["canton_id_beddem"].values))
+
+    print(df_trips_matsim_agg.head(3))
+    return df_trips_matsim_agg
+
+
+def match_key(options, df_vehicles):
+    # fingerprint of everything the matching depends on: BEDDEM and MATSim trips, home locations, matching parameters
+    # and code, and the vehicle types of the vehicle stock (BEDDEM agents with other vehicle types are dropped),
+    # but not its consumption values. File digests are memoized in the cache directory, so that the BEDDEM and MATSim
+    # trips are only hashed again once they changed.
+    sources = [options.beddem_trips, options.matsim_trips, __file__]
+    sources += [os.path.join(os.path.dirname(utils.__file__), name) for name in ["beddem.py", "matching.py"]]
+    if options.home_locations:
+        sources.append(options.home_locations)
+    else:
+        sources += glob.glob(os.path.splitext(options.mun_shp)[0] + ".*") + [options.spatial_structure]
+
+    vehicle_types = sorted(zip(df_vehicles["vehicle_type"], df_vehicles["powertrain"]))
+    params = [options.matching, MATCHING_STRATA, vehicle_types]
+    if options.matching == "random":
+        params += [options.seed, RANDOM_TOLERANCE]
+    elif options.matching == "features":
+        params += [matching_features(options.matching_features.split(","))]
+    return fingerprint(sources, *params, memo_path=digest_memo_path(options.cache_dir))
+
+
+@stage("re-join vehicles")
+def rejoin_vehicles(df_matches, df_vehicles):
+    # consumption of the vehicle type and powertrain of the matched BEDDEM agents (0 for unmatched agents),
+    # as set by match_agents
+    print("Joining consumption of the vehicle stock onto matched MATSim agents...")
+    df_matches = pd.merge(df_matches, df_vehicles[["vehicle_type", "powertrain", "consumption"]],
+                          on=["vehicle_type", "powertrain"], how="left")
+    df_matches["consumption"] = df_matches["consumption"].fillna(0.0)
+    print(df_matches.head(3))
+    return df_matches
+
+
+@stage("compare matching")
+def compare_matching(df_trips_matsim_agg):
+    # # Comparing results
+    print("--- MATCHING RESULTS ---")
+    # distance matching -- relative error
+    print("distance matching: relative error")
+    dist_rel_err = np.abs(df_trips_matsim_agg["network_distance"].values - df_trips_matsim_agg["distance_beddem"].values) / df_trips_matsim_agg["network_distance"].values
+    dist_rel_err = dist_rel_err[dist_rel_err < 1 ]
+    print("Error <= 25%:", np.sum(dist_rel_err <= 0.25) / len(df_trips_matsim_agg))
+    print("Error > 25%:", np.sum(dist_rel_err > 0.25) / len(df_trips_matsim_agg))
+
+    # number of trips matching -- absolute error
+    print("number of trips matching: absolute error")
+    trips_abs_err = np.abs(df_trips_matsim_agg["number_trips"].values - df_trips_matsim_agg["number_trips_beddem"].values)
+    print("Absolute error <= 2 trips:", np.sum(trips_abs_err <= 2) / len(df_trips_matsim_agg))
+    print("Absolute error > 2 trips:", np.sum(trips_abs_err > 2) / len(df_trips_matsim_agg))
+
+    # compare canton matching
+    print("Comparing canton matching...")
+    print("Correctly matched cantons:",np.sum(df_trips_matsim_agg["canton_id"].values == df_trips_matsim_agg["canton_id_beddem"].values) / len(df_trips_matsim_agg))
+    print("Incorrectly matched cantons:",np.sum(df_trips_matsim_agg["canton_id"].values != df_trips_matsim_agg["canton_id_beddem"].values) / len(df_trips_matsim_agg))
+
+    # compare municipality type matching
+    print("Comparing municipality type matching...")
+    print("Correctly matched municipality types:", np.sum(df_trips_matsim_agg["municipality_type"].values == df_trips_matsim_agg["municipality_type_beddem"].values) / len(df_trips_matsim_agg))
+    print("Incorrectly matched municipality types:",np.sum(df_trips_matsim_agg["municipality_type"].values != df_trips_matsim_agg["municipality_type_beddem"].values) / len(df_trips_matsim_agg))
+    return dist_rel_err, trips_abs_err
+
+
+def distance_pairs(df_trips_matsim_agg):
+    # MATSim and BEDDEM daily distances of the agents for the scatter plot,
+    # rounded to 10 m (far below the figure resolution) and deduplicated
+    pairs = np.round(df_trips_matsim_agg[["network_distance", "distance_beddem"]].values, 2)
+    return np.unique(pairs, axis=0)
+
+
+def plot_distance_scatter(pairs):
+    import matplotlib.pyplot as plt
+
+    # distance matching -- scatter plot
+    print("distance matching: scatter plot")
+    figure = plt.figure(dpi=120)
+    plt.plot(pairs[:, 0], pairs[:, 1], ".")
+    plt.xlabel("MATSim daily distance by car (km)")
+    plt.ylabel("BEDDEM daily distance by car (km)")
+    return figure
+
+
+def plot_distance_error(counts, edges):
+    import matplotlib.pyplot as plt
+
+    # distance matching -- relative error
+    figure = plt.figure(dpi=120)
+    plt.hist(edges[:-1], edges, weights=counts)
+    plt.xlim((0,1))
+    plt.xlabel("Relative error on daily distance by car")
+    return figure
+
+
+def plot_number_trips_error(counts, edges):
+    import matplotlib.pyplot as plt
+
+    # number of trips matching -- absolute error
+    figure = plt.figure(dpi=120)
+    plt.hist(edges[:-1], edges, weights=counts)
+    plt.xlim((0,10))
+    plt.xlabel("Absolute error on number of car trips")
+    return figure
+
+
+@stage("compare vehicle stocks")
+def compare_vehicle_stocks(df_trips_matsim_agg, df_agents_beddem):
+    # # Vehicle stocks
+    print("--- VEHICLE STOCKS ---")
+
+    # matsim vehicle stock
+    print("Getting MATSim vehicle stock...")
+    df_vehicle_stock_matsim = (df_trips_matsim_agg[["vehicle_type", "powertrain"]]
+                               .groupby(["vehicle_type", "powertrain"])
+                               .size()
+                               .reset_index()
+                               .rename(columns={0: "count"})
+                               )
+    print(df_vehicle_stock_matsim.head(3))
+
+    # beddem stock for agents using car
+    print("Getting BEDDEM vehicle stock...")
+    df_vehicle_stock_beddem = (df_agents_beddem[["vehicle_type", "powertrain", "weight"]]
+                               .groupby(["vehicle_type", "powertrain"])
+                               .sum()
+                               .reset_index()
+                               .rename(columns={"weight": "count"})
+                               )
+    print(df_vehicle_stock_beddem.head(3))
+
+    # compare vehicle stocks
+    print("Comparing vehicle stocks...")
+    df_vehicle_stock_compare = pd.merge(df_vehicle_stock_matsim, df_vehicle_stock_beddem,
+                                        on=["vehicle_type", "powertrain"],
+                                        how="outer",
+                                        suffixes=["_matsim", "_beddem"]).fillna(0.0)
+    df_vehicle_stock_compare["count_matsim"] = df_vehicle_stock_compare["count_matsim"] / np.sum(df_vehicle_stock_compare["count_matsim"])
+    df_vehicle_stock_compare["count_beddem"] = df_vehicle_stock_compare["count_beddem"] / np.sum(df_vehicle_stock_compare["count_beddem"])
+
+    a = df_vehicle_stock_compare.rename({"count_matsim": "share"}, axis=1).drop("count_beddem", axis=1)
+    b = df_vehicle_stock_compare.rename({"count_beddem": "share"}, axis=1).drop("count_matsim", axis=1)
+
+    a["case"] = "matsim"
+    b["case"] = "beddem"
+
+    return pd.concat([a, b])
+
+
+def plot_vehicle_stocks(df_vehicle_stock_compare):
+    import seaborn as sns
+
+    with sns.axes_style("whitegrid"):
+        return sns.catplot(x="powertrain", y="share",
+                           hue="case",
+                           col="vehicle_type",
+                           kind="bar",
+                           data=df_vehicle_stock_compare)
+
+
+@stage("build Swissmod trips")
+def swissmod_trips(df_trips_car, df_trips_matsim_agg):
+    # Swissmod output columns of the car trips of matched agents (see SWISSMOD_COLUMNS), built in one pass from
+    # typed arrays: trips in the order of df_trips_car, sorted by time when exported (see utils.export)
+    # # Generating output for Swissmod
+    print("--- SWISSMOD ---")
+    print("Generating output for Swissmod...")
+
+    # vehicle info of the agent of each car trip (trips of agents absent from df_trips_matsim_agg are dropped)
+    print("Joining agent vehicle info onto MATSim car trips...")
+    agents = pd.Index(df_trips_matsim_agg["person_id"]).get_indexer(df_trips_car["person_id"])
+    trips = np.flatnonzero(agents >= 0)
+    agents = agents[trips]
+
+    def trip_values(name):
+        return df_trips_car[name].to_numpy(np.float64)[trips]
+
+    def categories(values, rows):
+        # strings as categories, so that they are neither copied per row nor converted when written
+        values = pd.Categorical(values)
+        return pd.Categorical.from_codes(values.codes[rows], values.categories)
+
+    start_time = trip_values("start_time")
+    columns = {"vehicleId": df_trips_car["person_id"].to_numpy(np.int64)[trips],
+               "vehicleType": categories(df_trips_matsim_agg["vehicle_type"], agents),
+               "powertrain": categories(df_trips_matsim_agg["powertrain"], agents),
+               "consumption": df_trips_matsim_agg["consumption"].to_numpy(np.float64)[agents],
+               "startTime": start_time,
+               "endTime": start_time + trip_values("travel_time"),
+               "startX": trip_values("origin_x"),
+               "startY": trip_values("origin_y"),
+               "endX": trip_values("destination_x"),
+               "endY": trip_values("destination_y"),
+               "startActivityType": categories(df_trips_car["preceedingPurpose"], trips),
+               "endActivityType": categories(df_trips_car["followingPurpose"], trips),
+               "travelDistance_km": trip_values("network_distance")}
+
+    df_trips_w_veh = pd.DataFrame(columns, columns=SWISSMOD_COLUMNS, copy=False)
+    print(df_trips_w_veh.head(10))
+    return df_trips_w_veh
+
+
+def distance_distribution(df_trips_w_veh):
+    # histogram of the trip distances, shown up to the 95th percentile
+    data = df_trips_w_veh["travelDistance_km"].values
+    counts, edges = histogram(data, 500)
+    x_max = np.ceil(np.percentile(data, 95) / 10) * 10
+    return counts, edges, x_max
+
+
+def plot_distance_distribution(counts, edges, x_max):
+    import matplotlib.pyplot as plt
+
+    # plot distance distribution
+    print("Plotting distance distribution...")
+    figure = plt.figure(dpi=120)
+    plt.hist(edges[:-1], edges, weights=counts)
+    plt.xlim((0, x_max))
+    plt.xlabel("Distance (km)")
+    plt.ylabel("# of car trips")
+    return figure
+
+
+def main(argv=None, df_home=None):
+    # df_home: home locations (see utils.home_locations), imputed here if not given by the caller
+    options = parse_options(argv)
+
+    # start time moments are only computed if matched on
+    features = options.matching_features.split(",")
+    start_times = options.matching == "features" and any(name.startswith("start_time") for name in features)
+
+    df_vehicles = load_beddem_vehicles(options.beddem_vehicles)
+    df_trips_car = load_matsim_car_trips(options.matsim_trips)
+
+    def figure_path(name):
+        return '{dir}/{name}.{ext}'.format(dir=options.fig_dir, name=name, ext=options.fig_ext)
+
+    # if only the consumption values of the vehicle stock changed, the persisted matching is reused
+    # (the matching figures are then those of the run that matched)
+    match_index_path = options.match_index or match_index_path_for(options.output)
+    key = match_key(options, df_vehicles)
+    df_matches = None if options.rematch else load_match_index(match_index_path, key)
+
+    # figures are drawn from small tables, so that the agent and trip tables can be released before rendering
+    figures = []
+    if df_matches is not None:
+        df_trips_matsim_agg = rejoin_vehicles(df_matches, df_vehicles)
+    else:
+        df_agents_beddem = load_beddem_agents(df_vehicles, options.beddem_trips, options.beddem_chunk_size,
+                                              start_times)
+
+        ## Spatial data
+        if df_home is None and options.home_locations:
+            df_home = load_home_locations(options.home_locations)
+        elif df_home is None:
+            print("--- SPATIAL DATA ---")
+            df_home = home_locations_table(impute_home_locations(options.matsim_trips, options.mun_shp,
+                                                                 options.spatial_structure, options.cache_dir))
+
+        df_trips_matsim_agg = aggregate_matsim_agents(df_trips_car, df_home, start_times)
+        df_trips_matsim_agg = match_agents(df_trips_matsim_agg, df_agents_beddem, options.workers,
+                                           options.matching, options.seed, features)
+        write_match_index(df_trips_matsim_agg, match_index_path, key)
+
+        dist_rel_err, trips_abs_err = compare_matching(df_trips_matsim_agg)
+        df_vehicle_stock_compare = compare_vehicle_stocks(df_trips_matsim_agg, df_agents_beddem)
+        del df_agents_beddem
+
+        if not options.no_figures:
+            figures = [(plot_distance_scatter, (distance_pairs(df_trips_matsim_agg),), figure_path("distance_scatter")),
+                       (plot_distance_error, histogram(dist_rel_err, 100), figure_path("distance_comparison")),
+                       (plot_number_trips_error, histogram(trips_abs_err, 100), figure_path("number_trips_comparison")),
+                       (plot_vehicle_stocks, (df_vehicle_stock_compare,), figure_path("vehicle_stock_comparison"))]
+
+    df_trips_w_veh = swissmod_trips(df_trips_car, df_trips_matsim_agg)
+    if not options.no_figures:
+        figures.append((plot_distance_distribution, distance_distribution(df_trips_w_veh),
+                        figure_path("distance_distribution")))
+
+    # save to file, sorted by timestamp
+    print("Saving output...")
+    with stage("write output") as record:
+        record.rows = export_sorted(df_trips_w_veh, SWISSMOD_ORDER, options.output, options.workers,
+                                    options.export_chunk_size)
+    del df_trips_car, df_trips_matsim_agg, df_trips_w_veh
+
+    render(figures, options.workers)
+
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
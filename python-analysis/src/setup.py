@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='sccer-python-analysis',
     version='',
-    packages=['utils'],
+    packages=['benchmark', 'filemanagement', 'utils'],
     url='',
     license='',
     author='thibautd',
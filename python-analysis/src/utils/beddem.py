@@ -0,0 +1,123 @@
+# Loaders for the BEDDEM vehicle stock and trip files.
+#
+# The trip file is streamed in chunks: each chunk is reduced to car distance and number of trips per agent
+# and weekday before being accumulated, so that peak memory is bounded by the chunk size
+# and by the number of agent-days, and not by the size of the file.
+#
+# Optionally, the mean and standard deviation of the start times of the car trips of each agent (in hours) are
+# computed as well, from sums of start times and of their squares accumulated in the same way.
+
+import numpy as np
+import pandas as pd
+
+from utils.schema import BEDDEM_TRIPS, BEDDEM_VEHICLES, read_csv
+
+VEHICLE_COLUMNS = {"Type_Of_Vehicle": "vehicle_type",
+                   "Powertrain": "powertrain",
+                   "Cons": "consumption",
+                   "CO2": "CO2"}
+
+TRIP_COLUMNS = {"AgentID": "agent_id",
+                "gemeindetype": "municipality_type",
+                "Kanton": "canton",
+                "Vehicle_Category": "vehicle_type",
+                "Vehicle_Type": "powertrain",
+                "Day_Of_The_Week": "day_of_week",
+                "Mode": "mode",
+                "Distance": "distance",
+                "Weight_To_Universe": "weight"}
+
+START_TIME_COLUMNS = {"Time_Start": "start_time"}
+
+AGENT_DAY_KEYS = ["agent_id", "municipality_type", "canton", "day_of_week", "vehicle_type", "powertrain", "weight"]
+AGENT_KEYS = ["agent_id", "municipality_type", "canton", "vehicle_type", "powertrain", "consumption"]
+
+CHUNK_SIZE = 1000000
+
+
+def load_vehicles(path):
+    # average consumption and CO2 emissions per vehicle type and powertrain
+    df_vehicles = read_csv(path, BEDDEM_VEHICLES, usecols=list(VEHICLE_COLUMNS.keys()))
+    df_vehicles = df_vehicles.rename(VEHICLE_COLUMNS, axis=1)
+    df_vehicles = df_vehicles.groupby(["vehicle_type", "powertrain"], observed=True).mean().reset_index()
+
+    # a few rows: plain strings, as in the aggregated BEDDEM trips
+    df_vehicles["vehicle_type"] = df_vehicles["vehicle_type"].astype(str)
+    df_vehicles["powertrain"] = df_vehicles["powertrain"].astype(str)
+    return df_vehicles
+
+
+def _aggregate_days(df_trips):
+    # car distance and number of car trips per agent and weekday (and sums of start times, if read)
+    df_trips = df_trips[(df_trips["mode"] == "Car") & (df_trips["day_of_week"] < 5)]
+    start_times = "start_time" in df_trips.columns
+    if start_times:
+        df_trips = df_trips.assign(start_time_squared=df_trips["start_time"] ** 2)
+    groups = df_trips.groupby(AGENT_DAY_KEYS, observed=True)
+
+    df_days = (groups["distance"]
+               .agg(["sum", "count"])
+               .rename(columns={"sum": "distance", "count": "number_trips"}))
+    if start_times:
+        df_days[["start_time", "start_time_squared"]] = groups[["start_time", "start_time_squared"]].sum()
+    df_days = df_days.reset_index()
+
+    # categories differ from chunk to chunk, plain strings can be accumulated
+    df_days["vehicle_type"] = df_days["vehicle_type"].astype(str)
+    df_days["powertrain"] = df_days["powertrain"].astype(str)
+
+    return df_days
+
+
+def _fold_days(partials):
+    sums = [column for column in partials[0].columns if column not in AGENT_DAY_KEYS]
+    return pd.concat(partials).groupby(AGENT_DAY_KEYS, as_index=False)[sums].sum()
+
+
+def load_agents(path, df_vehicles, chunk_size=CHUNK_SIZE, start_times=False):
+    # average daily car distance and number of car trips on weekdays per BEDDEM agent
+    # start_times: add the mean and standard deviation of the start times of the car trips (start_time_mean/_std)
+    from tqdm import tqdm
+
+    columns = dict(TRIP_COLUMNS, **(START_TIME_COLUMNS if start_times else {}))
+    partials = []
+    partial_rows = 0
+    folded_rows = 0
+
+    with tqdm(desc="Streaming BEDDEM trips", unit=" trips") as progress:
+        for df_chunk in read_csv(path, BEDDEM_TRIPS, usecols=list(columns.keys()), chunksize=chunk_size):
+            df_chunk = df_chunk.rename(columns, axis=1)
+            partials.append(_aggregate_days(df_chunk))
+            partial_rows += len(partials[-1])
+            progress.update(len(df_chunk))
+
+            # trips of an agent-day can be spread over several chunks: merge partial aggregates regularly,
+            # once they exceed a chunk and twice the size of the last merge (so that merges do not repeat for
+            # every chunk once there are more agent-days than the chunk size)
+            if partial_rows > max(chunk_size, 2 * folded_rows):
+                partials = [_fold_days(partials)]
+                partial_rows = len(partials[0])
+                folded_rows = partial_rows
+
+    if len(partials) == 0:
+        raise ValueError("no trips found in {path}".format(path=path))
+
+    df_days = _fold_days(partials)
+
+    # merge vehicle info (agents with vehicle types absent from the vehicle stock are dropped)
+    df_days = pd.merge(df_days, df_vehicles[["vehicle_type", "powertrain", "consumption"]],
+                       on=["vehicle_type", "powertrain"])
+
+    df_days = df_days[["agent_id", "municipality_type", "canton", "day_of_week",
+                       "vehicle_type", "powertrain", "consumption", "weight",
+                       "distance", "number_trips"] + (["start_time", "start_time_squared"] if start_times else [])]
+    df_agents = df_days.groupby(AGENT_KEYS).mean().reset_index()
+    if not start_times:
+        return df_agents
+
+    # moments over all car trips of the agent: daily means of the sums divided by the daily mean number of trips
+    mean = df_agents["start_time"] / df_agents["number_trips"]
+    variance = df_agents["start_time_squared"] / df_agents["number_trips"] - mean ** 2
+    df_agents["start_time_mean"] = mean
+    df_agents["start_time_std"] = np.sqrt(np.maximum(variance, 0.0))
+    return df_agents.drop(["start_time", "start_time_squared"], axis=1)
@@ -0,0 +1,42 @@
+# Vectorized classification of agents into classes delimited by thresholds.
+#
+# Classes are computed for all agents at once with np.searchsorted, and labels are looked up
+# from a small table with one label per class, so that no string is built per agent.
+# Labels are returned as categoricals whose categories follow the class order.
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+def classify(values, thresholds, side="right"):
+    # class of each value: number of thresholds below it (side="right", as bisect.bisect)
+    # or strictly below it (side="left", as bisect.bisect_left)
+    return np.searchsorted(thresholds, values, side=side).astype(np.uint8)
+
+
+def interval_labels(thresholds, unit):
+    # "[0 , t0unit]", "[t0 , t1unit]", ..., "> tnunit"
+    labels = ["".join(("[0 , ", str(thresholds[0]), unit, "]"))]
+    labels += ["".join(("[", str(low), " , ", str(high), unit, "]")) for low, high in zip(thresholds[:-1], thresholds[1:])]
+    labels += ["".join(("> ", str(thresholds[-1]), unit))]
+    return labels
+
+
+def to_labels(classes, labels):
+    return pd.Categorical.from_codes(classes, categories=labels, ordered=True)
+
+
+def combine_labels(prefixes, label_columns, separator="-"):
+    # one label per combination, e.g. prefixes ["range_", "time_"] -> "range_[0 , 50.0km]-time_[0 , 2.0h]"
+    label_columns = [pd.Categorical(column) for column in label_columns]
+
+    codes = np.zeros(len(label_columns[0]), dtype=np.int64)
+    for column in label_columns:
+        codes = codes * len(column.categories) + column.codes
+
+    labels = [separator.join(prefix + str(label) for prefix, label in zip(prefixes, combination))
+              for combination in itertools.product(*[column.categories for column in label_columns])]
+
+    return pd.Categorical.from_codes(codes, categories=labels, ordered=True)
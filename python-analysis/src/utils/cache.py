@@ -0,0 +1,90 @@
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_digests(paths, memo_path=None):
+    # content digests of a set of files. Given a memo path, they are memoized there (JSON) by absolute path, size and
+    # modification time, as done by the pipeline, so that large unchanged inputs are not hashed again on every run.
+    if memo_path is None:
+        return {path: file_digest(path) for path in paths}
+
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+
+    digests = {}
+    updated = False
+    for path in paths:
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = memo.get(os.path.abspath(path))
+        if entry is None or entry[:2] != stamp:
+            entry = stamp + [file_digest(path)]
+            memo[os.path.abspath(path)] = entry
+            updated = True
+        digests[path] = entry[2]
+
+    if updated:
+        os.makedirs(os.path.dirname(os.path.abspath(memo_path)), exist_ok=True)
+        temp_path = "{path}.{pid}.tmp".format(path=memo_path, pid=os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(memo, f)
+        os.replace(temp_path, memo_path)
+
+    return digests
+
+
+def fingerprint(paths, *params, memo_path=None):
+    # content hash of a set of source files and of any parameters used to derive data from them
+    # (file digests are memoized in memo_path if given, see file_digests)
+    digests = file_digests(paths, memo_path)
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode())
+        digest.update(digests[path].encode())
+    for param in params:
+        digest.update(repr(param).encode())
+    return digest.hexdigest()
+
+
+def digest_memo_path(cache_dir):
+    return os.path.join(cache_dir, "digests.json")
+
+
+def cached_frame(cache_dir, name, sources, build, params=(), reader=pd.read_parquet):
+    # Returns the data frame produced by build(), stored as {cache_dir}/{name}.{key}.parquet.
+    # The key is derived from the content of the source files, so that the cache is rebuilt
+    # automatically whenever one of them changes. Outdated versions are removed.
+    key = fingerprint(sources, *params, memo_path=digest_memo_path(cache_dir))[:16]
+    path = os.path.join(cache_dir, "{name}.{key}.parquet".format(name=name, key=key))
+
+    if os.path.exists(path):
+        print("Loading cached {name} from {path}".format(name=name, path=path))
+        return reader(path)
+
+    df = build()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for outdated_path in glob.glob(os.path.join(cache_dir, "{name}.*.parquet".format(name=name))):
+        os.remove(outdated_path)
+
+    # write to a temporary file first so that concurrent runs never see a partial cache
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    df.to_parquet(temp_path)
+    os.replace(temp_path, path)
+    print("Cached {name} to {path}".format(name=name, path=path))
+
+    return df
@@ -0,0 +1,271 @@
+# Export of large tables sorted by time, e.g. the Swissmod trips of script 03, without a sorted copy of the table.
+#
+# Rows are ordered stably by the key columns (np.lexsort, ties in table order) in two passes:
+#   1. the table is split in chunks of rows, each sorted by the keys;
+#   2. the range of the first key is split in windows of about a chunk, from a sample of its values: each window
+#      is the k-way merge of the slices of the sorted chunks falling into it, sorted runs concatenated in chunk order,
+#      so that a stable sort of the window gives the rows in the order of a stable sort of the whole table.
+# Windows are then formatted and written one after the other, so that memory beyond the table is bounded by the
+# chunk size:
+#
+#     export_sorted(df_trips, ["startTime", "endTime"], "01-trips.2018.csv.gz", workers=4)
+#
+# The output format follows the extension of the path: Parquet (zstd) for .parquet, one row group per window,
+# compressed CSV for .gz and .zst, one compressed frame per window (concatenated frames decompress as a single
+# stream, e.g. by gzip -d, zstd -d or pandas), and plain CSV otherwise.
+#
+# CSV text is the same as written by DataFrame.to_csv(index=False), but formatted by Arrow when all columns are
+# numbers or categories without separators or quotes: Python writes floats in their shortest round-trip form
+# (repr), and so does Arrow for most values written in fixed notation by Python (1e-4 <= |x| < 1e16), except for
+# the ".0" of integral values, added back. Other values (e.g. 1e-05, or long values written with an exponent by
+# Arrow) are formatted by Python, and other tables by pandas. The text is compared to DataFrame.to_csv on edge values
+# by python-analysis/tests/test_export.py.
+#
+# With workers > 1, chunks are sorted and windows formatted by a process pool. The columns are copied once into
+# shared memory (see utils.shared_arrays) and the workers write the chunk orders into a shared array; windows are
+# written as soon as they are ready in order, with at most PENDING_PER_WORKER windows per worker held in memory.
+# The output does not depend on the number of workers.
+
+import os
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from utils.shared_arrays import attach, release, share
+
+CHUNK_SIZE = 250000
+
+# number of windows per worker, for load balancing
+CHUNKS_PER_WORKER = 4
+
+# windows being formatted or waiting to be written, per worker
+PENDING_PER_WORKER = 2
+
+# sampled values of the first key per window, to place the window bounds
+SAMPLES_PER_WINDOW = 64
+
+# CSV compression by extension, as pyarrow codecs and levels (the defaults of the gzip and zstd tools)
+CSV_COMPRESSIONS = {".gz": ("gzip", 6), ".zst": ("zstd", 3)}
+
+# range of absolute values written in fixed notation by Python
+FIXED_NOTATION = (1e-4, 1e16)
+
+
+def output_format(path):
+    # "parquet" or "csv", and the codec and level of CSV outputs (None: plain text)
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        return "parquet", None
+    if extension in [".bz2", ".xz", ".zip", ".tar"]:
+        raise ValueError("unsupported compression of {path}: use .gz or .zst".format(path=path))
+    return "csv", CSV_COMPRESSIONS.get(extension)
+
+
+def _table(df, keys, file_format, compression):
+    # numpy arrays of the columns (codes of categorical columns) and categories, as used by the functions below
+    arrays = {}
+    categories = {}
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            arrays[name] = df[name].cat.codes.values
+            categories[name] = df[name].cat.categories
+        else:
+            arrays[name] = df[name].values
+    return {"names": list(df.columns), "arrays": arrays, "categories": categories, "keys": keys,
+            "format": file_format, "compression": compression, "arrow_csv": _arrow_csv(arrays, categories)}
+
+
+def _arrow_csv(arrays, categories):
+    # whether Arrow writes the same CSV text as pandas: numbers, and names and categories needing no quotes
+    if any(any(character in str(name) for character in ',"\r\n') for name in arrays):
+        return False
+    for name, values in arrays.items():
+        if name in categories:
+            if any(any(character in str(category) for character in ',"\r\n') for category in categories[name]):
+                return False
+        elif values.dtype.kind not in "iuf":
+            return False
+    return True
+
+
+def _float_text(values):
+    # floats as written by pandas: shortest round-trip text (Python repr), empty for NaN
+    text = pc.cast(pa.array(values, from_pandas=True), pa.string())
+    exponent = pc.fill_null(pc.match_substring(text, "e"), False).to_numpy(zero_copy_only=False)
+    text = pc.if_else(pc.match_substring(text, "."), text, pc.binary_join_element_wise(text, ".0", ""))
+
+    magnitudes = np.abs(values)
+    fixed = (magnitudes >= FIXED_NOTATION[0]) & (magnitudes < FIXED_NOTATION[1]) | (values == 0)
+    python = ~(fixed & ~exponent | np.isnan(values))
+    if python.any():
+        text = pc.replace_with_mask(text, pa.array(python), pa.array([repr(value) for value in values[python].tolist()]))
+    return text
+
+
+def _csv_text(df, table, header):
+    # CSV text of a window, as a buffer
+    if not table["arrow_csv"]:
+        return pa.py_buffer(df.to_csv(index=False, header=header).encode())
+
+    columns = []
+    for name in table["names"]:
+        values = df[name]
+        if name in table["categories"]:
+            columns.append(pc.cast(pa.array(values), pa.string()))
+        elif values.dtype.kind == "f":
+            columns.append(_float_text(values.values))
+        else:
+            columns.append(pa.array(values.values))
+
+    # (Arrow quotes the header)
+    sink = pa.BufferOutputStream()
+    if header:
+        sink.write((",".join(table["names"]) + "\n").encode())
+    pa_csv.write_csv(pa.table(columns, names=table["names"]), sink,
+                     pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+    return sink.getvalue()
+
+
+def _window_bounds(table, windows):
+    # values of the first key splitting the rows in about equal windows, from a strided sample
+    values = table["arrays"][table["keys"][0]]
+    step = max(1, len(values) // (windows * SAMPLES_PER_WINDOW))
+    sample = np.sort(values[::step])
+    return np.unique(sample[(np.arange(1, windows) * len(sample)) // windows])
+
+
+def _sort_chunk(table, chunk, bounds):
+    # sorts the rows start:end into the table order, and returns the positions of the window bounds in the chunk
+    start, end = chunk
+    chunk_order = np.lexsort([table["arrays"][name][start:end] for name in reversed(table["keys"])])
+    table["order"][start:end] = start + chunk_order
+
+    first_key = table["arrays"][table["keys"][0]][start:end][chunk_order]
+    return np.concatenate([[0], np.searchsorted(first_key, bounds, side="left"), [end - start]]) + start
+
+
+def _merge_window(table, ranges):
+    # rows of a window: k-way merge of the sorted slices of the chunks, in chunk order, by a stable sort
+    rows = np.concatenate([table["order"][start:end] for start, end in ranges])
+    return rows[np.lexsort([table["arrays"][name][rows] for name in reversed(table["keys"])])]
+
+
+def _format_window(table, ranges, header):
+    # number of rows, and compressed CSV text or Arrow table of a window
+    rows = _merge_window(table, ranges)
+    columns = {}
+    for name in table["names"]:
+        values = table["arrays"][name][rows]
+        if name in table["categories"]:
+            values = pd.Categorical.from_codes(values, table["categories"][name])
+        columns[name] = values
+    df = pd.DataFrame(columns, columns=table["names"])
+
+    if table["format"] == "parquet":
+        return len(rows), pa.Table.from_pandas(df, preserve_index=False)
+
+    text = _csv_text(df, table, header)
+    if table["compression"] is not None:
+        codec, level = table["compression"]
+        text = pa.Codec(codec, compression_level=level).compress(text)
+    return len(rows), text
+
+
+def _window_ranges(cuts):
+    # ranges of the table order of each window, one per chunk
+    cuts = np.array(cuts)
+    return [list(zip(cuts[:, window], cuts[:, window + 1])) for window in range(cuts.shape[1] - 1)]
+
+
+def _write_parts(parts, path, file_format, total):
+    from tqdm import tqdm
+
+    writer = None
+    with tqdm(desc="Writing {name}".format(name=os.path.basename(path)), total=total, unit=" rows") as progress:
+        with open(path, "wb") as f:
+            for rows, part in parts:
+                if file_format == "parquet":
+                    if writer is None:
+                        writer = pq.ParquetWriter(f, part.schema, compression="zstd")
+                    writer.write_table(part)
+                else:
+                    f.write(part)
+                progress.update(rows)
+            if writer is not None:
+                writer.close()
+
+
+# state of pool workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(descriptions, table):
+    shared_memories = []
+    _worker["shared_memories"] = shared_memories
+    table["arrays"] = {name: attach(description, shared_memories) for name, description in descriptions["arrays"].items()}
+    table["order"] = attach(descriptions["order"], shared_memories)
+    _worker["table"] = table
+
+
+def _sort_chunk_worker(arguments):
+    return _sort_chunk(_worker["table"], *arguments)
+
+
+def _format_window_worker(arguments):
+    return _format_window(_worker["table"], *arguments)
+
+
+def _ordered(pool, function, arguments, pending_size):
+    # results of function over the arguments in order, computing at most pending_size ahead
+    pending = deque()
+    for argument in arguments:
+        pending.append(pool.apply_async(function, (argument,)))
+        if len(pending) >= pending_size:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def export_sorted(df, keys, path, workers=1, chunk_size=CHUNK_SIZE):
+    # writes the rows of df sorted by the key columns to path, returns the number of rows
+    # (columns of numbers or categoricals: strings are shared with workers as category codes)
+    file_format, compression = output_format(path)
+    table = _table(df, keys, file_format, compression)
+
+    rows = len(df)
+    chunk_bounds = np.unique(np.append(np.arange(0, rows, chunk_size), rows))
+    chunks = list(zip(chunk_bounds[:-1], chunk_bounds[1:])) or [(0, 0)]
+    windows = max(len(chunks), workers * CHUNKS_PER_WORKER if workers > 1 else 1)
+    bounds = _window_bounds(table, windows) if rows > 0 else np.array([])
+
+    # write to a temporary file first so that readers never see a partial output
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    if workers <= 1:
+        table["order"] = np.empty(rows, dtype=np.int64)
+        ranges = _window_ranges([_sort_chunk(table, chunk, bounds) for chunk in chunks])
+        parts = (_format_window(table, window_ranges, window == 0) for window, window_ranges in enumerate(ranges))
+        _write_parts(parts, temp_path, file_format, rows)
+    else:
+        shared_memories = []
+        try:
+            descriptions = {"arrays": {name: share(array, shared_memories) for name, array in table["arrays"].items()},
+                            "order": share(np.empty(rows, dtype=np.int64), shared_memories)}
+            worker_table = {name: value for name, value in table.items() if name != "arrays"}
+
+            with Pool(workers, initializer=_init_worker, initargs=(descriptions, worker_table)) as pool:
+                ranges = _window_ranges(pool.map(_sort_chunk_worker, [(chunk, bounds) for chunk in chunks]))
+                parts = _ordered(pool, _format_window_worker,
+                                 [(window_ranges, window == 0) for window, window_ranges in enumerate(ranges)],
+                                 workers * PENDING_PER_WORKER)
+                _write_parts(parts, temp_path, file_format, rows)
+        finally:
+            release(shared_memories)
+
+    os.replace(temp_path, path)
+    return rows
@@ -0,0 +1,55 @@
+# Rendering of the figures of the run scripts, once their numeric outputs are written.
+#
+# A figure is given as (function, arguments, path): the function draws the figure from small pre-aggregated
+# tables (group means, histogram counts, ...) and returns it (a matplotlib figure or a seaborn grid),
+# which is then saved to path. Figures are rendered with the Agg backend, so that no display is needed,
+# and independent figures are rendered by a process pool.
+#
+#     figures = [(plot_distance_distribution, (counts, edges, x_max), "distance_distribution.png")]
+#     render(figures, workers=4)
+#
+# With workers > 1, the functions and their arguments are pickled to the workers: functions must be defined at
+# module level and arguments should be kept small.
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils.instrumentation import stage
+
+
+def histogram(values, bins):
+    # counts and edges of a histogram, as drawn by plt.hist(values, bins)
+    return np.histogram(values, bins)
+
+
+def _use_agg():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _render(figure):
+    import matplotlib.pyplot as plt
+
+    function, arguments, path = figure
+    print("Rendering {path}...".format(path=path))
+    function(*arguments).savefig(path)
+    plt.close("all")
+    return path
+
+
+@stage("plot figures")
+def render(figures, workers=1):
+    figures = list(figures)
+    workers = min(workers, len(figures))
+    if len(figures) > 0:
+        print("Rendering {count} figures...".format(count=len(figures)))
+
+    if workers <= 1:
+        _use_agg()
+        for figure in figures:
+            _render(figure)
+        return
+
+    with Pool(workers, initializer=_use_agg) as pool:
+        pool.map(_render, figures, chunksize=1)
@@ -0,0 +1,91 @@
+# Municipality, canton, agglomeration type and municipality type of the home locations of MATSim agents.
+#
+# Home locations are the origins of trips starting at home (freight agents excluded). The same table is used by
+# the STEM and the Swissmod scripts: it is computed once per scenario and stored as home_locations.parquet,
+# keyed by person_id (agents with several home locations keep the first one).
+#
+# Usage as script:
+#     python -m utils.home_locations --matsim-trips trips.csv --municipality-shp g1g18.shp \
+#         --spatial-structure spatial_structure_2018.xlsx --output home_locations.parquet
+
+import os
+from optparse import OptionParser
+
+import pandas as pd
+
+from utils.instrumentation import stage
+from utils.schema import HOME_LOCATIONS
+from utils.trip_store import load_trips
+
+HOME_COLUMNS = ["person_id", "municipality_id", "canton_id", "agglo_type", "municipality_type"]
+
+
+@stage("impute home locations")
+def impute_home_locations(trips_path, municipality_shp, spatial_structure_path, cache_dir=None):
+    # (the geo stack is not needed by scripts reading home_locations.parquet)
+    from utils.spatial import ZoneIndex, load_municipalities, load_spatial_structure
+
+    # load municipality shapefile
+    print("Loading municipality shapefile...")
+    print(municipality_shp)
+    df_municipalities = load_municipalities(municipality_shp, cache_dir)
+    print(df_municipalities.head(3))
+
+    # load spatial structure data
+    print("Loading canton, agglomeration and municipality type data...")
+    print(spatial_structure_path)
+    df_municipality_types = load_spatial_structure(spatial_structure_path, cache_dir)
+    print(df_municipality_types.head(3))
+
+    # impute canton and municipality of agent's home location
+    print("Selecting MATSim agent's home locations...")
+    df_home_matsim = load_trips(trips_path,
+                                columns=["person_id", "origin_x", "origin_y"],
+                                filters=[("freight", "==", False), ("preceedingPurpose", "==", "home")])
+    df_home_matsim = (df_home_matsim.drop_duplicates()
+        .rename({"origin_x": "x", "origin_y": "y"}, axis=1)[["person_id", "x", "y"]])
+    print(df_home_matsim.head(3))
+
+    print("Imputing canton and municipality of home locations...")
+    municipality_index = ZoneIndex.from_frame(df_municipalities, "municipality_id")
+    df_home_matsim["municipality_id"] = municipality_index.lookup_xy(df_home_matsim["x"].values, df_home_matsim["y"].values)
+    df_home_matsim = df_home_matsim.drop(["x", "y"], axis=1)
+
+    # home locations in municipalities absent from the spatial structure are dropped
+    df_home = pd.merge(df_home_matsim, df_municipality_types, on="municipality_id")
+    df_home = df_home[HOME_COLUMNS]
+    print(df_home.head(3))
+    return df_home
+
+
+def home_locations_table(df_home):
+    # one row per agent, typed (see utils.schema)
+    df_home = df_home.drop_duplicates("person_id").reset_index(drop=True)
+    return df_home.astype(HOME_LOCATIONS.dtypes(HOME_COLUMNS))
+
+
+def write_home_locations(df_home, path):
+    # write to a temporary file first so that readers never see a partial table
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    home_locations_table(df_home).to_parquet(temp_path, index=False)
+    os.replace(temp_path, path)
+
+
+@stage("load home locations")
+def load_home_locations(path):
+    print("Loading home locations from {path}".format(path=path))
+    return pd.read_parquet(path, columns=HOME_COLUMNS)
+
+
+if __name__ == "__main__":
+    option_parser = OptionParser()
+    option_parser.add_option("--matsim-trips", dest="matsim_trips", help="MATSim trips")
+    option_parser.add_option("--municipality-shp", dest="mun_shp", help="Shapefile of Swiss municipalities")
+    option_parser.add_option("--spatial-structure", dest="spatial_structure", help="Swiss spatial structure data")
+    option_parser.add_option("--cache-dir", dest="cache_dir", help="directory for cached municipality and spatial structure data")
+    option_parser.add_option("--output", dest="output", help="output path for the home locations (parquet)")
+    options, args = option_parser.parse_args()
+
+    write_home_locations(impute_home_locations(options.matsim_trips, options.mun_shp, options.spatial_structure,
+                                               options.cache_dir),
+                         options.output)
@@ -0,0 +1,145 @@
+# Lightweight instrumentation of the stages of the analysis scripts (load, filter, impute, aggregate, match,
+# plot, write): wall time, CPU time, peak resident memory (RSS) and number of rows of each stage.
+#
+#     @stage("load BEDDEM agents")
+#     def load_beddem_agents(df_vehicles, trips_path):
+#         ...                               # rows: length of the returned table
+#
+#     with stage("write output") as record:
+#         df.to_csv(path)
+#         record.rows = len(df)
+#
+# Records are kept in memory (see records) and, if the environment variable SCCER_STAGE_REPORT is set
+# (as done by run_pipeline.py for each step), written as JSON to that path when the process exits.
+#
+# On Linux, the peak RSS of the process is reset when a stage starts (see /proc/self/clear_refs), so that each
+# stage gets its own peak; elsewhere, it is the peak of the process so far. CPU time includes the processes
+# waited for during the stage (e.g. worker pools), peak RSS only covers this process.
+
+import atexit
+import contextlib
+import functools
+import json
+import os
+import resource
+import time
+
+REPORT_VARIABLE = "SCCER_STAGE_REPORT"
+
+# records of the finished stages, in the order they finished
+records = []
+
+# records of the running stages, innermost last
+_running = []
+
+
+def cpu_time():
+    # CPU time of this process and of its waited-for children
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    # peak resident memory in bytes since the last reset
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _rows(result):
+    # number of rows of a table (DataFrame, array), None for other results
+    shape = getattr(result, "shape", None)
+    return None if shape is None or len(shape) == 0 else int(shape[0])
+
+
+class StageRecord:
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.rows = None
+        self.start = time.time()
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_rss_bytes = 0
+
+    def as_dict(self):
+        return {"name": self.name, "depth": self.depth, "start": self.start, "wall_s": self.wall_s,
+                "cpu_s": self.cpu_s, "peak_rss_bytes": self.peak_rss_bytes, "rows": self.rows}
+
+
+class stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        # the peak of the enclosing stage so far is kept before resetting it
+        if len(_running) > 0:
+            _running[-1].peak_rss_bytes = max(_running[-1].peak_rss_bytes, peak_rss())
+        _reset_peak_rss()
+
+        self.record = StageRecord(self.name, len(_running))
+        self._start_wall = time.perf_counter()
+        self._start_cpu = cpu_time()
+        _running.append(self.record)
+        return self.record
+
+    def __exit__(self, *exc_info):
+        record = _running.pop()
+        record.wall_s = time.perf_counter() - self._start_wall
+        record.cpu_s = cpu_time() - self._start_cpu
+        record.peak_rss_bytes = max(record.peak_rss_bytes, peak_rss())
+        if len(_running) > 0:
+            _running[-1].peak_rss_bytes = max(_running[-1].peak_rss_bytes, record.peak_rss_bytes)
+        records.append(record)
+
+        print("[stage] {name}: {wall:.2f}s wall, {cpu:.2f}s cpu, {peak:.0f} MB peak{rows}".format(
+            name=record.name, wall=record.wall_s, cpu=record.cpu_s, peak=record.peak_rss_bytes / 2 ** 20,
+            rows="" if record.rows is None else ", {rows} rows".format(rows=record.rows)))
+        return False
+
+    def __call__(self, function):
+        # as a decorator: one stage per call, with the number of rows of the returned table
+        @functools.wraps(function)
+        def staged(*args, **kwargs):
+            with stage(self.name) as record:
+                result = function(*args, **kwargs)
+                record.rows = _rows(result)
+            return result
+        return staged
+
+
+@contextlib.contextmanager
+def recording():
+    # records of the stages finished within the block
+    captured = []
+    start = len(records)
+    try:
+        yield captured
+    finally:
+        captured.extend(records[start:])
+
+
+def write_records(path, stage_records=None):
+    stage_records = records if stage_records is None else stage_records
+    with open(path, "w") as f:
+        json.dump([record.as_dict() for record in stage_records], f, indent=1)
+
+
+if os.environ.get(REPORT_VARIABLE):
+    atexit.register(lambda: write_records(os.environ[REPORT_VARIABLE]))
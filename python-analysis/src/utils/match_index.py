@@ -0,0 +1,71 @@
+# Persisted matching of MATSim to BEDDEM agents, so that the vehicle attributes can be re-joined without matching again.
+#
+# The index holds one row per MATSim agent: person_id, the BEDDEM agent_id and the vehicle type and powertrain
+# of that BEDDEM agent (both from the BEDDEM trips; 0 and empty for unmatched agents, as set by the matching).
+# It is stored as Parquet together with the key of the inputs it was computed from (see utils.cache.fingerprint),
+# and is only returned by load_match_index if that key is unchanged.
+#
+#     df_matches = load_match_index(path, key)    # None if missing or computed from other inputs
+#     if df_matches is None:
+#         ...                                     # match
+#         write_match_index(df_matched, path, key)
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.instrumentation import stage
+
+MATCH_COLUMNS = ["person_id", "agent_id", "vehicle_type", "powertrain"]
+
+KEY_METADATA = b"match_key"
+
+
+def match_index_path_for(output_path):
+    return os.path.splitext(output_path)[0] + ".matches.parquet"
+
+
+def match_index_table(df_matched):
+    # vehicle types and powertrains dictionary-encoded
+    df_matches = df_matched[MATCH_COLUMNS]
+    return df_matches.astype({"person_id": np.int64, "agent_id": np.int64,
+                              "vehicle_type": "category", "powertrain": "category"}).reset_index(drop=True)
+
+
+def write_match_index(df_matched, path, key):
+    print("Writing match index to {path}".format(path=path))
+    table = pa.Table.from_pandas(match_index_table(df_matched), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[KEY_METADATA] = key.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # write to a temporary file first so that readers never see a partial index
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, path)
+
+
+def match_index_key(path):
+    # key of the inputs of a stored index, None if there is none
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    key = metadata.get(KEY_METADATA)
+    return None if key is None else key.decode()
+
+
+@stage("load match index")
+def load_match_index(path, key):
+    stored_key = match_index_key(path)
+    if stored_key != key:
+        print("No match index for these inputs at {path}".format(path=path))
+        return None
+
+    print("Loading match index from {path}".format(path=path))
+    df_matches = pd.read_parquet(path, columns=MATCH_COLUMNS)
+    df_matches["vehicle_type"] = df_matches["vehicle_type"].astype(str)
+    df_matches["powertrain"] = df_matches["powertrain"].astype(str)
+    return df_matches
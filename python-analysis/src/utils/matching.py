@@ -0,0 +1,468 @@
+# Grouped nearest-neighbour matching of agents on one value, e.g. MATSim agents to BEDDEM agents on daily car distance.
+#
+# The candidates are sorted once by group and value, so that the nearest candidate of all agents is found
+# with a single np.searchsorted over the whole table instead of one KD-tree per group.
+# Groups and values are combined in one integer key per candidate: the group code, then the rank of the value
+# among the distinct candidate values (agent values falling between two candidate values get the rank in between).
+#
+#     strata = [(["municipality_type", "canton_id"], ["municipality_type", "canton"]),
+#               (["municipality_type"], ["municipality_type"])]
+#     positions = match_nearest(df_matsim, df_beddem, "network_distance", "distance", strata, max_distance=5.0)
+#     df_matches = df_beddem.iloc[positions]
+#
+# When several candidates are equally near, the first one in the candidate table is chosen.
+#
+# With workers > 1, the agents are split in ranges of groups queried by a process pool. The index and agent arrays
+# are placed in shared memory (see utils.shared_arrays), so that workers attach to them instead of
+# receiving pickled copies, and write their matches into a shared result array: the result does not depend
+# on the number of workers.
+#
+# Agents can also be matched at random (see match_random): a candidate is drawn with probability proportional to its
+# weight among the candidates of the group whose value is within a relative tolerance of the agent value.
+# The candidates within the tolerance are a range of the sorted candidates, found by np.searchsorted,
+# and the draws are made for all agents at once on the cumulative weights of the sorted candidates.
+#
+# Agents can be matched on several values at once (see match_features), e.g. daily distance and number of trips:
+# each value is divided by a scale (by default its standard deviation among the candidates), and the nearest
+# candidate in this scaled space is found by a KD-tree per group. The trees are built over consecutive rows of a
+# single array of scaled candidate values sorted by group, and each group of agents is queried in one batch.
+# In finer strata, only candidates whose first value is within the maximum distance count: the k nearest are queried,
+# with k growing up to a maximum for the agents without such a candidate among them, in batches of bounded size;
+# the agents left are compared to the candidates within the maximum distance, a range of the candidates sorted by
+# first value.
+#
+# Finally, agents can be assigned under capacities (see match_capacity): each candidate is assigned to a number
+# of agents proportional to its weight, scaled to the number of agents of its group. On one value, pairing the agents
+# and the capacity units of a group in order of value minimizes the sum of absolute differences, so that the
+# assignment of all groups is a single np.searchsorted of the sorted agents in the cumulative sorted capacities.
+
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from utils.shared_arrays import attach, release, share
+
+# number of agent ranges per worker, for load balancing
+CHUNKS_PER_WORKER = 4
+
+# growth and maximum of the number of neighbours queried for agents without a candidate within the maximum distance
+# (agents still without one are matched by brute force over the candidates within the maximum distance)
+NEIGHBOURS_GROWTH = 8
+MAX_NEIGHBOURS = 1024
+
+# maximum number of neighbour indices queried at once (agents x neighbours)
+NEIGHBOURS_BUDGET = 1 << 22
+
+
+class NearestIndex:
+    # Nearest candidate within the group of candidates sharing the same keys
+
+    ARRAYS = ["distinct_values", "sort_keys", "values", "order", "run_start", "group_start", "group_end"]
+
+    def __init__(self, groups, arrays):
+        # groups: unique candidate keys (None in workers, which only query by group code)
+        self.groups = groups
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+        # odd ranks for candidate values, even ranks for values in between
+        self.group_width = 2 * len(self.distinct_values) + 1
+        self.size = len(self.sort_keys)
+
+    @classmethod
+    def build(cls, keys, values):
+        keys = pd.MultiIndex.from_frame(keys)
+        values = np.asarray(values, dtype=np.float64)
+
+        groups = keys.unique()
+        distinct_values = np.unique(values)
+        codes = groups.get_indexer(keys).astype(np.int64)
+        ranks = 2 * np.searchsorted(distinct_values, values) + 1
+        sort_keys = codes * (2 * len(distinct_values) + 1) + ranks
+
+        # stable sort: among equal values of a group, candidates keep their order
+        order = np.argsort(sort_keys, kind="stable")
+        sort_keys = sort_keys[order]
+
+        group_width = 2 * len(distinct_values) + 1
+        group_bounds = np.searchsorted(sort_keys, np.arange(len(groups) + 1) * group_width)
+
+        # first position of each run of equal keys
+        positions = np.arange(len(sort_keys))
+        run_start = np.ones(len(sort_keys), dtype=bool)
+        run_start[1:] = sort_keys[1:] != sort_keys[:-1]
+
+        return cls(groups, {"distinct_values": distinct_values,
+                            "sort_keys": sort_keys,
+                            "values": values[order],
+                            "order": order,
+                            "run_start": np.maximum.accumulate(np.where(run_start, positions, 0)),
+                            "group_start": group_bounds[:-1],
+                            "group_end": group_bounds[1:]})
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def group_codes(self, keys):
+        # group of each agent (-1 if no candidate has its keys)
+        return self.groups.get_indexer(pd.MultiIndex.from_frame(keys)).astype(np.int64)
+
+    def _sort_keys(self, codes, values):
+        ranks = np.searchsorted(self.distinct_values, values)
+        exact = np.zeros(len(values), dtype=bool)
+        inside = ranks < len(self.distinct_values)
+        exact[inside] = self.distinct_values[ranks[inside]] == values[inside]
+        return codes * self.group_width + 2 * ranks + exact
+
+    def query(self, keys, values):
+        return self.query_codes(self.group_codes(keys), values)
+
+    def window(self, codes, low, high):
+        # range [start, end) of the sorted candidates of each group (codes >= 0) with values within [low, high]
+        start = np.searchsorted(self.sort_keys, self._sort_keys(codes, low))
+        end = np.searchsorted(self.sort_keys, self._sort_keys(codes, high), side="right")
+        return start, end
+
+    def query_codes(self, codes, values):
+        # position in the candidate table of the nearest candidate of each agent, and its distance
+        # (-1 and inf for agents without candidates in their group)
+        values = np.asarray(values, dtype=np.float64)
+
+        matches = np.full(len(values), -1, dtype=np.int64)
+        distances = np.full(len(values), np.inf)
+
+        found = np.flatnonzero(codes >= 0)
+        codes, values = codes[found], values[found]
+        start, end = self.group_start[codes], self.group_end[codes]
+
+        # first candidate not below the value, and last candidate below it (start of its run)
+        upper = np.searchsorted(self.sort_keys, self._sort_keys(codes, values))
+        lower = upper - 1
+        has_upper = upper < end
+        has_lower = lower >= start
+
+        upper_distances = np.full(len(found), np.inf)
+        upper_distances[has_upper] = np.abs(self.values[upper[has_upper]] - values[has_upper])
+        lower_distances = np.full(len(found), np.inf)
+        lower_distances[has_lower] = np.abs(values[has_lower] - self.values[lower[has_lower]])
+        lower[has_lower] = self.run_start[lower[has_lower]]
+
+        upper_matches = self.order[np.minimum(upper, self.size - 1)]
+        lower_matches = self.order[np.maximum(lower, 0)]
+
+        # on equal distances, the first candidate of the table
+        take_upper = (upper_distances < lower_distances) | ((upper_distances == lower_distances) & (upper_matches < lower_matches))
+        matches[found] = np.where(take_upper, upper_matches, lower_matches)
+        distances[found] = np.minimum(upper_distances, lower_distances)
+        return matches, distances
+
+
+def _match_levels(indexes, codes, values, max_distance):
+    # matches of a finer stratum are kept if within max_distance, the coarsest stratum accepts any match
+    matches = np.full(len(values), -1, dtype=np.int64)
+    unmatched = np.arange(len(values))
+
+    for level, (index, level_codes) in enumerate(zip(indexes, codes)):
+        level_matches, distances = index.query_codes(level_codes[unmatched], values[unmatched])
+
+        accepted = level_matches >= 0
+        if level < len(indexes) - 1:
+            accepted &= distances <= max_distance
+
+        matches[unmatched[accepted]] = level_matches[accepted]
+        unmatched = unmatched[~accepted]
+
+    return matches
+
+
+# state of pool workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(descriptions, max_distance):
+    shared_memories = []
+    _worker["shared_memories"] = shared_memories
+    _worker["indexes"] = [NearestIndex(None, {name: attach(description, shared_memories)
+                                              for name, description in index_descriptions.items()})
+                          for index_descriptions in descriptions["indexes"]]
+    _worker["codes"] = [attach(description, shared_memories) for description in descriptions["codes"]]
+    for name in ["values", "order", "matches"]:
+        _worker[name] = attach(descriptions[name], shared_memories)
+    _worker["max_distance"] = max_distance
+
+
+def _match_range(bounds):
+    # matches agents order[start:end], written into the shared result
+    agents = _worker["order"][bounds[0]:bounds[1]]
+    codes = [level_codes[agents] for level_codes in _worker["codes"]]
+    _worker["matches"][agents] = _match_levels(_worker["indexes"], codes, _worker["values"][agents],
+                                               _worker["max_distance"])
+    return bounds[1] - bounds[0]
+
+
+def _match_parallel(indexes, codes, values, max_distance, workers):
+    from tqdm import tqdm
+
+    # agents sorted by their finest group, so that each range queries a compact part of the indexes
+    order = np.argsort(codes[0], kind="stable")
+    bounds = np.linspace(0, len(order), workers * CHUNKS_PER_WORKER + 1).astype(np.int64)
+    ranges = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    shared_memories = []
+    try:
+        descriptions = {"indexes": [{name: share(array, shared_memories) for name, array in index.arrays().items()}
+                                    for index in indexes],
+                        "codes": [share(level_codes, shared_memories) for level_codes in codes],
+                        "values": share(values, shared_memories),
+                        "order": share(order, shared_memories),
+                        "matches": share(np.full(len(values), -1, dtype=np.int64), shared_memories)}
+        matches_memory = shared_memories[-1]
+
+        with Pool(workers, initializer=_init_worker, initargs=(descriptions, max_distance)) as pool:
+            with tqdm(desc="Matching agents", total=len(values), unit=" agents") as progress:
+                for count in pool.imap_unordered(_match_range, ranges):
+                    progress.update(count)
+
+        return np.frombuffer(matches_memory.buf, dtype=np.int64, count=len(values)).copy()
+    finally:
+        release(shared_memories)
+
+
+def match_nearest(df_agents, df_candidates, value, candidate_value, strata, max_distance, workers=1):
+    # Position in df_candidates of the nearest candidate of each agent (-1 if none).
+    # Strata are tried from the finest to the coarsest, as pairs of agent and candidate key columns:
+    # matches of a finer stratum are kept if within max_distance, the coarsest stratum accepts any match.
+    # Agents whose finer stratum has no candidates are matched in the next one.
+    candidate_values = df_candidates[candidate_value].values
+    indexes = [NearestIndex.build(df_candidates[candidate_keys], candidate_values) for _, candidate_keys in strata]
+    codes = [index.group_codes(df_agents[agent_keys]) for index, (agent_keys, _) in zip(indexes, strata)]
+    values = np.asarray(df_agents[value].values, dtype=np.float64)
+
+    if workers > 1:
+        return _match_parallel(indexes, codes, values, max_distance, workers)
+    return _match_levels(indexes, codes, values, max_distance)
+
+
+def _draw_weighted(index, weights, codes, values, uniforms, tolerance):
+    # candidate drawn by weight within the tolerance of each agent value, the nearest candidate if there is none
+    # cumulative[i]: total weight of the sorted candidates before position i
+    cumulative = np.concatenate([[0.0], np.cumsum(weights[index.order])])
+    start, end = index.window(codes, values * (1.0 - tolerance), values * (1.0 + tolerance))
+    totals = cumulative[end] - cumulative[start]
+
+    drawn = totals > 0
+    matches = np.empty(len(values), dtype=np.int64)
+    matches[~drawn] = index.query_codes(codes[~drawn], values[~drawn])[0]
+
+    # position whose cumulative weight interval contains the target (candidates without weight are never drawn)
+    targets = cumulative[start[drawn]] + uniforms[drawn] * totals[drawn]
+    positions = np.searchsorted(cumulative, targets, side="right") - 1
+    positions = np.clip(positions, start[drawn], end[drawn] - 1)
+    matches[drawn] = index.order[positions]
+    return matches
+
+
+def match_random(df_agents, df_candidates, value, candidate_value, weight, strata, tolerance=0.01, seed=0):
+    # Position in df_candidates of a candidate drawn for each agent (-1 if none), with probability proportional
+    # to its weight among the candidates whose value is within the relative tolerance of the agent value.
+    # Agents are matched in the finest stratum in which their group has candidates, to the nearest candidate
+    # of the group if none is within the tolerance.
+    # Draws use one random number per agent from a generator seeded with seed, so that matches are reproducible.
+    candidate_values = df_candidates[candidate_value].values
+    weights = np.asarray(df_candidates[weight].values, dtype=np.float64)
+    values = np.asarray(df_agents[value].values, dtype=np.float64)
+    uniforms = np.random.default_rng(seed).random(len(values))
+
+    matches = np.full(len(values), -1, dtype=np.int64)
+    unmatched = np.arange(len(values))
+    for agent_keys, candidate_keys in strata:
+        index = NearestIndex.build(df_candidates[candidate_keys], candidate_values)
+        codes = index.group_codes(df_agents[agent_keys].iloc[unmatched])
+
+        found = codes >= 0
+        agents = unmatched[found]
+        matches[agents] = _draw_weighted(index, weights, codes[found], values[agents], uniforms[agents], tolerance)
+        unmatched = unmatched[~found]
+
+    return matches
+
+
+class FeatureIndex:
+    # Nearest candidate in a scaled space of several values, within the group of candidates sharing the same keys
+
+    def __init__(self, keys, features, scales):
+        from sklearn.neighbors import KDTree
+
+        keys = pd.MultiIndex.from_frame(keys)
+        self.groups = keys.unique()
+        self.scales = scales
+        codes = self.groups.get_indexer(keys)
+
+        # candidates sorted by group: each tree uses a slice of the same array, without copy
+        self.order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[self.order], np.arange(len(self.groups) + 1))
+        self.group_start = bounds[:-1]
+        self.group_size = np.diff(bounds)
+        self.first_feature = np.asarray(features[self.order, 0], dtype=np.float64)
+        self.first_order = np.lexsort([self.first_feature, codes[self.order]])
+        self.sorted_first_feature = self.first_feature[self.first_order]
+        self.features = np.ascontiguousarray(features[self.order] / scales, dtype=np.float64)
+        self.trees = [KDTree(self.features[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def group_codes(self, keys):
+        # group of each agent (-1 if no candidate has its keys)
+        return self.groups.get_indexer(pd.MultiIndex.from_frame(keys)).astype(np.int64)
+
+    def _nearest_within(self, group, agent_features, first_feature, max_distance):
+        # nearest candidate of the group among those whose first value differs by at most max_distance (-1 if none):
+        # the k nearest are queried, k growing for agents without such a candidate among them, up to MAX_NEIGHBOURS;
+        # the candidates of the agents left are then compared one by one
+        start = self.group_start[group]
+        size = self.group_size[group]
+        nearest = np.full(len(agent_features), -1, dtype=np.int64)
+
+        # candidates within max_distance of each agent: a range of the sorted first values of the group
+        values = self.sorted_first_feature[start:start + size]
+        lows = np.searchsorted(values, first_feature - max_distance, side="left")
+        highs = np.searchsorted(values, first_feature + max_distance, side="right")
+        pending = np.flatnonzero(highs > lows)
+
+        k = 1
+        max_k = min(size, MAX_NEIGHBOURS)
+        while len(pending) > 0:
+            found = np.zeros(len(pending), dtype=bool)
+            batch_size = max(1, NEIGHBOURS_BUDGET // k)
+            for batch_start in range(0, len(pending), batch_size):
+                batch = pending[batch_start:batch_start + batch_size]
+                neighbours = self.trees[group].query(agent_features[batch], k=k, return_distance=False)
+                within = np.abs(self.first_feature[start + neighbours] - first_feature[batch, None]) <= max_distance
+                batch_found = within.any(axis=1)
+                nearest[batch[batch_found]] = neighbours[batch_found, np.argmax(within[batch_found], axis=1)]
+                found[batch_start:batch_start + len(batch)] = batch_found
+            pending = pending[~found]
+            if k == max_k:
+                break
+            k = min(max_k, k * NEIGHBOURS_GROWTH)
+
+        # (none left if the whole group was queried)
+        if k < size:
+            for agent in pending:
+                candidates = self.first_order[start + lows[agent]:start + highs[agent]]
+                candidates = candidates[np.abs(self.first_feature[candidates] - first_feature[agent]) <= max_distance]
+                if len(candidates) > 0:
+                    distances = np.sum((self.features[candidates] - agent_features[agent]) ** 2, axis=1)
+                    nearest[agent] = candidates[np.argmin(distances)] - start
+        return nearest
+
+    def query_codes(self, codes, features, max_distance=None):
+        # position in the candidate table of the nearest candidate of each agent (-1 for agents without candidates),
+        # among the candidates whose first value differs by at most max_distance if given
+        matches = np.full(len(codes), -1, dtype=np.int64)
+        first_feature = features[:, 0]
+        features = features / self.scales
+
+        # agents sorted by group, each group queried at once
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        groups = np.unique(sorted_codes[sorted_codes >= 0])
+        starts = np.searchsorted(sorted_codes, groups)
+        ends = np.searchsorted(sorted_codes, groups, side="right")
+        for group, start, end in zip(groups, starts, ends):
+            agents = order[start:end]
+            if max_distance is None:
+                nearest = self.trees[group].query(features[agents], k=1, return_distance=False)[:, 0]
+            else:
+                nearest = self._nearest_within(group, features[agents], first_feature[agents], max_distance)
+                agents = agents[nearest >= 0]
+                nearest = nearest[nearest >= 0]
+            matches[agents] = self.order[self.group_start[group] + nearest]
+        return matches
+
+
+def match_features(df_agents, df_candidates, features, strata, max_distance, scales=None):
+    # Position in df_candidates of the nearest candidate of each agent (-1 if none) on several values,
+    # given as pairs of agent and candidate columns, e.g. [("network_distance", "distance"), ...].
+    # Values are divided by the scales, by default their standard deviation among the candidates.
+    # Strata are tried from the finest to the coarsest: in a finer stratum, agents are matched to the nearest candidate
+    # among those whose first value differs by at most max_distance (e.g. daily distance within 5 km), if any;
+    # the coarsest stratum accepts any match.
+    agent_features = df_agents[[agent_column for agent_column, _ in features]].to_numpy(dtype=np.float64)
+    candidate_features = df_candidates[[candidate_column for _, candidate_column in features]].to_numpy(dtype=np.float64)
+    if scales is None:
+        scales = candidate_features.std(axis=0)
+        scales[scales == 0] = 1.0
+
+    matches = np.full(len(df_agents), -1, dtype=np.int64)
+    unmatched = np.arange(len(df_agents))
+    for level, (agent_keys, candidate_keys) in enumerate(strata):
+        index = FeatureIndex(df_candidates[candidate_keys], candidate_features, np.asarray(scales, dtype=np.float64))
+        level_matches = index.query_codes(index.group_codes(df_agents[agent_keys].iloc[unmatched]),
+                                          agent_features[unmatched],
+                                          max_distance if level < len(strata) - 1 else None)
+
+        accepted = level_matches >= 0
+
+        matches[unmatched[accepted]] = level_matches[accepted]
+        unmatched = unmatched[~accepted]
+
+    return matches
+
+
+def _capacities(codes, weights, demand):
+    # integer capacity of each candidate, proportional to its weight and summing to the demand of its group
+    # (largest remainder rounding; candidates of groups without weight share the demand equally)
+    totals = np.bincount(codes, weights, minlength=len(demand))
+    weights = np.where(totals[codes] > 0, weights, 1.0)
+    totals = np.bincount(codes, weights, minlength=len(demand))
+
+    quotas = weights * (demand / totals)[codes]
+    capacities = np.floor(quotas).astype(np.int64)
+    remainders = demand - np.bincount(codes, capacities, minlength=len(demand))
+
+    # one more unit for the largest fractions of each group
+    order = np.lexsort((capacities - quotas, codes))
+    ranks = np.arange(len(order)) - np.searchsorted(codes[order], codes[order])
+    capacities[order[ranks < remainders[codes[order]]]] += 1
+    assert(np.array_equal(np.bincount(codes, capacities, minlength=len(demand)), demand))
+    return capacities
+
+
+def match_capacity(df_agents, df_candidates, value, candidate_value, weight, strata):
+    # Position in df_candidates of the candidate assigned to each agent (-1 if none), such that each candidate is
+    # assigned to a number of agents proportional to its weight, scaled to the number of agents of its group.
+    # Within a group, agents and candidate capacities are paired in order of value, which minimizes the sum of
+    # absolute differences. Agents are matched in the finest stratum in which their group has candidates.
+    # In a coarser stratum, the capacities are computed for all agents of the group, including those matched in finer
+    # strata, and the units these used are deducted: the remaining units are shared by the agents left.
+    candidate_values = np.asarray(df_candidates[candidate_value].values, dtype=np.float64)
+    weights = np.asarray(df_candidates[weight].values, dtype=np.float64)
+    values = np.asarray(df_agents[value].values, dtype=np.float64)
+
+    matches = np.full(len(values), -1, dtype=np.int64)
+    unmatched = np.arange(len(values))
+    for agent_keys, candidate_keys in strata:
+        candidate_groups = pd.MultiIndex.from_frame(df_candidates[candidate_keys])
+        groups = candidate_groups.unique()
+        candidate_codes = groups.get_indexer(candidate_groups)
+        codes = groups.get_indexer(pd.MultiIndex.from_frame(df_agents[agent_keys].iloc[unmatched]))
+
+        found = codes >= 0
+        agents, codes = unmatched[found], codes[found]
+        demand = np.bincount(codes, minlength=len(groups))
+
+        # units used in finer strata (candidates overused there get none; the others share the demand
+        # in proportion to their remaining units)
+        used = np.bincount(matches[matches >= 0], minlength=len(candidate_codes))
+        group_used = np.bincount(candidate_codes, used, minlength=len(groups)).astype(np.int64)
+        capacities = _capacities(candidate_codes, weights, demand + group_used)
+        capacities = _capacities(candidate_codes, np.maximum(capacities - used, 0).astype(np.float64), demand)
+
+        # agents and capacity units in order of group and value: the k-th agent gets the k-th unit
+        candidate_order = np.lexsort((candidate_values, candidate_codes))
+        units_end = np.cumsum(capacities[candidate_order])
+        agent_order = np.lexsort((values[agents], codes))
+        matches[agents[agent_order]] = candidate_order[np.searchsorted(units_end, np.arange(len(agents)), side="right")]
+        unmatched = unmatched[~found]
+
+    return matches
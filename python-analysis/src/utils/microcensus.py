@@ -0,0 +1,62 @@
+# Loaders for the microcensus (MZ) vehicle and household files.
+#
+# Both tables do not depend on the simulation year: with a cache directory, they are read once and stored
+# as Parquet (see utils.cache), so that the runs for all years reuse them.
+
+from utils.cache import cached_frame
+from utils.schema import MZ_HOUSEHOLDS, MZ_VEHICLES, read_csv
+
+VEHICLE_COLUMNS = {"HHNR": "mzPersonId",
+                   "f30900_31700": "year_km",
+                   "f30700_hpnr1": "driver_1",
+                   "f30700_hpnr2": "driver_2",
+                   "f30700_hpnr3": "driver_3",
+                   "f30700_hpnr4": "driver_4",
+                   "f30700_hpnr5": "driver_5"}
+
+HOUSEHOLD_COLUMNS = {"HHNR": "mzPersonId",
+                     "F20601": "income"}
+
+
+def vehicles_path(mz_dir):
+    return "{dir}/fahrzeuge.csv".format(dir=mz_dir)
+
+
+def households_path(mz_dir):
+    return "{dir}/haushalte.csv".format(dir=mz_dir)
+
+
+def _read_vehicle_km(mz_dir):
+    df_mz_vehicles = (read_csv(vehicles_path(mz_dir), MZ_VEHICLES, encoding='latin')
+                      .rename(VEHICLE_COLUMNS, axis=1)
+                      )[list(VEHICLE_COLUMNS.values())]
+    df_mz_vehicles = df_mz_vehicles.replace([-97, -98, -99], 100)
+
+    # annual distance of the first vehicle of each household, ordered by driver
+    return (df_mz_vehicles
+            .sort_values(["driver_1", "driver_2", "driver_3", "driver_4", "driver_5"])
+            .groupby("mzPersonId", as_index=False).first()
+            )[["mzPersonId", "year_km"]]
+
+
+def _read_household_income(mz_dir):
+    return (read_csv(households_path(mz_dir), MZ_HOUSEHOLDS, encoding='latin')[list(HOUSEHOLD_COLUMNS.keys())]
+            .rename(HOUSEHOLD_COLUMNS, axis=1))
+
+
+def load_vehicle_km(mz_dir, cache_dir=None):
+    # annual car distance per household
+    if cache_dir is None:
+        return _read_vehicle_km(mz_dir)
+
+    return cached_frame(cache_dir, "mz_vehicle_km", [vehicles_path(mz_dir)], lambda: _read_vehicle_km(mz_dir),
+                        params=(VEHICLE_COLUMNS, MZ_VEHICLES))
+
+
+def load_household_income(mz_dir, cache_dir=None):
+    # income class per household
+    if cache_dir is None:
+        return _read_household_income(mz_dir)
+
+    return cached_frame(cache_dir, "mz_household_income", [households_path(mz_dir)],
+                        lambda: _read_household_income(mz_dir), params=(HOUSEHOLD_COLUMNS, MZ_HOUSEHOLDS))
@@ -0,0 +1,386 @@
+# Incremental execution of the steps of run_pipeline.py.
+#
+# Each step declares the files it reads (inputs), the code it runs (scripts, jar), its parameters and its outputs.
+# The fingerprint of all of these (see utils.cache.fingerprint) is recorded in a state file after each successful run,
+# and a step is rerun only if its outputs are missing or its fingerprint changed.
+# Dependencies follow from the files: a step depends on the steps producing its inputs, so that rerunning a step
+# invalidates its dependents whenever its outputs change.
+#
+#     pipeline = Pipeline([step_a, step_b], state_path="data/10_interim/pipeline_state.json")
+#     pipeline.run(dry_run=True)
+#
+# File digests are memoized in the state file by size and modification time, so that large unchanged inputs
+# (e.g. output_events.xml.gz) are not hashed again on every run.
+#
+# Independent steps can run concurrently (jobs > 1): a step is started as soon as the steps it depends on are done,
+# as long as the sum of the cores of the running steps (one per step, or its number of worker processes) stays within
+# jobs and the sum of their expected memory (e.g. the JVM heap) within the memory budget.
+# Each step then writes its output to its own log file. If a step fails, no further step is started,
+# running steps are waited for, and the failure is raised once they are done.
+#
+# A step can also be given a function, run in the driver process instead of its command (e.g. the main() of an
+# analysis script), so that steps can share data in memory. The command still defines the parameters of the step.
+#
+# Given a report path, the run is written there as JSON: for each step, its status, wall and CPU time and peak RSS
+# (of the child process, e.g. the JVM, or of the driver for function steps), and the stages recorded within it
+# by utils.instrumentation.
+
+import contextlib
+import json
+import os
+import subprocess as sp
+import time
+import traceback
+
+from utils import instrumentation
+from utils.cache import file_digest, fingerprint
+
+
+MEMORY_UNITS = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+# seconds between checks of running steps
+POLL_INTERVAL = 0.2
+
+
+def parse_memory(memory):
+    # bytes of a memory size in java format, e.g. "10g" or "512m"
+    memory = str(memory).strip().lower()
+    if memory[-1] in MEMORY_UNITS:
+        return int(float(memory[:-1]) * MEMORY_UNITS[memory[-1]])
+    return int(memory)
+
+
+def physical_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class Step:
+
+    def __init__(self, name, command, inputs=(), outputs=(), code=(), params=None, env=None, directories=(), memory=0,
+                 cores=1, function=None):
+        # params default to the command line, so that changing any argument reruns the step
+        # memory, cores: expected peak memory in bytes and number of busy cores, used to schedule concurrent steps
+        # function: run in the driver process instead of the command, if given
+        self.name = name
+        self.command = list(command)
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.outputs = [os.path.abspath(path) for path in outputs]
+        self.code = [os.path.abspath(path) for path in code]
+        self.params = self.command if params is None else params
+        self.env = env
+        self.directories = [os.path.abspath(path) for path in directories]
+        self.memory = memory
+        self.cores = cores
+        self.function = function
+
+    def log_name(self):
+        return self.name.replace(" ", "_") + ".log"
+
+    def start(self, log_path=None, stage_report=None):
+        # starts the step, writing its output to the log file if given (to the console otherwise)
+        # stage_report: path where python child processes write their stages (see utils.instrumentation)
+        for directory in self.directories + [os.path.dirname(path) for path in self.outputs]:
+            os.makedirs(directory, exist_ok=True)
+
+        if self.function is not None:
+            return self._run_function(log_path), None
+
+        env = self.env
+        if stage_report is not None:
+            env = dict(os.environ if env is None else env)
+            env[instrumentation.REPORT_VARIABLE] = stage_report
+
+        if log_path is None:
+            return MeasuredProcess(sp.Popen(self.command, env=env)), None
+
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        log = open(log_path, "w")
+        try:
+            return MeasuredProcess(sp.Popen(self.command, env=env, stdout=log, stderr=sp.STDOUT)), log
+        except OSError:
+            log.close()
+            raise
+
+
+    def _run_function(self, log_path):
+        # runs the function until done, with the interface of a finished process
+        with contextlib.ExitStack() as stack:
+            if log_path is not None:
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                log = stack.enter_context(open(log_path, "w"))
+                stack.enter_context(contextlib.redirect_stdout(log))
+                stack.enter_context(contextlib.redirect_stderr(log))
+            stages = stack.enter_context(instrumentation.recording())
+            try:
+                with instrumentation.stage(self.name) as record:
+                    self.function()
+                returncode = 0
+            except Exception:
+                traceback.print_exc()
+                record, returncode = None, 1
+        # stages are recorded once the recording is closed
+        return FinishedProcess(returncode, record, stages)
+
+
+class MeasuredProcess:
+    # child process reaped with wait4, which gives its resource usage: CPU time and peak RSS (e.g. of the JVM)
+    # the peak RSS is at least the RSS of the driver when the child was forked, so only meaningful for large steps
+
+    def __init__(self, popen):
+        self.popen = popen
+        self.returncode = None
+        self.usage = None
+
+    def _reap(self, options):
+        if self.returncode is None:
+            pid, status, usage = os.wait4(self.popen.pid, options)
+            if pid == 0:
+                return None
+            self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            self.usage = {"cpu_s": usage.ru_utime + usage.ru_stime, "peak_rss_bytes": usage.ru_maxrss * 1024}
+            # the process is reaped: Popen must not wait for it again
+            self.popen.returncode = self.returncode
+        return self.returncode
+
+    def poll(self):
+        return self._reap(os.WNOHANG)
+
+    def wait(self):
+        return self._reap(0)
+
+    def terminate(self):
+        if self.returncode is None:
+            self.popen.terminate()
+
+
+class FinishedProcess:
+    # step run in the driver process, which is done when started
+
+    def __init__(self, returncode, record=None, stages=()):
+        self.returncode = returncode
+        self.usage = None if record is None else {"cpu_s": record.cpu_s, "peak_rss_bytes": record.peak_rss_bytes}
+        self.stages = [stage.as_dict() for stage in stages]
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def terminate(self):
+        pass
+
+
+def _files(path):
+    # files of a path, recursively for directories (without python bytecode), in a stable order
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(directory, name)
+                  for directory, _, names in os.walk(path) if "__pycache__" not in directory
+                  for name in names)
+
+
+class Pipeline:
+
+    def __init__(self, steps, state_path):
+        names = [step.name for step in steps]
+        assert(len(names) == len(set(names)))
+
+        self.steps = steps
+        self.state_path = state_path
+        self.producers = {path: step for step in steps for path in step.outputs}
+        self.state = {"fingerprints": {}, "digests": {}}
+
+        # steps are declared after the steps they depend on
+        for position, step in enumerate(steps):
+            assert(all(names.index(dependency.name) < position for dependency in self.dependencies(step)))
+
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.state = json.load(f)
+
+    def dependencies(self, step):
+        return [self.producers[path] for path in step.inputs if path in self.producers]
+
+    def _digest(self, path):
+        # content digest of a file, memoized by size and modification time
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        memo = self.state["digests"].get(path)
+        if memo is None or memo[:2] != stamp:
+            memo = stamp + [file_digest(path)]
+            self.state["digests"][path] = memo
+        return memo[2]
+
+    def fingerprint(self, step):
+        digests = []
+        for path in step.inputs + step.code:
+            if not os.path.exists(path):
+                digests.append((path, None))
+            else:
+                digests += [(os.path.relpath(file_path, path), self._digest(file_path)) for file_path in _files(path)]
+        return fingerprint([], step.params, digests)
+
+    def reason(self, step, force=False):
+        # why the step has to run, None if it is up to date
+        if force:
+            return "forced"
+        if not all(os.path.exists(path) for path in step.outputs):
+            return "missing outputs"
+
+        # outputs of runs preceding the state file are assumed to be up to date, as the driver did before
+        # (their fingerprint is recorded by run, not here, so that a dry run leaves the state unchanged)
+        fingerprint = self.fingerprint(step)
+        if self.state["fingerprints"].get(step.name, fingerprint) != fingerprint:
+            return "inputs, code or parameters changed"
+        return None
+
+    def _save(self):
+        temp_path = "{path}.{pid}.tmp".format(path=self.state_path, pid=os.getpid())
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temp_path, self.state_path)
+
+    def plan(self, force=False):
+        # (step, reason) of the steps that would run: invalidated steps and all their dependents
+        planned = {}
+        for step in self.steps:
+            reason = self.reason(step, force)
+            if reason is None:
+                upstream = [dependency.name for dependency in self.dependencies(step) if dependency.name in planned]
+                if len(upstream) > 0:
+                    reason = "depends on " + ", ".join(upstream)
+            if reason is not None:
+                planned[step.name] = (step, reason)
+        return list(planned.values())
+
+    def _stage_report(self, step, report_path):
+        # path where the stages of a step run as child process are written
+        if report_path is None or step.function is not None:
+            return None
+        return "{path}.{name}.stages.json".format(path=report_path, name=step.name.replace(" ", "_"))
+
+    def _finish_entry(self, entry, process, status, stage_report):
+        # completes the report entry of a step with its status, resource usage and stages
+        entry["wall_s"] = time.time() - entry["started"]
+        entry["status"] = status
+        entry["exit_code"] = process.returncode
+        if getattr(process, "usage", None) is not None:
+            entry.update(process.usage)
+
+        entry["stages"] = getattr(process, "stages", [])
+        if stage_report is not None and os.path.exists(stage_report):
+            with open(stage_report) as f:
+                entry["stages"] = json.load(f)
+            os.remove(stage_report)
+
+    def _write_report(self, report_path, report):
+        report["wall_s"] = time.time() - report["started"]
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1)
+        print("\nRun report: {path}".format(path=report_path))
+
+    def run(self, force=False, dry_run=False, jobs=1, memory_budget=None, log_dir=None, report_path=None):
+        # Steps start in declaration order, which must follow dependencies, as soon as their dependencies are done.
+        # Fingerprints are checked just before starting a step, so that dependents of a rerun step
+        # whose outputs did not change are skipped.
+        # With jobs > 1, the output of each step goes to {log_dir}/{step name}.log.
+        # With a report path, the run report is written there (json), also if a step fails.
+        if dry_run:
+            for step, reason in self.plan(force):
+                print("would run {name} ({reason})".format(name=step.name, reason=reason))
+            return
+
+        if memory_budget is None:
+            memory_budget = physical_memory()
+        if jobs > 1:
+            assert(log_dir is not None)
+
+        pending = list(self.steps)
+        running = {}
+        done = set()
+        failures = []
+        report = {"started": time.time(), "jobs": jobs, "memory_budget_bytes": memory_budget, "steps": []}
+        entries = {}
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for name, (step, process, log, log_path) in list(running.items()):
+                    return_code = process.poll()
+                    if return_code is None:
+                        continue
+
+                    del running[name]
+                    if log is not None:
+                        log.close()
+                    self._finish_entry(entries[name], process, "done" if return_code == 0 else "failed",
+                                       self._stage_report(step, report_path))
+
+                    if return_code == 0:
+                        print("\n{name}: done".format(name=name))
+                        self.state["fingerprints"][name] = self.fingerprint(step)
+                        self._save()
+                        done.add(name)
+                    else:
+                        print("\n{name}: failed with exit code {code}{log}".format(
+                            name=name, code=return_code, log="" if log_path is None else ", see " + log_path))
+                        failures.append((step, return_code))
+
+                # after a failure, only wait for the running steps
+                if len(failures) > 0:
+                    pending = []
+
+                used_memory = sum(step.memory for step, _, _, _ in running.values())
+                used_cores = sum(step.cores for step, _, _, _ in running.values())
+                for step in list(pending):
+                    if not all(dependency.name in done for dependency in self.dependencies(step)):
+                        continue
+
+                    reason = self.reason(step, force)
+                    if reason is None:
+                        print("\n{name}: up to date".format(name=step.name))
+                        if step.name not in self.state["fingerprints"]:
+                            self.state["fingerprints"][step.name] = self.fingerprint(step)
+                            self._save()
+                        report["steps"].append({"name": step.name, "status": "up to date"})
+                        pending.remove(step)
+                        done.add(step.name)
+                        continue
+
+                    # a step larger than the budgets still runs, alone
+                    over_budget = used_cores + step.cores > jobs or used_memory + step.memory > memory_budget
+                    if len(running) > 0 and over_budget:
+                        continue
+
+                    log_path = None if jobs == 1 else os.path.join(log_dir, step.log_name())
+                    print("\n{name} ({reason})...".format(name=step.name, reason=reason))
+                    entries[step.name] = {"name": step.name, "reason": reason, "status": "running",
+                                          "started": time.time(), "expected_memory_bytes": step.memory,
+                                          "cores": step.cores}
+                    report["steps"].append(entries[step.name])
+                    process, log = step.start(log_path, self._stage_report(step, report_path))
+                    running[step.name] = (step, process, log, log_path)
+                    used_memory += step.memory
+                    used_cores += step.cores
+                    pending.remove(step)
+
+                if len(running) > 0:
+                    time.sleep(POLL_INTERVAL)
+        except BaseException:
+            # e.g. interrupted: do not leave steps running
+            for step, process, log, _ in running.values():
+                process.terminate()
+                process.wait()
+                if log is not None:
+                    log.close()
+                self._finish_entry(entries[step.name], process, "interrupted", self._stage_report(step, report_path))
+            raise
+        finally:
+            if report_path is not None:
+                self._write_report(report_path, report)
+
+        if len(failures) > 0:
+            step, return_code = failures[0]
+            raise sp.CalledProcessError(return_code, step.command)
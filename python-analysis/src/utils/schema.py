@@ -0,0 +1,143 @@
+# Column types of the input tables of the analysis scripts, applied when the files are read.
+#
+# Identifiers are int32, enumerations (sex, vehicle types, powertrains, modes, purposes) categoricals and small codes
+# (canton, municipality and agglomeration types) uint8. Microcensus columns may have blank cells, and are read
+# as nullable integers (Int8, Int32).
+# Identifiers of external registers (statpop, BEDDEM agents) and MATSim person ids in the trip store keep int64.
+# Values compared to thresholds, summed over many rows or written to outputs (trip coordinates, times and distances,
+# per-time-bin plan features, BEDDEM distances and weights) stay float64, so that classes and outputs do not depend
+# on rounding.
+# Columns absent from a schema keep the types inferred by pandas.
+#
+#     features = read_csv(plan_features_path, PLAN_FEATURES, sep="\t")
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+class Schema:
+
+    def __init__(self, columns, prefixes=None):
+        # columns: type per column name
+        # prefixes: type per column name prefix, for columns named after bins (e.g. "driven_s_[0.0;3600.0]")
+        self.columns = columns
+        self.prefixes = {} if prefixes is None else prefixes
+
+    def dtypes(self, names):
+        # types of the given columns
+        dtypes = {}
+        for name in names:
+            if name in self.columns:
+                dtypes[name] = self.columns[name]
+                continue
+            for prefix, dtype in self.prefixes.items():
+                if name.startswith(prefix):
+                    dtypes[name] = dtype
+                    break
+        return dtypes
+
+    def __repr__(self):
+        # part of the cache keys of the tables read with the schema
+        return "Schema({columns!r}, {prefixes!r})".format(columns=self.columns, prefixes=self.prefixes)
+
+
+def read_csv(path, schema, **kwargs):
+    # pandas.read_csv with the types of the schema (the header is read first if columns are typed by prefix)
+    dtypes = dict(schema.columns)
+    if len(schema.prefixes) > 0:
+        header_kwargs = {key: kwargs[key] for key in ["sep", "encoding"] if key in kwargs}
+        dtypes = schema.dtypes(pd.read_csv(path, nrows=0, **header_kwargs).columns)
+    return pd.read_csv(path, dtype=dtypes, **kwargs)
+
+
+# plan features written by PlanFeatureExtractor, one row per agent
+PLAN_FEATURES = Schema({"agentId": np.int32,
+                        "age": np.int16,
+                        "sex": "category",
+                        "mzHeadId": np.int32,
+                        "mzPersonId": np.int32,
+                        "statpopHouseholdId": np.int64,
+                        "statpopPersonId": np.int64,
+                        "longest_stop_s": np.float64,
+                        "longest_stop_9_16_s": np.float64,
+                        "longest_trip_m": np.float64,
+                        "total_stop_s": np.float64,
+                        "total_trip_m": np.float64},
+                       prefixes={"driven_s_": np.float64,
+                                 "distance_m_": np.float64,
+                                 "parked_s_": np.float64})
+
+# household features written by WriteSccerHouseholdFeatures, one row per agent
+HOUSEHOLD_FEATURES = Schema({"agentId": np.int32,
+                             "householdId": np.int64,
+                             "householdSize": np.int16,
+                             "householdIncome": np.float32})
+
+# microcensus vehicles (fahrzeuge.csv): household, annual distance (negative codes: no answer), drivers
+MZ_VEHICLES = Schema({"HHNR": "Int32",
+                      "f30900_31700": "Int32",
+                      "f30700_hpnr1": "Int8",
+                      "f30700_hpnr2": "Int8",
+                      "f30700_hpnr3": "Int8",
+                      "f30700_hpnr4": "Int8",
+                      "f30700_hpnr5": "Int8"})
+
+# microcensus households (haushalte.csv): household and income class
+MZ_HOUSEHOLDS = Schema({"HHNR": "Int32",
+                        "F20601": "Int8"})
+
+# BEDDEM disaggregated vehicle stock, one row per vehicle
+BEDDEM_VEHICLES = Schema({"Type_Of_Vehicle": "category",
+                          "Powertrain": "category",
+                          "Cons": np.float64,
+                          "CO2": np.float64})
+
+# BEDDEM trips (distances and weights stay float64 so that daily sums are not affected by rounding)
+BEDDEM_TRIPS = Schema({"AgentID": np.int64,
+                       "gemeindetype": np.uint8,
+                       "Kanton": np.uint8,
+                       "Vehicle_Category": "category",
+                       "Vehicle_Type": "category",
+                       "Day_Of_The_Week": np.uint8,
+                       "Time_Start": np.float64,
+                       "Mode": "category",
+                       "Distance": np.float64,
+                       "Weight_To_Universe": np.float64})
+
+# spatial structure of the Swiss municipalities, by output column name (see utils.spatial)
+SPATIAL_STRUCTURE = Schema({"municipality_id": np.int32,
+                            "canton_id": np.uint8,
+                            "agglo_type": np.uint8,
+                            "municipality_type": np.uint8})
+
+# home locations of MATSim agents (see utils.home_locations)
+HOME_LOCATIONS = Schema({"person_id": np.int64,
+                         "municipality_id": np.int32,
+                         "canton_id": np.uint8,
+                         "agglo_type": np.uint8,
+                         "municipality_type": np.uint8})
+
+# trips.csv written by RunTripAnalysis: types of the text file, and of the trip store (see utils.trip_store)
+TRIPS_CSV = Schema({"person_id": str, "mode": str, "preceedingPurpose": str, "followingPurpose": str})
+
+STRING_DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+TRIPS = pa.schema([
+    ("person_id", pa.int64()),
+    ("freight", pa.bool_()),
+    ("freight_id", STRING_DICTIONARY),
+    ("person_trip_id", pa.int32()),
+    ("origin_x", pa.float64()),
+    ("origin_y", pa.float64()),
+    ("destination_x", pa.float64()),
+    ("destination_y", pa.float64()),
+    ("start_time", pa.float64()),
+    ("travel_time", pa.float64()),
+    ("network_distance", pa.float64()),
+    ("mode", STRING_DICTIONARY),
+    ("preceedingPurpose", STRING_DICTIONARY),
+    ("followingPurpose", STRING_DICTIONARY),
+    ("returning", pa.bool_()),
+    ("crowfly_distance", pa.float64()),
+])
@@ -0,0 +1,163 @@
+# Declarative segmentation of agents for the STEM/PSI cluster tables.
+#
+# A segmentation is a list of dimensions (each one classifying agents by thresholds on a column,
+# or by a mapping function) and the time-bin column family to average per segment, e.g. "parked_s"
+# (see utils.time_bins).
+# Any number of segmentations are aggregated together in a single pass over the feature matrix:
+# the segment membership of all segmentations is stacked into one sparse indicator matrix,
+# which is multiplied once with the time-bin columns.
+#
+#     range = Dimension("range", "longest_trip_m", labels, thresholds=range_thresholds)
+#     parktime = Segmentation([range, charge_time], "parked_s", "parked_time_s")
+#     parktime_per_group, = aggregate(features, [parktime])
+#
+# Classes already added by Segmentation.assign are not computed again if their segment codes are given:
+#
+#     assigned = parktime.assign(features)
+#     parktime_per_group, = aggregate(assigned, [parktime], [parktime.assigned_codes(assigned)])
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from utils.binning import classify, combine_labels, to_labels
+from utils.time_bins import TIME_COLUMNS, family_bins, time_bins
+
+
+class Dimension:
+    # Classifies agents in len(labels) classes, either by thresholds on a column (see binning.classify)
+    # or by a mapping function from the column values to class numbers.
+
+    def __init__(self, name, column, labels, thresholds=None, mapping=None, side="right", prefix=None):
+        assert((thresholds is None) != (mapping is None))
+        if thresholds is not None:
+            assert(len(labels) == len(thresholds) + 1)
+
+        self.name = name
+        self.column = column
+        self.labels = list(labels)
+        self.thresholds = thresholds
+        self.mapping = mapping
+        self.side = side
+        self.prefix = name + "_" if prefix is None else prefix
+
+    @property
+    def class_column(self):
+        return self.name + "_class"
+
+    @property
+    def label_column(self):
+        return self.name + "_label"
+
+    def classes(self, df):
+        if self.thresholds is not None:
+            return classify(df[self.column].values, self.thresholds, side=self.side)
+        return np.asarray(self.mapping(df[self.column]), dtype=np.uint8)
+
+
+class Segmentation:
+    # Combination of dimensions, with the family of time-bin columns to average per segment
+
+    def __init__(self, dimensions, family, value_name):
+        self.dimensions = dimensions
+        self.family = family
+        self.value_name = value_name
+
+    @property
+    def label_columns(self):
+        return [dimension.label_column for dimension in self.dimensions]
+
+    def segment_codes(self, df):
+        # one code per combination of classes, in the order of the dimensions
+        codes = np.zeros(len(df), dtype=np.int64)
+        for dimension in self.dimensions:
+            codes = codes * len(dimension.labels) + dimension.classes(df)
+        return codes
+
+    def assigned_codes(self, df):
+        # segment codes from the class columns added by assign
+        codes = np.zeros(len(df), dtype=np.int64)
+        for dimension in self.dimensions:
+            codes = codes * len(dimension.labels) + df[dimension.class_column].values
+        return codes
+
+    def segment_count(self):
+        return int(np.prod([len(dimension.labels) for dimension in self.dimensions]))
+
+    def segment_labels(self, codes):
+        # labels of each dimension for the given segment codes
+        labels = {}
+        for dimension in reversed(self.dimensions):
+            codes, classes = np.divmod(codes, len(dimension.labels))
+            labels[dimension.label_column] = to_labels(classes, dimension.labels)
+        return {column: labels[column] for column in self.label_columns}
+
+    def label_order(self, codes):
+        # order of the given segment codes by their labels as text, dimension after dimension
+        # (the order of a groupby over the label columns)
+        ranks = []
+        for dimension in reversed(self.dimensions):
+            codes, classes = np.divmod(codes, len(dimension.labels))
+            label_order = np.argsort(np.array(dimension.labels, dtype=str), kind="stable")
+            label_ranks = np.empty(len(dimension.labels), dtype=np.int64)
+            label_ranks[label_order] = np.arange(len(dimension.labels))
+            ranks.append(label_ranks[classes])
+        return np.lexsort(ranks)
+
+    def assign(self, df):
+        # adds class and label columns of each dimension, and the combined label
+        columns = {}
+        for dimension in self.dimensions:
+            classes = dimension.classes(df)
+            columns[dimension.class_column] = classes
+            columns[dimension.label_column] = to_labels(classes, dimension.labels)
+
+        columns["label"] = combine_labels([dimension.prefix for dimension in self.dimensions],
+                                          [columns[dimension.label_column] for dimension in self.dimensions])
+        return df.assign(**columns)
+
+
+def aggregate(df, segmentations, codes=None):
+    # Average of the time-bin columns per observed segment, for each segmentation, as long tables
+    # with the label columns, the number of agents n, the value and the times of the bin (see time_bins.TIME_COLUMNS).
+    # Segments are ordered by their labels as text, as by a groupby over the label columns.
+    # codes: segment codes of the agents for each segmentation (see Segmentation.assigned_codes), computed if None.
+    bins = time_bins(df.columns)
+    segmentation_bins = [family_bins(bins, segmentation.family) for segmentation in segmentations]
+
+    columns = []
+    for family_table in segmentation_bins:
+        columns += [column for column in family_table["column"] if column not in columns]
+
+    values = df[columns].to_numpy(dtype=np.float64)
+
+    # stack the segment indicators of all segmentations, so that all sums are computed in one product
+    offsets = np.cumsum([0] + [segmentation.segment_count() for segmentation in segmentations])
+    if codes is None:
+        codes = [segmentation.segment_codes(df) for segmentation in segmentations]
+    assert(len(codes) == len(segmentations))
+    codes = np.concatenate([segmentation_codes + offset for segmentation_codes, offset in zip(codes, offsets[:-1])])
+    agents = np.tile(np.arange(len(df)), len(segmentations))
+    indicators = scipy.sparse.csr_matrix((np.ones(len(codes)), (codes, agents)), shape=(offsets[-1], len(df)))
+
+    sums = indicators @ values
+    counts = np.bincount(codes, minlength=offsets[-1])
+
+    results = []
+    for segmentation, family_table, offset, end in zip(segmentations, segmentation_bins, offsets[:-1], offsets[1:]):
+        segment_codes = np.flatnonzero(counts[offset:end])
+        segment_codes = segment_codes[segmentation.label_order(segment_codes)]
+        segment_rows = segment_codes + offset
+        segment_columns = [columns.index(column) for column in family_table["column"]]
+
+        averages = sums[segment_rows][:, segment_columns] / counts[segment_rows][:, np.newaxis]
+
+        # long format: all segments for the first time bin, then all segments for the second one...
+        long_table = pd.DataFrame(segmentation.segment_labels(np.tile(segment_codes, len(segment_columns))))
+        long_table["n"] = np.tile(counts[segment_rows], len(segment_columns))
+        long_table[segmentation.value_name] = averages.T.flatten()
+        for column in TIME_COLUMNS:
+            long_table[column] = np.repeat(family_table[column].values, len(segment_codes))
+        results.append(long_table)
+
+    return results
@@ -0,0 +1,36 @@
+# Numpy arrays in shared memory blocks (see multiprocessing.shared_memory), so that pool workers attach to the arrays
+# of the parent process instead of receiving pickled copies, and can write their results into shared arrays.
+#
+#     shared_memories = []
+#     try:
+#         description = share(values, shared_memories)       # in the parent, passed to the workers
+#         ...                                                # values = attach(description, worker_memories)
+#     finally:
+#         release(shared_memories)
+#
+# Blocks are created by the parent, which releases them once the workers are done.
+
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+def share(array, shared_memories):
+    # copy of the array in a new shared memory block, and its description for workers
+    shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_memories.append(shared_memory)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)[:] = array
+    return shared_memory.name, array.shape, array.dtype.str
+
+
+def attach(description, shared_memories):
+    name, shape, dtype = description
+    shared_memory = SharedMemory(name=name)
+    shared_memories.append(shared_memory)
+    return np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+
+
+def release(shared_memories):
+    for shared_memory in shared_memories:
+        shared_memory.close()
+        shared_memory.unlink()
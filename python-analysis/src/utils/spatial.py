@@ -0,0 +1,169 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from utils.cache import cached_frame
+from utils.schema import SPATIAL_STRUCTURE
+
+# geopandas and sklearn are imported where they are used (reading municipalities, fixing points by distance)
+
+SPATIAL_STRUCTURE_COLUMNS = {0: "municipality_id", 2: "canton_id", 17: "agglo_type", 21: "municipality_type"}
+
+
+def _read_municipalities(path):
+    import geopandas as gpd
+
+    df_municipalities = gpd.read_file(path, encoding="latin1").to_crs("EPSG:2056")
+    return df_municipalities[["GMDNR", "geometry"]].rename({"GMDNR": "municipality_id"}, axis=1)
+
+
+def _read_spatial_structure(path):
+    return pd.read_excel(path,
+                         names=list(SPATIAL_STRUCTURE_COLUMNS.values()),
+                         usecols=list(SPATIAL_STRUCTURE_COLUMNS.keys()),
+                         dtype=SPATIAL_STRUCTURE.columns,
+                         skiprows=6,
+                         nrows=2229,
+                         )
+
+
+def load_municipalities(path, cache_dir=None):
+    # municipality polygons in EPSG:2056, cached as GeoParquet (WKB geometries) if a cache directory is given
+    if cache_dir is None:
+        return _read_municipalities(path)
+
+    import geopandas as gpd
+
+    # a shapefile is spread over several files (.shp, .dbf, .prj, ...) which all need to be tracked
+    sources = glob.glob(os.path.splitext(path)[0] + ".*")
+    return cached_frame(cache_dir, "municipalities", sources, lambda: _read_municipalities(path),
+                        reader=gpd.read_parquet)
+
+
+def load_spatial_structure(path, cache_dir=None):
+    # canton, agglomeration type and municipality type per municipality
+    if cache_dir is None:
+        return _read_spatial_structure(path)
+
+    return cached_frame(cache_dir, "spatial_structure", [path], lambda: _read_spatial_structure(path),
+                        params=(SPATIAL_STRUCTURE_COLUMNS, SPATIAL_STRUCTURE))
+
+
+class ZoneIndex:
+    # Point-in-zone lookup over a fixed set of zones (e.g. municipalities).
+    #
+    # The zone polygons are prepared and bulk-loaded into a packed STRtree once,
+    # so that any number of points can then be assigned to zones in a single vectorized query.
+    # Points falling outside of all zones are assigned to the zone with the nearest centroid
+    # (the KD-tree over the centroids is only built once such a point occurs).
+    #
+    # Points can either be given as shapely geometries (locate, lookup) or directly as coordinate
+    # arrays (locate_xy, lookup_xy), which avoids creating one geometry object per point.
+
+    def __init__(self, zone_ids, geometries):
+        self.zone_ids = np.asarray(zone_ids)
+        self.geometries = np.asarray(geometries)
+        assert(len(self.zone_ids) == len(self.geometries))
+
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self.bounds = shapely.bounds(self.geometries)
+        self.centroid_tree = None
+
+    @classmethod
+    def from_frame(cls, df_zones, zone_id_field):
+        assert(zone_id_field in df_zones.columns)
+        return cls(df_zones[zone_id_field].values, df_zones["geometry"].values)
+
+    def locate(self, points, fix_by_distance=True):
+        # returns, for each point, the position of its zone in the index (-1 if none found)
+        points = np.asarray(points)
+        zone_index = np.full(len(points), -1, dtype=np.int64)
+
+        point_index, tree_index = self.tree.query(points, predicate="within")
+
+        # points on a shared border may lie in several zones: keep the first zone, as a spatial join would
+        order = np.lexsort((tree_index, point_index))
+        point_index, tree_index = point_index[order], tree_index[order]
+        first = np.ones(len(point_index), dtype=bool)
+        first[1:] = point_index[1:] != point_index[:-1]
+        zone_index[point_index[first]] = tree_index[first]
+
+        if fix_by_distance:
+            self._fix_by_distance(zone_index, lambda mask: shapely.get_coordinates(points[mask]))
+
+        return zone_index
+
+    def locate_xy(self, x, y, fix_by_distance=True):
+        # same as locate, for points given as coordinate arrays
+        #
+        # The loop runs over the zones, not the points: each iteration is one vectorized contains_xy over the
+        # points in the bounding box of the zone. At 10M points this is 4-7 times faster than building
+        # shapely.points and querying the tree as locate does (see benchmark.point_lookup), and it never holds
+        # one geometry object per point.
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        assert(len(x) == len(y))
+
+        # sort points along x once, so that the points within the x extent of a zone form a contiguous slice
+        order = np.argsort(x, kind="stable")
+        x_sorted = x[order]
+        y_sorted = y[order]
+        zone_sorted = np.full(len(x), -1, dtype=np.int64)
+
+        starts = np.searchsorted(x_sorted, self.bounds[:, 0], side="left")
+        ends = np.searchsorted(x_sorted, self.bounds[:, 2], side="right")
+
+        # zones are visited in index order and never overwrite a previous match,
+        # so that points on a shared border get the first zone, as in locate
+        for zone in np.flatnonzero(ends > starts):
+            start, end = starts[zone], ends[zone]
+
+            y_slice = y_sorted[start:end]
+            candidates = np.flatnonzero((y_slice >= self.bounds[zone, 1]) & (y_slice <= self.bounds[zone, 3])) + start
+            candidates = candidates[zone_sorted[candidates] < 0]
+
+            inside = shapely.contains_xy(self.geometries[zone], x_sorted[candidates], y_sorted[candidates])
+            zone_sorted[candidates[inside]] = zone
+
+        zone_index = np.empty(len(x), dtype=np.int64)
+        zone_index[order] = zone_sorted
+
+        if fix_by_distance:
+            self._fix_by_distance(zone_index, lambda mask: np.column_stack([x[mask], y[mask]]))
+
+        return zone_index
+
+    def lookup(self, points, fix_by_distance=True):
+        # returns, for each point, the id of its zone (NaN if none found and not fixed by distance)
+        print("Imputing %d zones into %d points by spatial join..." % (len(self.zone_ids), len(points)))
+        return self._zone_ids(self.locate(points, fix_by_distance))
+
+    def lookup_xy(self, x, y, fix_by_distance=True):
+        # same as lookup, for points given as coordinate arrays
+        print("Imputing %d zones into %d points by spatial join..." % (len(self.zone_ids), len(x)))
+        return self._zone_ids(self.locate_xy(x, y, fix_by_distance))
+
+    def _fix_by_distance(self, zone_index, get_coordinates):
+        invalid_mask = zone_index < 0
+
+        if np.any(invalid_mask):
+            print("  Fixing %d points by centroid distance join..." % np.count_nonzero(invalid_mask))
+            coordinates = get_coordinates(invalid_mask)
+
+            if self.centroid_tree is None:
+                from sklearn.neighbors import KDTree
+                self.centroid_tree = KDTree(shapely.get_coordinates(shapely.centroid(self.geometries)))
+
+            zone_index[invalid_mask] = self.centroid_tree.query(coordinates, return_distance=False).flatten()
+
+    def _zone_ids(self, zone_index):
+        if np.all(zone_index >= 0):
+            return self.zone_ids[zone_index]
+
+        zone_ids = self.zone_ids[np.maximum(zone_index, 0)].astype(float)
+        zone_ids[zone_index < 0] = np.nan
+        return zone_ids
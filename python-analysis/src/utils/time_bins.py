@@ -0,0 +1,45 @@
+# Schema of the time-bin features written by WriteSccerPlanFeatures, e.g. driven_s_[0.0;3600.0].
+#
+# Column names are parsed once into a bin table (one row per column, with the feature family,
+# the bin number within the family, start, end and middle of the interval and the hour of day),
+# so that consumers can select bins by time window or attach bin times to tables without string parsing.
+#
+#     bins = time_bins(features.columns)
+#     morning_columns = select(bins, "driven_s", 6 * 3600, 9 * 3600)
+
+import re
+
+import numpy as np
+import pandas as pd
+
+TIME_BIN_PATTERN = re.compile(r"^(?P<family>.+)_\[(?P<start>[^;\]]+);(?P<end>[^;\]]+)\]$")
+
+# bin times attached to aggregated tables, in this order
+TIME_COLUMNS = ["interval_start_s", "interval_end_s", "time_of_day_s", "time_of_day_h"]
+
+
+def time_bins(columns):
+    # bin table of all time-bin columns among the given columns (other columns are ignored), in column order
+    records = []
+    for column in columns:
+        match = TIME_BIN_PATTERN.match(column)
+        if match is not None:
+            records.append((column, match.group("family"), float(match.group("start")), float(match.group("end"))))
+
+    bins = pd.DataFrame.from_records(records, columns=["column", "family", "interval_start_s", "interval_end_s"])
+    bins["bin"] = bins.groupby("family").cumcount()
+    bins["time_of_day_s"] = (bins["interval_start_s"] + bins["interval_end_s"]) / 2.0
+    bins["time_of_day_h"] = bins["time_of_day_s"] / 3600.0
+    bins["hour"] = np.floor(bins["interval_start_s"] / 3600.0).astype(int)
+    return bins[["column", "family", "bin"] + TIME_COLUMNS + ["hour"]]
+
+
+def family_bins(bins, family):
+    return bins[bins["family"] == family].reset_index(drop=True)
+
+
+def select(bins, family, start_s=0.0, end_s=np.inf):
+    # columns of the family whose interval overlaps [start_s, end_s)
+    bins = family_bins(bins, family)
+    overlapping = (bins["interval_start_s"] < end_s) & (bins["interval_end_s"] > start_s)
+    return list(bins.loc[overlapping, "column"])
@@ -0,0 +1,143 @@
+# Columnar store for the trips.csv written by RunTripAnalysis.
+#
+# The semicolon-separated text file is converted once into a Parquet dataset partitioned by mode,
+# with typed columns (see utils.schema): int64 person ids, dictionary-encoded modes and purposes and a precomputed
+# freight flag.
+# Downstream scripts then only read the columns and rows they need, e.g.
+#
+#     load_trips(path, columns=["person_id", "network_distance"], filters=[("mode", "==", "car")])
+#
+# Freight agents do not have numeric ids: they get negative person ids and keep their original id in freight_id.
+#
+# Usage as script (converts trips.csv to trips.parquet next to it):
+#     python -m utils.trip_store path/to/trips.csv
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from utils.instrumentation import stage
+from utils.schema import TRIPS, TRIPS_CSV
+
+CSV_SEPARATOR = ";"
+CHUNK_SIZE = 2000000
+PARTITION_COLUMN = "mode"
+
+SOURCE_FILE = "_source.json"
+
+
+def store_path_for(csv_path):
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def _source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {"path": os.path.abspath(csv_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_up_to_date(csv_path, store_path):
+    stamp_path = os.path.join(store_path, SOURCE_FILE)
+    if not os.path.exists(stamp_path):
+        return False
+
+    with open(stamp_path) as f:
+        return json.load(f) == _source_stamp(csv_path)
+
+
+def _string_array(values):
+    # pandas may hold strings as a chunked Arrow array, record batches need a single array
+    array = pa.array(values, type=pa.string())
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    return array
+
+
+def _to_record_batch(df_chunk, freight_ids):
+    # returns the record batch of the chunk and the freight ids seen so far (including those of the chunk)
+    freight = df_chunk["person_id"].str.contains("freight").values
+
+    person_ids = np.zeros(len(df_chunk), dtype=np.int64)
+    person_ids[~freight] = df_chunk["person_id"].values[~freight].astype(np.int64)
+
+    # negative ids for freight agents, consistent over all chunks: -(position in freight_ids + 1), where ids are
+    # appended in order of first occurrence
+    codes, uniques = pd.factorize(df_chunk["person_id"].values[freight])
+    positions = freight_ids.get_indexer(uniques)
+    unseen = positions < 0
+    positions[unseen] = len(freight_ids) + np.arange(np.count_nonzero(unseen))
+    freight_ids = freight_ids.append(pd.Index(uniques[unseen], dtype=object))
+    person_ids[freight] = -(positions[codes] + 1)
+
+    columns = {name: df_chunk[name].values for name in TRIPS.names if name in df_chunk.columns}
+    columns["person_id"] = person_ids
+    columns["freight"] = freight
+    columns["freight_id"] = np.where(freight, df_chunk["person_id"].values, None)
+
+    arrays = []
+    for field in TRIPS:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(_string_array(columns[field.name]).dictionary_encode())
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=TRIPS), freight_ids
+
+
+def _record_batches(chunks):
+    freight_ids = pd.Index([], dtype=object)
+    for df_chunk in chunks:
+        batch, freight_ids = _to_record_batch(df_chunk, freight_ids)
+        yield batch
+
+
+@stage("convert trips")
+def convert_trips(csv_path, store_path=None, chunk_size=CHUNK_SIZE):
+    # converts trips.csv chunk by chunk, so that memory stays bounded by the chunk size
+    if store_path is None:
+        store_path = store_path_for(csv_path)
+
+    print("Converting {csv} to {store}...".format(csv=csv_path, store=store_path))
+    batches = _record_batches(pd.read_csv(csv_path, sep=CSV_SEPARATOR, dtype=TRIPS_CSV.columns, chunksize=chunk_size))
+
+    # write next to the final location and swap, so that readers never see a partial store
+    temp_path = "{path}.{pid}.tmp".format(path=store_path, pid=os.getpid())
+    ds.write_dataset(batches, temp_path, schema=TRIPS, format="parquet",
+                     partitioning=[PARTITION_COLUMN], partitioning_flavor="hive",
+                     existing_data_behavior="delete_matching")
+
+    with open(os.path.join(temp_path, SOURCE_FILE), "w") as f:
+        json.dump(_source_stamp(csv_path), f)
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(temp_path, store_path)
+
+    return store_path
+
+
+def open_trips(csv_path, store_path=None):
+    # returns the path to the trip store for a trips.csv, converting it first if missing or outdated
+    if store_path is None:
+        store_path = store_path_for(csv_path)
+
+    if not is_up_to_date(csv_path, store_path):
+        convert_trips(csv_path, store_path)
+
+    return store_path
+
+
+def load_trips(csv_path, columns=None, filters=None):
+    # reads only the given columns of the trips matching the filters (see pandas.read_parquet)
+    store_path = open_trips(csv_path)
+    return pd.read_parquet(store_path, engine="pyarrow", columns=columns, filters=filters)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        open_trips(path)
@@ -0,0 +1,10 @@
+# Tests of the python-analysis modules, run from the repository root:
+#
+#     python -m pytest -q python-analysis/tests
+#
+# The modules are imported from python-analysis/src, as by the analysis scripts (see run_pipeline.py).
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,58 @@
+# The exported CSV text must be the text of DataFrame.to_csv of the sorted table: floats formatted by Arrow are
+# compared to pandas on values at the edges of the fixed notation range, and on random values of all magnitudes.
+
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.export import export_sorted
+
+EDGE_VALUES = [0.0, -0.0, 1.0, -1.5, 0.1, 0.1 + 0.2, 1 / 3, 1e-5, 9.999e-5, 1e-4, 1.0001e-4, 123.456,
+               1e15, 1e15 + 0.5, 2.0 ** 53, 2.0 ** 53 + 2, 9999999999999998.0, 1e16, 1.5e16, 1e17, 123456789012345.67,
+               5e-324, 2.2250738585072014e-308, 1.7976931348623157e308, np.inf, -np.inf, np.nan, -1e-5, -1e16]
+
+
+def reference_csv(df, keys):
+    return df.sort_values(keys, kind="stable").to_csv(index=False)
+
+
+def assert_same_text(text, expected):
+    # first differing line, instead of a diff of the whole text
+    lines, expected_lines = text.splitlines(), expected.splitlines()
+    for number, (line, expected_line) in enumerate(zip(lines, expected_lines)):
+        assert line == expected_line, "line {number}".format(number=number)
+    assert len(lines) == len(expected_lines) and text == expected
+
+
+def random_values(rng, count):
+    # doubles of all magnitudes and signs, some integral
+    values = rng.standard_normal(count) * 10.0 ** rng.integers(-12, 20, count)
+    values[::7] = np.round(values[::7])
+    return values
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_float_text_matches_pandas(tmp_path, workers):
+    rng = np.random.default_rng(0)
+    count = 5000
+    values = np.concatenate([EDGE_VALUES, random_values(rng, count - len(EDGE_VALUES))])
+    df = pd.DataFrame({"startTime": rng.integers(0, 100, count).astype(np.float64),
+                       "endTime": rng.permutation(values),
+                       "value": values,
+                       "number": rng.integers(-10 ** 12, 10 ** 12, count),
+                       "mode": pd.Categorical.from_codes(rng.integers(0, 2, count), ["car", "car_passenger"])})
+
+    path = tmp_path / "trips.csv"
+    assert export_sorted(df, ["startTime", "endTime"], str(path), workers, chunk_size=700) == count
+    assert_same_text(path.read_text(), reference_csv(df, ["startTime", "endTime"]))
+
+
+def test_compressed_and_fallback_text(tmp_path):
+    # strings needing quotes are written by pandas
+    df = pd.DataFrame({"startTime": [1.0, 0.5, np.nan, 0.5], "endTime": [2.0, 1.0, 0.0, -0.0],
+                       "label": ["x,y", 'a "b"', "z", ""]})
+    path = tmp_path / "trips.csv.gz"
+    export_sorted(df, ["startTime", "endTime"], str(path))
+    assert_same_text(gzip.decompress(path.read_bytes()).decode(), reference_csv(df, ["startTime", "endTime"]))
@@ -0,0 +1,107 @@
+# Script 03 and the point-in-zone lookup on a small synthetic sample (see benchmark.synthetic), against plain
+# reference implementations: matching by brute force, output sorted by pandas, zones by a geopandas spatial join.
+
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmark.suite import YEAR, Inputs, script_module
+from benchmark.synthetic import EXTENT, MUNICIPALITY_SIZE, generate
+
+SCALE = 0.0002
+
+
+@pytest.fixture(scope="module")
+def inputs(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("synthetic")
+    generate(str(data_dir), SCALE, YEAR)
+    return Inputs(str(data_dir), str(tmp_path_factory.mktemp("work")))
+
+
+@pytest.fixture(scope="module")
+def script():
+    return script_module("03_merge_beddem_to_matsim_agents_for_swissmod")
+
+
+def nearest_reference(df_agents, df_candidates, strata, max_distance):
+    # agent_id of the BEDDEM agent matched to each MATSim agent: nearest daily distance in the finest stratum in
+    # which it is within max_distance (any distance in the coarsest), the first candidate of the table on ties
+    agent_ids = []
+    for _, agent in df_agents.iterrows():
+        agent_id = 0
+        for level, (agent_keys, candidate_keys) in enumerate(strata):
+            same_keys = np.all([df_candidates[candidate_key].values == agent[agent_key]
+                                for agent_key, candidate_key in zip(agent_keys, candidate_keys)], axis=0)
+            candidates = np.flatnonzero(same_keys)
+            if len(candidates) == 0:
+                continue
+            differences = np.abs(df_candidates["distance"].values[candidates] - agent["network_distance"])
+            nearest = np.argmin(differences)
+            if level < len(strata) - 1 and differences[nearest] > max_distance:
+                continue
+            agent_id = df_candidates["agent_id"].values[candidates[nearest]]
+            break
+        agent_ids.append(agent_id)
+    return np.array(agent_ids)
+
+
+def test_nearest_matching_and_export(inputs, script, tmp_path):
+    output_path = tmp_path / "01-trips.csv"
+    script.main(["--beddem-vehicles", inputs.path("01-disaggregatedvehiclestock.{year}.csv".format(year=YEAR)),
+                 "--beddem-trips", inputs.path("03-trips.{year}.csv".format(year=YEAR)),
+                 "--beddem-chunk-size", "5000",
+                 "--matsim-trips", inputs.trips_path(),
+                 "--municipality-shp", inputs.path("shp/g1g18.shp"),
+                 "--spatial-structure", inputs.path("spatial_structure_2018.xlsx"),
+                 "--cache-dir", str(tmp_path),
+                 "--matching", "nearest",
+                 "--no-figures",
+                 "--export-chunk-size", "997",
+                 "--output", str(output_path)])
+
+    # matches of the script, as persisted in the match index
+    df_agents_matsim = inputs.matsim_agents()
+    df_agents_beddem = inputs.beddem_agents()
+    df_matches = pd.read_parquet(script.match_index_path_for(str(output_path)))
+    expected_agent_ids = nearest_reference(df_agents_matsim, df_agents_beddem, script.MATCHING_STRATA, 5.0)
+    agent_ids = df_matches.set_index("person_id")["agent_id"].reindex(df_agents_matsim["person_id"]).values
+    assert np.array_equal(agent_ids, expected_agent_ids)
+
+    # output: trips of the matched agents sorted by pandas, whatever the chunks and the number of workers
+    df_matched = script.match_agents(df_agents_matsim.copy(), df_agents_beddem)
+    df_trips = script.swissmod_trips(script.load_matsim_car_trips(inputs.trips_path()), df_matched)
+    expected = df_trips.sort_values(script.SWISSMOD_ORDER, kind="stable").to_csv(index=False)
+    assert output_path.read_text() == expected
+
+    from utils.export import export_sorted
+    export_sorted(df_trips, script.SWISSMOD_ORDER, str(tmp_path / "trips.csv.gz"), workers=2, chunk_size=1000)
+    assert gzip.decompress((tmp_path / "trips.csv.gz").read_bytes()).decode() == expected
+    export_sorted(df_trips, script.SWISSMOD_ORDER, str(tmp_path / "trips.parquet"), workers=2, chunk_size=1000)
+    assert pd.read_parquet(tmp_path / "trips.parquet").to_csv(index=False) == expected
+
+
+def test_zone_index_matches_spatial_join(inputs):
+    import geopandas as gpd
+
+    from utils.spatial import ZoneIndex, load_municipalities
+
+    df_municipalities = load_municipalities(inputs.path("shp/g1g18.shp")).reset_index(drop=True)
+    index = ZoneIndex.from_frame(df_municipalities, "municipality_id")
+
+    # trip origins, corners of the municipality grid (on the borders of four zones) and points outside of all zones
+    df_trips = pd.read_csv(inputs.path("trips.csv"), sep=";", usecols=["origin_x", "origin_y"])
+    corners = np.meshgrid(np.arange(EXTENT[0], EXTENT[2], MUNICIPALITY_SIZE)[:20],
+                          np.arange(EXTENT[1], EXTENT[3], MUNICIPALITY_SIZE)[:5])
+    x = np.concatenate([df_trips["origin_x"].values, corners[0].ravel(), [EXTENT[0] - 5000.0, EXTENT[2] + 20000.0]])
+    y = np.concatenate([df_trips["origin_y"].values, corners[1].ravel(), [EXTENT[1] - 5000.0, EXTENT[3] + 20000.0]])
+    df_points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=df_municipalities.crs)
+
+    # first zone of each point, as kept by ZoneIndex on shared borders
+    df_joined = gpd.sjoin(df_points, df_municipalities[["geometry"]], how="left", predicate="within")
+    expected = df_joined.groupby(level=0)["index_right"].min().reindex(df_points.index).fillna(-1).astype(np.int64).values
+
+    assert np.array_equal(index.locate(df_points.geometry.values, fix_by_distance=False), expected)
+    assert np.array_equal(index.locate_xy(x, y, fix_by_distance=False), expected)
+    assert np.all(index.locate_xy(x, y) >= 0)
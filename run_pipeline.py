@@ -1,5 +1,8 @@
+import glob
+import importlib.util
 import os
-import subprocess as sp
+import sys
+import time
 from optparse import OptionParser
 
 # get script directory
@@ -16,13 +19,26 @@ option_parser.add_option("-t", "--temp-data-path", default="{path}/data/10_inter
 option_parser.add_option("-o", "--output-data-path", default="{path}/data/20_final".format(path=script_dir), dest="output_data_path", help="final output path")
 
 # external paths
-option_parser.add_option("-s", "--scenario-path", dest="scenario_path", help="scenario path")
+option_parser.add_option("-s", "--scenario-path", dest="scenario_path", help="scenario path, with {year} replaced by the simulation year (ex. scenarios/{year})")
 option_parser.add_option("-b", "--beddem-path", dest="beddem_path", help="beddem data path")
 
 # other
 option_parser.add_option("-y", "--year", dest="year", help="simulation year")
-option_parser.add_option("-u", "--update", default=False, action="store_true", dest="update", help="flag to update outputs")
+option_parser.add_option("--years", dest="years", help="comma-separated simulation years processed in one run (ex. 2018,2030,2050)")
+option_parser.add_option("-u", "--update", default=False, action="store_true", dest="update", help="flag to rerun all steps, even if up to date")
+option_parser.add_option("-n", "--dry-run", default=False, action="store_true", dest="dry_run", help="only list the steps that would run")
 option_parser.add_option("-m", "--memory", default='10g', dest="mem", help="java memory (ex. 40g), default = 10g")
+option_parser.add_option("--jobs", type="int", dest="jobs", help="number of cores used by independent steps run concurrently (a step uses one core, the Swissmod step --workers cores), default = 1 for one year, number of cores for several years")
+option_parser.add_option("--workers", type="int", dest="workers", help="number of processes of the Swissmod step (matching, export and figures), default = number of cores divided by --jobs")
+option_parser.add_option("--memory-budget", dest="memory_budget", help="total memory of concurrent steps (ex. 60g), default = physical memory")
+option_parser.add_option("--in-process", default=False, action="store_true", dest="in_process", help="run the python steps in this process, sharing data in memory (one python step at a time)")
+option_parser.add_option("--matching", default="nearest", dest="matching", help="matching of MATSim to BEDDEM agents: nearest, random, features or capacity, default = nearest")
+option_parser.add_option("--matching-features", default="distance,number_trips", dest="matching_features", help="comma-separated features of the features matching (ex. distance,number_trips,start_time_mean), default = distance,number_trips")
+option_parser.add_option("--swissmod-format", type="choice", choices=["csv", "csv.gz", "csv.zst", "parquet"], default="csv", dest="swissmod_format", help="format of the Swissmod trips: csv, csv.gz, csv.zst or parquet, default = csv")
+option_parser.add_option("--no-figures", default=False, action="store_true", dest="no_figures", help="flag to only write the csv outputs of the python steps, without figures")
+option_parser.add_option("--python-memory", default='8g', dest="python_mem", help="expected peak memory of python steps (ex. 16g), default = 8g")
+option_parser.add_option("--worker-memory", default='1g', dest="worker_mem", help="expected additional memory per worker process of the Swissmod step (ex. 2g), default = 1g")
+option_parser.add_option("--report", dest="report", help="output path of the run report (json) with the time and memory of each step and stage, default = {temp}/reports/run_{date}.json")
 
 # parse options
 (options, args) = option_parser.parse_args()
@@ -42,88 +58,267 @@ output_path = options.output_data_path
 scenario_path = options.scenario_path
 beddem_path = options.beddem_path
 
-year = options.year
+# years to process
+years = [options.year] if options.years is None else options.years.split(",")
+if None in years:
+    option_parser.error("a simulation year is required: use --year or --years")
+if scenario_path is None:
+    option_parser.error("a scenario path is required: use --scenario-path")
+if len(years) > 1 and "{year}" not in scenario_path:
+    option_parser.error("--scenario-path must contain {year} to process several years")
+jobs = options.jobs
+if jobs is None:
+    jobs = 1 if len(years) == 1 else os.cpu_count()
+workers = options.workers
+if workers is None:
+    workers = max(1, os.cpu_count() // jobs)
+
 update = options.update
 mem = options.mem
 
+python_src_dir = os.path.dirname(os.path.abspath(python_path))
+sys.path.insert(0, python_src_dir)
+from utils.pipeline import Pipeline, Step, parse_memory
 
-# run features extraction
-if update or not os.path.exists("{path}/{year}/plan_features.csv".format(path=temp_path, year=year)):
-    print("\nfeature extraction...")
+# expected memory of the steps, to schedule concurrent steps
+java_memory = parse_memory(mem)
+python_memory = parse_memory(options.python_mem)
+worker_memory = parse_memory(options.worker_mem)
+memory_budget = None if options.memory_budget is None else parse_memory(options.memory_budget)
 
-    temp_year_dir = os.path.abspath("{path}/{year}".format(path=temp_path, year=year))
+# make the shared python-analysis modules (utils, ...) importable by the analysis scripts
+python_env = dict(os.environ)
+python_env["PYTHONPATH"] = os.pathsep.join(
+    [python_src_dir] + ([os.environ["PYTHONPATH"]] if "PYTHONPATH" in os.environ else []))
 
-    if not os.path.isdir(temp_year_dir):
-        os.makedirs(temp_year_dir)
 
-    sp.check_call([
-        "java", "-Xmx{mem}".format(mem=mem), "-cp", jar_path, "ch.ethz.ivt.sccer.planfeatures.WriteSccerPlanFeatures",
-        "{path}/output_plans.xml.gz".format(path=scenario_path),
-        "{path}/output_network.xml.gz".format(path=scenario_path),
-        "{path}/output_events.xml.gz".format(path=scenario_path),
-        "{path}/plan_features.csv".format(path=temp_year_dir)
-    ])
+# year-independent paths
+microcensus_dir = "{path}/microcensus".format(path=data_path)
+statpop_dir = "{path}/statpop".format(path=data_path)
+municipality_shp = "{path}/shp/g1g18.shp".format(path=data_path)
+municipality_files = glob.glob("{path}/shp/g1g18.*".format(path=data_path))
+spatial_structure_path = "{path}/spatial_structure_2018.xlsx".format(path=data_path)
+shared_inputs_path = "{path}/shared_inputs.json".format(path=temp_path)
 
-# run trips
-if update or not os.path.exists("{path}/{year}/trips.csv".format(path=temp_path, year=year)):
-    print("\ngetting trips...")
+# code of the python steps: the script and the shared modules
+utils_dir = os.path.join(python_src_dir, "utils")
 
-    temp_year_dir = os.path.abspath("{path}/{year}".format(path=temp_path, year=year))
 
-    if not os.path.isdir(temp_year_dir):
-        os.makedirs(temp_year_dir)
+def java_command(main_class, arguments):
+    return ["java", "-Xmx{mem}".format(mem=mem), "-cp", jar_path, main_class] + arguments
 
-    sp.check_call([
-        "java", "-Xmx{mem}".format(mem=mem), "-cp", jar_path, "ch.ethz.ivt.sccer.analysis.RunTripAnalysis",
-        "--network-path", "{path}/output_network.xml.gz".format(path=scenario_path),
-        "--events-path", "{path}/output_events.xml.gz".format(path=scenario_path),
-        "--output-path", "{path}/trips.csv".format(path=temp_year_dir)
-    ])
 
-# activity patterns with annual car distance, home locations and income
-if update or not os.path.exists("{path}/{year}/01_agent_clusters.{year}.csv".format(path=output_path, year=year)):
-    print("\ncreating activity patterns by annual car distance, home locations and income for STEM...")
+# analysis scripts loaded in this process (--in-process), by path
+script_modules = {}
 
-    output_year_dir = os.path.abspath("{path}/{year}".format(path=output_path, year=year))
-    if not os.path.isdir(output_year_dir):
-        os.makedirs(output_year_dir)
 
-    output_figure_dir = os.path.abspath("{path}/figures".format(path=output_year_dir))
-    if not os.path.isdir(output_figure_dir):
-        os.makedirs(output_figure_dir)
-
-    sp.check_call([
-        "python", "{path}/01_annual_car_dist_home_locations_income.py".format(path=python_path),
-        "--input", "{path}/{year}/plan_features.csv".format(path=temp_path, year=year),
-        "--mz-dir", "{path}/microcensus".format(path=data_path),
-        "--statpop-dir", "{path}/statpop".format(path=data_path),
-        "--matsim-trips", "{path}/{year}/trips.csv".format(path=temp_path, year=year),
-        "--municipality-shp", "{path}/shp/g1g18.shp".format(path=data_path),
-        "--spatial-structure", "{path}/spatial_structure_2018.xlsx".format(path=data_path),
-        "--figure", "{path}/01_agent_clusters.{year}.png".format(path=output_figure_dir, year=year),
-        "--output", "{path}/01_agent_clusters.{year}.csv".format(path=output_year_dir, year=year)
-    ])
-
-# trips for swissmod
-if update or not os.path.exists("{path}/{year}/01-trips.{year}.csv".format(path=output_path, year=year)):
-    print("\ncreating trips for Swissmod...")
+def script_module(script_path):
+    # script names start with a number: load them from their path rather than by module name
+    if script_path not in script_modules:
+        module_name = "run_" + os.path.splitext(os.path.basename(script_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, script_path)
+        module = importlib.util.module_from_spec(spec)
+        # registered, so that its functions can be pickled to the process pools of the script (e.g. figure rendering)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        script_modules[script_path] = module
+    return script_modules[script_path]
 
-    output_year_dir = os.path.abspath("{path}/{year}".format(path=output_path, year=year))
-    if not os.path.isdir(output_year_dir):
-        os.makedirs(output_year_dir)
 
+# home locations per year when running in this process, shared by the python steps of the year
+home_locations = {}
+
+
+def impute_home_locations(year, trips_path, home_locations_path):
+    from utils.home_locations import home_locations_table, impute_home_locations, write_home_locations
+    home_locations[year] = home_locations_table(
+        impute_home_locations(trips_path, municipality_shp, spatial_structure_path, temp_path))
+    write_home_locations(home_locations[year], home_locations_path)
+
+
+def year_home_locations(year, home_locations_path):
+    # written by an earlier run if the home locations step was up to date
+    if year not in home_locations:
+        from utils.home_locations import load_home_locations
+        home_locations[year] = load_home_locations(home_locations_path)
+    return home_locations[year]
+
+
+def python_step(name, script_name, arguments, inputs, outputs, directories=(), shared_data=lambda: {}, figures=False,
+                workers=1):
+    # shared_data: keyword arguments of the main() of the script when running in this process
+    # figures: whether the script supports --no-figures
+    # workers: number of processes of the script (--workers), counted as cores and memory of the step
+    # (not a parameter of the step: the outputs do not depend on it)
+    script_path = "{path}/{script}".format(path=python_path, script=script_name)
+    if figures and options.no_figures:
+        arguments = arguments + ["--no-figures"]
+    params = ["python", script_path] + arguments
+    if workers > 1:
+        arguments = arguments + ["--workers", str(workers)]
+
+    function = None
+    if options.in_process:
+        def function():
+            script_module(script_path).main(arguments, **shared_data())
+
+    return Step(name, ["python", script_path] + arguments,
+                inputs=inputs,
+                outputs=outputs,
+                code=[script_path, utils_dir],
+                params=params,
+                env=python_env,
+                directories=directories,
+                memory=python_memory + (workers - 1) * worker_memory,
+                cores=workers,
+                function=function)
+
+
+def convert_trips(trips_path):
+    from utils.trip_store import open_trips
+    open_trips(trips_path)
+
+
+# read the year-independent inputs (microcensus, municipalities, spatial structure) once for all years
+shared_steps = [python_step("shared inputs", "00_cache_shared_inputs.py",
+                            ["--mz-dir", microcensus_dir,
+                             "--municipality-shp", municipality_shp,
+                             "--spatial-structure", spatial_structure_path,
+                             "--cache-dir", temp_path,
+                             "--output", shared_inputs_path],
+                            inputs=[microcensus_dir, spatial_structure_path] + municipality_files,
+                            outputs=[shared_inputs_path])]
+
+# the per-year steps also depend on the raw shared inputs they read (through the cache): the summary written by the
+# shared inputs step does not change with the content of the tables
+spatial_inputs = [spatial_structure_path] + municipality_files
+
+
+def year_steps(year):
+    year_scenario_path = scenario_path.replace("{year}", year)
+    plans_path = "{path}/output_plans.xml.gz".format(path=year_scenario_path)
+    network_path = "{path}/output_network.xml.gz".format(path=year_scenario_path)
+    events_path = "{path}/output_events.xml.gz".format(path=year_scenario_path)
+
+    temp_year_dir = os.path.abspath("{path}/{year}".format(path=temp_path, year=year))
+    output_year_dir = os.path.abspath("{path}/{year}".format(path=output_path, year=year))
     output_figure_dir = os.path.abspath("{path}/figures".format(path=output_year_dir))
-    if not os.path.isdir(output_figure_dir):
-        os.makedirs(output_figure_dir)
-
-    sp.check_call([
-        "python", "{path}/03_merge_beddem_to_matsim_agents_for_swissmod.py".format(path=python_path),
-        "--beddem-vehicles", "{path}/01-disaggregatedvehiclestock.{year}.csv".format(path=beddem_path, year=year),
-        "--beddem-trips", "{path}/03-trips.{year}.csv".format(path=beddem_path, year=year),
-        "--matsim-trips", "{path}/{year}/trips.csv".format(path=temp_path, year=year),
-        "--municipality-shp", "{path}/shp/g1g18.shp".format(path=data_path),
-        "--spatial-structure", "{path}/spatial_structure_2018.xlsx".format(path=data_path),
-        "--fig-dir", output_figure_dir,
-        "--fig-ext", "png",
-        "--output", "{path}/01-trips.{year}.csv".format(path=output_year_dir, year=year)
-    ])
+
+    plan_features_path = "{path}/plan_features.csv".format(path=temp_year_dir)
+    trips_path = "{path}/trips.csv".format(path=temp_year_dir)
+    trip_store_path = "{path}/trips.parquet".format(path=temp_year_dir)
+
+    steps = []
+
+    # run features extraction
+    # (the java memory is not part of the parameters: changing it does not change the outputs)
+    feature_arguments = [plans_path, network_path, events_path, plan_features_path]
+    steps.append(Step("{year} feature extraction".format(year=year),
+                      java_command("ch.ethz.ivt.sccer.planfeatures.WriteSccerPlanFeatures", feature_arguments),
+                      inputs=[plans_path, network_path, events_path],
+                      outputs=[plan_features_path],
+                      code=[jar_path],
+                      params=["WriteSccerPlanFeatures"] + feature_arguments,
+                      memory=java_memory))
+
+    # run trips
+    trip_arguments = ["--network-path", network_path, "--events-path", events_path, "--output-path", trips_path]
+    steps.append(Step("{year} trip analysis".format(year=year),
+                      java_command("ch.ethz.ivt.sccer.analysis.RunTripAnalysis", trip_arguments),
+                      inputs=[network_path, events_path],
+                      outputs=[trips_path],
+                      code=[jar_path],
+                      params=["RunTripAnalysis"] + trip_arguments,
+                      memory=java_memory))
+
+    # convert trips to the columnar trip store read by the analysis scripts
+    steps.append(Step("{year} trip store conversion".format(year=year),
+                      ["python", "-m", "utils.trip_store", trips_path],
+                      inputs=[trips_path],
+                      outputs=[trip_store_path],
+                      code=[os.path.join(utils_dir, "trip_store.py")],
+                      env=python_env,
+                      memory=python_memory,
+                      function=(lambda: convert_trips(trips_path)) if options.in_process else None))
+
+    # impute the home locations of the agents once, for both scripts below
+    home_locations_path = "{path}/home_locations.parquet".format(path=temp_year_dir)
+    steps.append(Step("{year} home locations".format(year=year),
+                      ["python", "-m", "utils.home_locations",
+                       "--matsim-trips", trips_path,
+                       "--municipality-shp", municipality_shp,
+                       "--spatial-structure", spatial_structure_path,
+                       "--cache-dir", temp_path,
+                       "--output", home_locations_path],
+                      inputs=[trips_path, trip_store_path, shared_inputs_path] + spatial_inputs,
+                      outputs=[home_locations_path],
+                      code=[os.path.join(utils_dir, name) for name in ["home_locations.py", "spatial.py", "trip_store.py"]],
+                      env=python_env,
+                      memory=python_memory,
+                      function=(lambda: impute_home_locations(year, trips_path, home_locations_path))
+                      if options.in_process else None))
+
+    # activity patterns with annual car distance, home locations and income
+    output_csv = "{path}/01_agent_clusters.{year}.csv".format(path=output_year_dir, year=year)
+    steps.append(python_step("{year} activity patterns for STEM".format(year=year),
+                             "01_annual_car_dist_home_locations_income.py",
+                             ["--input", plan_features_path,
+                              "--mz-dir", microcensus_dir,
+                              "--statpop-dir", statpop_dir,
+                              "--matsim-trips", trips_path,
+                              "--municipality-shp", municipality_shp,
+                              "--spatial-structure", spatial_structure_path,
+                              "--home-locations", home_locations_path,
+                              "--cache-dir", temp_path,
+                              "--figure", "{path}/01_agent_clusters.{year}.png".format(path=output_figure_dir, year=year),
+                              "--output", output_csv],
+                             inputs=[plan_features_path, home_locations_path, shared_inputs_path, statpop_dir,
+                                     microcensus_dir] + spatial_inputs,
+                             outputs=[output_csv],
+                             directories=[output_figure_dir],
+                             shared_data=lambda: {"df_home": year_home_locations(year, home_locations_path)},
+                             figures=True))
+
+    # trips for swissmod (the matching is kept in the temporary directory: if only the consumption values of the
+    # vehicle stock changed, they are re-joined onto the matched agents without matching again)
+    beddem_vehicles_path = "{path}/01-disaggregatedvehiclestock.{year}.csv".format(path=beddem_path, year=year)
+    beddem_trips_path = "{path}/03-trips.{year}.csv".format(path=beddem_path, year=year)
+    output_csv = "{path}/01-trips.{year}.{ext}".format(path=output_year_dir, year=year, ext=options.swissmod_format)
+    steps.append(python_step("{year} trips for Swissmod".format(year=year),
+                             "03_merge_beddem_to_matsim_agents_for_swissmod.py",
+                             ["--beddem-vehicles", beddem_vehicles_path,
+                              "--beddem-trips", beddem_trips_path,
+                              "--matsim-trips", trips_path,
+                              "--municipality-shp", municipality_shp,
+                              "--spatial-structure", spatial_structure_path,
+                              "--home-locations", home_locations_path,
+                              "--cache-dir", temp_path,
+                              "--fig-dir", output_figure_dir,
+                              "--fig-ext", "png",
+                              "--matching", options.matching,
+                              "--matching-features", options.matching_features,
+                              "--match-index", "{path}/swissmod_matches.parquet".format(path=temp_year_dir),
+                              "--output", output_csv],
+                             inputs=[beddem_vehicles_path, beddem_trips_path, trip_store_path, home_locations_path]
+                             + spatial_inputs,
+                             outputs=[output_csv],
+                             directories=[output_figure_dir],
+                             shared_data=lambda: {"df_home": year_home_locations(year, home_locations_path)},
+                             figures=True,
+                             workers=workers))
+
+    return steps
+
+
+steps = shared_steps + [step for year in years for step in year_steps(year)]
+
+# run the steps whose inputs, code or parameters changed since their last run, and their dependents,
+# independent steps concurrently (e.g. both java runs, or the steps of different years), with one log file per step
+# and report the wall time, CPU time and peak memory of each step (java included) and of the stages of python steps
+report_path = options.report
+if report_path is None:
+    report_path = "{path}/reports/run_{date}.json".format(path=temp_path, date=time.strftime("%Y%m%d_%H%M%S"))
+
+pipeline = Pipeline(steps, "{path}/pipeline_state.json".format(path=temp_path))
+pipeline.run(force=update, dry_run=options.dry_run, jobs=jobs, memory_budget=memory_budget,
+             log_dir="{path}/logs".format(path=temp_path), report_path=report_path)